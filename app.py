@@ -6,14 +6,21 @@ Clean, professional design inspired by FinPlanner template
 import streamlit as st
 
 # Import modules
-from modules.database import init_db, init_default_data
+from modules.database import init_db, init_default_data, start_history_migration
+from modules.analytics import ensure_rollups
+from modules.analytics_engine import start_analytics_sync
 from modules.ui_components import show_debug_info, check_app_access
+from modules.metrics import track_rerun, start_metrics_server
+from modules.change_feed import start_change_feed_server
+from modules.profiling import profile_rerun
+from modules.coherence import start_coherence_watcher
 
 # Import pages
 from page_modules.login import show_login_page
 from page_modules.blister_scheduler import show_blister_scheduler_page
 from page_modules.user_admin import show_user_admin_page
 from page_modules.patient_management import show_patient_management_page
+from page_modules.analytics import show_analytics_page
 
 # Initialize session state
 if 'logged_in' not in st.session_state:
@@ -39,70 +46,94 @@ st.set_page_config(
 # Initialize database
 init_db()
 init_default_data()
+ensure_rollups()
+
+# Rewrite any old-format cycle history into the compact table without blocking staff
+start_history_migration()
+
+# Expose Prometheus metrics alongside Streamlit (once per process)
+start_metrics_server()
+
+# Push patient changes to live screens over SSE / long poll (once per process)
+start_change_feed_server()
+
+# Notice writes made by other replicas sharing the database (once per process)
+start_coherence_watcher()
+
+# Load the columnar copy long-range reports run on (once per process)
+start_analytics_sync()
 
 # Main Application Logic
-if not st.session_state.logged_in:
-    show_login_page()
-else:
-    # Add branding to header bar
-    st.markdown(f"""
-        <style>
-        header[data-testid="stHeader"]::before {{
-            content: "PHARMALIFE";
-            font-weight: 700;
-            font-size: 1.1rem;
-            margin-right: auto;
-            padding-left: 1rem;
-        }}
+def main():
+    """Render the page for the current session"""
+    if not st.session_state.logged_in:
+        show_login_page()
+    else:
+        # Add branding to header bar
+        st.markdown(f"""
+            <style>
+            header[data-testid="stHeader"]::before {{
+                content: "PHARMALIFE";
+                font-weight: 700;
+                font-size: 1.1rem;
+                margin-right: auto;
+                padding-left: 1rem;
+            }}
         
-        header[data-testid="stHeader"]::after {{
-            content: "{st.session_state.full_name} ({st.session_state.role})";
-            font-size: 0.9rem;
-            padding-right: 1rem;
-        }}
-        </style>
-    """, unsafe_allow_html=True)
+            header[data-testid="stHeader"]::after {{
+                content: "{st.session_state.full_name} ({st.session_state.role})";
+                font-size: 0.9rem;
+                padding-right: 1rem;
+            }}
+            </style>
+        """, unsafe_allow_html=True)
     
-    # Sidebar
-    with st.sidebar:
+        # Sidebar
+        with st.sidebar:
         
-        # Show debug info
-        show_debug_info(
-            st.session_state.user_id,
-            st.session_state.username,
-            st.session_state.role
-        )
+            # Show debug info
+            show_debug_info(
+                st.session_state.user_id,
+                st.session_state.username,
+                st.session_state.role
+            )
         
-        # Check app access
-        has_blister_access = check_app_access(
-            st.session_state.user_id,
-            st.session_state.role,
-            'blister_scheduler'
-        )
+            # Check app access
+            has_blister_access = check_app_access(
+                st.session_state.user_id,
+                st.session_state.role,
+                'blister_scheduler'
+            )
         
-        # Navigation menu
-        if st.session_state.role == 'admin':
-            page = st.radio("Navigation Menu", ["Blister Scheduler", "Patient Management", "User Management", "Logout"], label_visibility="collapsed")
-        else:
-            page = st.radio("Navigation Menu", ["Blister Scheduler", "Patient Management", "Logout"], label_visibility="collapsed")
+            # Navigation menu
+            if st.session_state.role == 'admin':
+                page = st.radio("Navigation Menu", ["Blister Scheduler", "Patient Management", "Analytics", "User Management", "Logout"], label_visibility="collapsed")
+            else:
+                page = st.radio("Navigation Menu", ["Blister Scheduler", "Patient Management", "Analytics", "Logout"], label_visibility="collapsed")
+    
+        # Handle navigation
+        if page == "Logout":
+            st.session_state.logged_in = False
+            st.session_state.user_id = None
+            st.session_state.username = None
+            st.session_state.full_name = None
+            st.session_state.role = None
+            st.rerun()
     
-    # Handle navigation
-    if page == "Logout":
-        st.session_state.logged_in = False
-        st.session_state.user_id = None
-        st.session_state.username = None
-        st.session_state.full_name = None
-        st.session_state.role = None
-        st.rerun()
+        elif page == "Patient Management":
+            show_patient_management_page()
     
-    elif page == "Patient Management":
-        show_patient_management_page()
+        elif page == "Analytics":
+            show_analytics_page()
     
-    elif page == "User Management" and st.session_state.role == 'admin':
-        show_user_admin_page()
+        elif page == "User Management" and st.session_state.role == 'admin':
+            show_user_admin_page()
     
-    elif page == "Blister Scheduler":
-        if not has_blister_access:
-            st.error("You don't have access to the Blister Pack Scheduler.")
-        else:
-            show_blister_scheduler_page()
\ No newline at end of file
+        elif page == "Blister Scheduler":
+            if not has_blister_access:
+                st.error("You don't have access to the Blister Pack Scheduler.")
+            else:
+                show_blister_scheduler_page()
+
+with track_rerun(), profile_rerun(st.session_state.username):
+    main()
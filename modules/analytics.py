@@ -0,0 +1,88 @@
+"""
+Analytics module for Blister Pack Scheduler
+Keeps monthly cost and cycle rollups per insurer, delivery method and schedule type,
+updated incrementally as each cycle is recorded
+"""
+
+import pandas as pd
+from modules.database import get_connection, get_read_connection
+
+# Rollups store missing dimensions as '' so they can be part of the primary key
+UNKNOWN = ''
+
+def _dimensions(insurer, delivery, schedule_type):
+    return (insurer or UNKNOWN, delivery or UNKNOWN, schedule_type or UNKNOWN)
+
+def record_cycle_rollup(conn, patient_id, billing_date, insurer, delivery, schedule_type, cost):
+    """Add one cycle to its monthly rollup inside the caller's transaction"""
+    c = conn.cursor()
+    month = billing_date[:7]
+    dims = _dimensions(insurer, delivery, schedule_type)
+
+    c.execute('''
+        INSERT OR IGNORE INTO rollup_patients (month, insurer, delivery, schedule_type, patient_id)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (month, *dims, patient_id))
+    new_patient = c.rowcount
+
+    c.execute('''
+        INSERT INTO monthly_rollups (month, insurer, delivery, schedule_type, cycles, total_cost, patient_count)
+        VALUES (?, ?, ?, ?, 1, ?, ?)
+        ON CONFLICT(month, insurer, delivery, schedule_type) DO UPDATE SET
+            cycles = cycles + 1,
+            total_cost = total_cost + excluded.total_cost,
+            patient_count = patient_count + excluded.patient_count
+    ''', (month, *dims, cost or 0.0, new_patient))
+
+def rebuild_rollups():
+    """
+    Recompute all rollups from the cycle history (one-off backfill or repair)
+    History does not record what a patient's insurer or cost was at the time,
+    so the backfill uses each patient's current details.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('DELETE FROM monthly_rollups')
+    c.execute('DELETE FROM rollup_patients')
+    c.execute('''
+        INSERT INTO rollup_patients (month, insurer, delivery, schedule_type, patient_id)
+        SELECT DISTINCT substr(r.new_billing_date, 1, 7), COALESCE(p.insurance, ''),
+               COALESCE(p.delivery, ''), COALESCE(p.blister_schedule, ''), r.patient_id
+        FROM schedule_history r
+        JOIN patients p ON p.id = r.patient_id
+    ''')
+    c.execute('''
+        INSERT INTO monthly_rollups (month, insurer, delivery, schedule_type, cycles, total_cost, patient_count)
+        SELECT substr(r.new_billing_date, 1, 7), COALESCE(p.insurance, ''), COALESCE(p.delivery, ''),
+               COALESCE(p.blister_schedule, ''), COUNT(*), SUM(COALESCE(p.cost, 0)),
+               COUNT(DISTINCT r.patient_id)
+        FROM schedule_history r
+        JOIN patients p ON p.id = r.patient_id
+        GROUP BY 1, 2, 3, 4
+    ''')
+    conn.commit()
+    conn.close()
+
+def ensure_rollups():
+    """Backfill rollups once for databases that have history but no rollups yet"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT EXISTS(SELECT 1 FROM monthly_rollups), EXISTS(SELECT 1 FROM schedule_history)')
+    has_rollups, has_history = c.fetchone()
+    conn.close()
+    if has_history and not has_rollups:
+        rebuild_rollups()
+
+def get_monthly_rollups(start_month=None, use_snapshot=True):
+    """Get rollup rows (optionally from start_month 'YYYY-MM'), labelling missing dimensions"""
+    conn = get_read_connection(use_snapshot)
+    query = 'SELECT * FROM monthly_rollups'
+    params = ()
+    if start_month:
+        query += ' WHERE month >= ?'
+        params = (start_month,)
+    df = pd.read_sql_query(query + ' ORDER BY month', conn, params=params)
+    conn.close()
+    for column in ('insurer', 'delivery', 'schedule_type'):
+        df[column] = df[column].replace(UNKNOWN, 'Unknown')
+    return df
@@ -0,0 +1,281 @@
+"""
+Analytics engine module for Blister Pack Scheduler
+Long-range report queries (cycles per month by insurer, schedule adherence, cost by
+year) run on an embedded DuckDB engine over a columnar copy of the SQLite data
+
+Writes stay on sqlite3. Each process keeps an in-memory DuckDB copy of the patient
+dimensions and the compact cycle history (with month keys precomputed). The first
+load runs in the background at startup; after that, each report first appends the
+history rows added since the last one (an id watermark) and, when patients changed,
+re-reads only the rows whose version moved and drops deleted patients with their
+history. Until the copy is ready, if it failed to load, or without the duckdb package,
+the same reports run on the SQLite report snapshot.
+"""
+
+import logging
+import threading
+import pandas as pd
+from modules.database import get_connection, get_snapshot_connection
+
+try:
+    import duckdb
+except ImportError:  # optional dependency: reports fall back to SQLite
+    duckdb = None
+
+SYNC_CHUNK = 250000        # history rows copied per batch into DuckDB
+PATIENT_CHUNK = 500        # changed patients re-read per query
+ON_TIME_GRACE_DAYS = 0     # a cycle done this many days after its due day still counts as on time
+
+DIMENSIONS = ('insurance', 'delivery', 'blister_schedule')
+
+logger = logging.getLogger(__name__)
+
+# Reports read `history` with month keys (YYYYMM integers) and the cycle day. DuckDB
+# stores those columns in its copy; SQLite derives them on the fly.
+DIALECTS = {
+    'duckdb': {
+        'history': 'schedule_records',
+        'month_label': "printf('%d-%02d', {0} // 100, {0} % 100)",
+        'year': "({0} // 100)",
+    },
+    'sqlite': {
+        'history': '''(
+            SELECT *,
+                   CAST(strftime('%Y%m', new_billing_day * 86400, 'unixepoch') AS INTEGER) AS new_billing_month,
+                   CAST(strftime('%Y%m', previous_billing_day * 86400, 'unixepoch') AS INTEGER) AS previous_billing_month,
+                   cycled_at / 86400 AS cycled_day
+            FROM schedule_records
+        )''',
+        'month_label': "printf('%d-%02d', {0} / 100, {0} % 100)",
+        'year': "({0} / 100)",
+    },
+}
+
+_engine = {'conn': None, 'ready': False, 'loading': False, 'failed': False, 'patients_version': None,
+           'history_version': None, 'history_max_id': 0, 'legacy': None}
+_sync_lock = threading.Lock()
+
+def engine_name():
+    """Engine the next report will run on: 'duckdb', or 'sqlite' (no duckdb, copy still loading or failed)"""
+    usable = duckdb is not None and not _engine['failed']
+    return 'duckdb' if usable and (_engine['ready'] or not _engine['loading']) else 'sqlite'
+
+def _month_key(column):
+    date = f"(DATE '1970-01-01' + CAST({column} AS INTEGER))"
+    return f"year({date}) * 100 + month({date})"
+
+# Columnar Copy
+def _duckdb():
+    if _engine['conn'] is None:
+        conn = duckdb.connect()
+        conn.execute('''
+            CREATE TABLE patients (id BIGINT, version BIGINT, insurance VARCHAR, delivery VARCHAR,
+                                   blister_schedule VARCHAR, cost DOUBLE)
+        ''')
+        conn.execute('''
+            CREATE TABLE schedule_records (id BIGINT, patient_id BIGINT, previous_billing_day INTEGER,
+                                           new_billing_day INTEGER, new_next_schedule_day INTEGER,
+                                           cycled_at BIGINT, new_billing_month INTEGER,
+                                           previous_billing_month INTEGER, cycled_day INTEGER)
+        ''')
+        _engine['conn'] = conn
+    return _engine['conn']
+
+def _copy_history(source, target, after_id):
+    """Append SQLite history rows with id > after_id to the DuckDB copy"""
+    day_columns = ['previous_billing_day', 'new_billing_day', 'new_next_schedule_day', 'cycled_at']
+    for chunk in pd.read_sql_query('''
+        SELECT id, patient_id, previous_billing_day, new_billing_day, new_next_schedule_day, cycled_at
+        FROM schedule_records WHERE id > ? ORDER BY id
+    ''', source, params=(after_id,), chunksize=SYNC_CHUNK, dtype={column: 'Int64' for column in day_columns}):
+        target.register('incoming', chunk)
+        target.execute(f'''
+            INSERT INTO schedule_records
+            SELECT *, {_month_key('new_billing_day')}, {_month_key('previous_billing_day')}, cycled_at // 86400
+            FROM incoming
+        ''')
+        target.unregister('incoming')
+        _engine['history_max_id'] = int(chunk['id'].iloc[-1])
+
+def _copy_patients(source, target, reload):
+    """
+    Bring the patients copy up to date with the live table
+    Rows are compared by id and row version (every patient write bumps it), so only new
+    and changed rows are re-read; patients that are gone are dropped with their history.
+    """
+    columns = f"id, version, {', '.join(DIMENSIONS)}, cost"
+    if reload:
+        target.execute('DELETE FROM patients')
+        incoming = pd.read_sql_query(f'SELECT {columns} FROM patients', source)
+    else:
+        target.register('current', pd.read_sql_query('SELECT id, version FROM patients', source))
+        target.execute('''
+            DELETE FROM schedule_records
+            WHERE patient_id IN (SELECT id FROM patients WHERE id NOT IN (SELECT id FROM current))
+        ''')
+        target.execute('DELETE FROM patients WHERE id NOT IN (SELECT id FROM current)')
+        changed = [patient_id for (patient_id,) in target.execute('''
+            SELECT c.id FROM current c
+            LEFT JOIN patients p ON p.id = c.id
+            WHERE p.version IS DISTINCT FROM c.version
+        ''').fetchall()]
+        target.unregister('current')
+        if not changed:
+            return
+        incoming = pd.concat([
+            pd.read_sql_query(f"SELECT {columns} FROM patients WHERE id IN ({', '.join('?' * len(chunk))})",
+                              source, params=chunk)
+            for chunk in (changed[i:i + PATIENT_CHUNK] for i in range(0, len(changed), PATIENT_CHUNK))
+        ], ignore_index=True)
+    target.register('incoming', incoming)
+    if not reload:
+        target.execute('DELETE FROM patients WHERE id IN (SELECT id FROM incoming)')
+    target.execute('INSERT INTO patients SELECT * FROM incoming')
+    target.unregister('incoming')
+
+def sync():
+    """
+    Bring the DuckDB copy up to date with the live database
+    History rows only disappear with their patient, and only gain lower ids while the
+    one-off history migration runs, so appending new ids and dropping the history of
+    deleted patients keeps the copy exact; everything is reloaded when the migration
+    finishes, when a patient merge moves history rows to another patient, and after a
+    restore. The SQLite side is read in one read transaction and the copy is changed in
+    one DuckDB transaction, so a report running meanwhile never sees it half loaded.
+    """
+    source = get_connection()
+    c = source.cursor()
+    c.execute('BEGIN')
+    try:
+        c.execute("SELECT scope, version FROM data_versions WHERE scope IN ('patients', 'history')")
+        versions = dict(c.fetchall())
+        patients_version, history_version = versions['patients'], versions.get('history')
+        c.execute('SELECT MAX(id) FROM schedule_records')
+        max_id = c.fetchone()[0] or 0
+        c.execute("SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE name = 'schedule_records_legacy')")
+        legacy = c.fetchone()[0]
+
+        with _sync_lock:
+            reload = (_engine['patients_version'] is None or legacy != _engine['legacy']
+                      or history_version != _engine['history_version'] or max_id < _engine['history_max_id'])
+            if not reload and max_id == _engine['history_max_id'] and patients_version == _engine['patients_version']:
+                return
+            target = _duckdb()
+            target.execute('BEGIN')
+            try:
+                if reload:
+                    target.execute('DELETE FROM schedule_records')
+                    _engine['history_max_id'] = 0
+                if max_id > _engine['history_max_id']:
+                    _copy_history(source, target, _engine['history_max_id'])
+                if reload or patients_version != _engine['patients_version']:
+                    _copy_patients(source, target, reload)
+                target.execute('COMMIT')
+            except Exception:
+                target.execute('ROLLBACK')
+                # The watermarks may have moved with the rolled-back rows: reload next time
+                _engine['patients_version'] = None
+                raise
+            _engine['patients_version'] = patients_version
+            _engine['legacy'] = legacy
+            _engine['history_version'] = history_version
+            _engine['ready'] = True
+    finally:
+        source.rollback()
+        source.close()
+
+def _load_in_background():
+    try:
+        sync()
+    except Exception as e:
+        logger.warning("Analytics copy failed to load, reports stay on SQLite: %s", e)
+        _engine['failed'] = True
+    finally:
+        _engine['loading'] = False
+
+def start_analytics_sync():
+    """Load the DuckDB copy on a background thread (once per process); reports use SQLite meanwhile"""
+    with _sync_lock:
+        if duckdb is None or _engine['ready'] or _engine['loading']:
+            return False
+        _engine['loading'] = True
+    threading.Thread(target=_load_in_background, daemon=True).start()
+    return True
+
+def _query(build_sql, params=()):
+    """Run a report built for the active engine's dialect and return a DataFrame"""
+    if engine_name() == 'duckdb':
+        try:
+            sync()
+        except Exception as e:
+            logger.warning("Analytics copy failed to sync, reports fall back to SQLite: %s", e)
+            _engine['failed'] = True
+        else:
+            cursor = _duckdb().cursor()
+            try:
+                return cursor.execute(build_sql(DIALECTS['duckdb']), list(params)).df()
+            finally:
+                cursor.close()
+    conn = get_snapshot_connection()
+    df = pd.read_sql_query(build_sql(DIALECTS['sqlite']), conn, params=params)
+    conn.close()
+    return df
+
+# Reports
+def cycles_by_month(dimension='insurance', start_day=0):
+    """
+    Cycles, cost and distinct patients per billing month and dimension value
+    Cost and dimensions are the patient's current details (history does not keep them).
+    Returns DataFrame: month, <dimension>, cycles, total_cost, patients
+    """
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension: {dimension}")
+    return _query(lambda d: f'''
+        SELECT {d['month_label'].format('r.new_billing_month')} AS month,
+               COALESCE(NULLIF(p.{dimension}, ''), 'Unknown') AS {dimension},
+               COUNT(*) AS cycles,
+               SUM(COALESCE(p.cost, 0)) AS total_cost,
+               COUNT(DISTINCT r.patient_id) AS patients
+        FROM {d['history']} r
+        JOIN patients p ON p.id = r.patient_id
+        WHERE r.new_billing_day >= ?
+        GROUP BY r.new_billing_month, 2
+        ORDER BY 1, 2
+    ''', (start_day,))
+
+def schedule_adherence(start_day=0, grace_days=ON_TIME_GRACE_DAYS):
+    """
+    How promptly due packs were cycled, per due month
+    A cycle is on time when it was done no later than grace_days after the billing day it closed.
+    Returns DataFrame: month, cycles, on_time, on_time_pct, avg_days_late
+    """
+    return _query(lambda d: f'''
+        SELECT {d['month_label'].format('previous_billing_month')} AS month,
+               COUNT(*) AS cycles,
+               CAST(SUM(CASE WHEN cycled_day - previous_billing_day <= ? THEN 1 ELSE 0 END) AS INTEGER) AS on_time,
+               ROUND(100.0 * SUM(CASE WHEN cycled_day - previous_billing_day <= ? THEN 1 ELSE 0 END)
+                     / COUNT(*), 1) AS on_time_pct,
+               ROUND(AVG(CASE WHEN cycled_day > previous_billing_day
+                              THEN cycled_day - previous_billing_day ELSE 0 END), 2) AS avg_days_late
+        FROM {d['history']} r
+        WHERE previous_billing_day >= ?
+        GROUP BY previous_billing_month
+        ORDER BY 1
+    ''', (grace_days, grace_days, start_day))
+
+def cost_by_year():
+    """
+    Cycles, cost and patients per billing year
+    Returns DataFrame: year, cycles, patients, total_cost, avg_cost_per_cycle
+    """
+    return _query(lambda d: f'''
+        SELECT {d['year'].format('r.new_billing_month')} AS year,
+               COUNT(*) AS cycles,
+               COUNT(DISTINCT r.patient_id) AS patients,
+               SUM(COALESCE(p.cost, 0)) AS total_cost,
+               ROUND(AVG(COALESCE(p.cost, 0)), 2) AS avg_cost_per_cycle
+        FROM {d['history']} r
+        JOIN patients p ON p.id = r.patient_id
+        GROUP BY 1
+        ORDER BY 1
+    ''')
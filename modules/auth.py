@@ -6,6 +6,7 @@ Handles password hashing and user authentication
 import hashlib
 import pandas as pd
 from modules.database import get_connection
+from modules.coherence import cached_read
 
 def hash_password(password):
     """Hash a password using SHA-256"""
@@ -29,12 +30,14 @@ def authenticate_user(username, password):
     return user
 
 def get_user_apps(user_id):
-    """Get apps assigned to a user"""
-    conn = get_connection()
-    df = pd.read_sql_query('''
-        SELECT a.* FROM apps a
-        JOIN user_apps ua ON a.id = ua.app_id
-        WHERE ua.user_id = ?
-    ''', conn, params=(user_id,))
-    conn.close()
-    return df
+    """Get apps assigned to a user (cached until any replica changes users or assignments)"""
+    def load():
+        conn = get_connection()
+        df = pd.read_sql_query('''
+            SELECT a.* FROM apps a
+            JOIN user_apps ua ON a.id = ua.app_id
+            WHERE ua.user_id = ?
+        ''', conn, params=(user_id,))
+        conn.close()
+        return df
+    return cached_read('access', ('user_apps', user_id), load)
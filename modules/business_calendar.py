@@ -0,0 +1,176 @@
+"""
+Business calendar module for Blister Pack Scheduler
+Opening days per location, holidays and one-off closures, and moving schedule
+dates off days the pharmacy is closed
+
+Each location has a weekmask of open weekdays (Monday first) and a roll direction:
+'preceding' moves a date that falls on a closed day back to the previous open day,
+'following' moves it forward to the next one. Holidays close every location;
+location closures close just one. Calendars are compiled into NumPy business-day
+calendars once per change and roll whole arrays of day numbers at a time.
+"""
+
+import numpy as np
+from datetime import date, timedelta
+from modules.database import get_connection
+from modules.coherence import cached_read, note_local_write
+
+DEFAULT_WEEKMASK = '1111110'   # Monday to Saturday
+DEFAULT_ROLL = 'preceding'
+ROLLS = {'preceding': 'backward', 'following': 'forward'}
+WEEKDAY_LABELS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+EPOCH = date(1970, 1, 1)
+
+class BusinessCalendar:
+    """Open days of one location, compiled for vectorized rolling"""
+
+    def __init__(self, weekmask=DEFAULT_WEEKMASK, closed_days=(), roll=DEFAULT_ROLL):
+        if roll not in ROLLS:
+            raise ValueError(f"Roll must be one of {', '.join(ROLLS)}")
+        if '1' not in weekmask:
+            raise ValueError("A location needs at least one open weekday")
+        self.weekmask = weekmask
+        self.roll = roll
+        self._calendar = np.busdaycalendar(weekmask=weekmask,
+                                           holidays=np.array(sorted(closed_days), dtype='datetime64[D]'))
+
+    def roll_days(self, days, after=None):
+        """
+        Day numbers moved onto open days (days already open are unchanged)
+        Where rolling back would land on or before the matching `after` day (the billing
+        day the date was computed from), the date rolls forward instead.
+        """
+        dates = np.asarray(days, dtype='int64').astype('datetime64[D]')
+        rolled = np.busday_offset(dates, 0, roll=ROLLS[self.roll], busdaycal=self._calendar).astype('int64')
+        if after is not None and self.roll == 'preceding':
+            forward = np.busday_offset(dates, 0, roll='forward', busdaycal=self._calendar).astype('int64')
+            rolled = np.where(rolled <= np.asarray(after, dtype='int64'), forward, rolled)
+        return rolled
+
+    def roll_date(self, value, after=None):
+        """A single date moved onto an open day"""
+        day = (value - EPOCH).days
+        after_day = None if after is None else (after - EPOCH).days
+        return EPOCH + timedelta(days=int(self.roll_days([day], after_day)[0]))
+
+
+def load_calendars(conn):
+    """
+    Compile every location's calendar from a connection
+    Returns dict: location_id -> BusinessCalendar, with None mapping to the default
+    location's calendar (the first location, or the built-in defaults if there is none)
+    """
+    c = conn.cursor()
+    c.execute('SELECT day FROM holidays')
+    holidays = [day for (day,) in c.fetchall()]
+    c.execute('SELECT location_id, day FROM location_closures')
+    closures = {}
+    for location_id, day in c.fetchall():
+        closures.setdefault(location_id, []).append(day)
+    c.execute('SELECT id, weekmask, roll FROM locations ORDER BY id')
+    calendars = {}
+    for location_id, weekmask, roll in c.fetchall():
+        calendars[location_id] = BusinessCalendar(weekmask, holidays + closures.get(location_id, []), roll)
+    calendars[None] = next(iter(calendars.values()), None) or BusinessCalendar(closed_days=holidays)
+    return calendars
+
+def get_calendars():
+    """Compiled calendars of the live database, shared until any replica changes them"""
+    def load():
+        conn = get_connection()
+        calendars = load_calendars(conn)
+        conn.close()
+        return calendars
+    return cached_read('calendar', 'calendars', load)
+
+# Location CRUD Operations
+def get_locations():
+    """All locations as a list of dicts (id, name, weekmask, roll)"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT id, name, weekmask, roll FROM locations ORDER BY id')
+    locations = [dict(zip(('id', 'name', 'weekmask', 'roll'), row)) for row in c.fetchall()]
+    conn.close()
+    return locations
+
+def _validate(weekmask, roll):
+    BusinessCalendar(weekmask, (), roll)
+
+def add_location(name, weekmask=DEFAULT_WEEKMASK, roll=DEFAULT_ROLL):
+    """Add a location; returns its id"""
+    _validate(weekmask, roll)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('INSERT INTO locations (name, weekmask, roll) VALUES (?, ?, ?)', (name, weekmask, roll))
+    location_id = c.lastrowid
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
+    return location_id
+
+def update_location(location_id, name, weekmask, roll):
+    """Change a location's name, open weekdays or roll direction"""
+    _validate(weekmask, roll)
+    conn = get_connection()
+    conn.execute('UPDATE locations SET name = ?, weekmask = ?, roll = ? WHERE id = ?',
+                 (name, weekmask, roll, int(location_id)))
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
+
+# Holidays and Closures
+def get_holidays():
+    """Holidays as a list of (date, name), earliest first"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT day, name FROM holidays ORDER BY day')
+    holidays = [(EPOCH + timedelta(days=day), name) for day, name in c.fetchall()]
+    conn.close()
+    return holidays
+
+def set_holiday(holiday_date, name):
+    """Close every location on a date"""
+    conn = get_connection()
+    conn.execute('INSERT OR REPLACE INTO holidays (day, name) VALUES (?, ?)', ((holiday_date - EPOCH).days, name))
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
+
+def remove_holiday(holiday_date):
+    conn = get_connection()
+    conn.execute('DELETE FROM holidays WHERE day = ?', ((holiday_date - EPOCH).days,))
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
+
+def get_closures():
+    """Location closures as a list of (location_id, location name, date, reason), earliest first"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT lc.location_id, l.name, lc.day, lc.reason
+        FROM location_closures lc
+        JOIN locations l ON l.id = lc.location_id
+        ORDER BY lc.day, l.name
+    ''')
+    closures = [(location_id, name, EPOCH + timedelta(days=day), reason) for location_id, name, day, reason in c.fetchall()]
+    conn.close()
+    return closures
+
+def set_closure(location_id, closure_date, reason=None):
+    """Close one location on a date"""
+    conn = get_connection()
+    conn.execute('INSERT OR REPLACE INTO location_closures (location_id, day, reason) VALUES (?, ?, ?)',
+                 (int(location_id), (closure_date - EPOCH).days, reason))
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
+
+def remove_closure(location_id, closure_date):
+    conn = get_connection()
+    conn.execute('DELETE FROM location_closures WHERE location_id = ? AND day = ?',
+                 (int(location_id), (closure_date - EPOCH).days))
+    conn.commit()
+    conn.close()
+    note_local_write('calendar')
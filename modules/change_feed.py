@@ -0,0 +1,142 @@
+"""
+Change feed module for Blister Pack Scheduler
+Publishes patient changes (adds, edits, cycles, discharges, deletes) as they are
+committed, so screens can refresh just what changed instead of re-reading every table
+
+Streamlit fragments compare latest_seq() with the sequence they last rendered.
+Other screens (front-counter displays, the Node client) subscribe over HTTP:
+    GET /events?since=N                 server-sent events, one 'change' event per write
+    GET /changes?since=N&timeout=25     long poll: JSON list of changes after N
+The feed lives in memory and covers writes made by this process; writes by other
+replicas sharing the database arrive as a 'reset' from the coherence watcher.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CHANGES_HOST = os.environ.get('BLISTER_CHANGES_HOST', '127.0.0.1')
+CHANGES_PORT = int(os.environ.get('BLISTER_CHANGES_PORT', '9465'))
+
+FEED_LENGTH = 1000           # changes kept for subscribers that fall behind
+LONG_POLL_TIMEOUT = 25       # seconds a long poll waits before answering empty
+SSE_KEEPALIVE_SECONDS = 15   # comment line sent on idle event streams
+
+logger = logging.getLogger(__name__)
+
+Change = namedtuple('Change', ['seq', 'kind', 'patient_ids', 'at'])
+
+_changes = deque(maxlen=FEED_LENGTH)
+_state = {'seq': 0}
+_condition = threading.Condition()
+
+def publish(kind, patient_ids=()):
+    """Record a committed change and wake everyone waiting on the feed"""
+    with _condition:
+        _state['seq'] += 1
+        _changes.append(Change(_state['seq'], kind, [int(pid) for pid in patient_ids], time.time()))
+        _condition.notify_all()
+
+def latest_seq():
+    """Sequence number of the most recent change (0 before any)"""
+    return _state['seq']
+
+def changes_since(seq):
+    """
+    Changes after a sequence number, oldest first
+    A subscriber that fell further behind than the feed keeps gets a single 'reset'
+    change, meaning it should reload everything. So does one ahead of the feed: the
+    sequence starts again from 0 when the process restarts, so its position is from
+    before the restart and it may have missed anything since.
+    """
+    with _condition:
+        if seq == _state['seq']:
+            return []
+        if seq > _state['seq'] or (_changes and seq < _changes[0].seq - 1):
+            return [Change(_state['seq'], 'reset', [], time.time())]
+        return [change for change in _changes if change.seq > seq]
+
+def wait_for_changes(seq, timeout=LONG_POLL_TIMEOUT):
+    """Block until there are changes after seq (or the timeout passes) and return them"""
+    with _condition:
+        # A seq ahead of the feed answers at once, with a 'reset'
+        _condition.wait_for(lambda: _state['seq'] != seq, timeout)
+    return changes_since(seq)
+
+# HTTP Subscriptions
+class _ChangeFeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            since = int(query.get('since', [self.headers.get('Last-Event-ID') or latest_seq()])[0])
+            timeout = min(float(query.get('timeout', [LONG_POLL_TIMEOUT])[0]), LONG_POLL_TIMEOUT)
+        except ValueError:
+            self.send_error(400, 'since and timeout must be numbers')
+            return
+
+        if url.path == '/changes':
+            self._long_poll(since, timeout)
+        elif url.path == '/events':
+            self._stream(since)
+        else:
+            self.send_error(404)
+
+    def _long_poll(self, since, timeout):
+        changes = wait_for_changes(since, timeout)
+        body = json.dumps({
+            'seq': changes[-1].seq if changes else since,
+            'changes': [change._asdict() for change in changes],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, since):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        try:
+            while True:
+                changes = wait_for_changes(since, SSE_KEEPALIVE_SECONDS)
+                if not changes:
+                    self.wfile.write(b': keepalive\n\n')
+                for change in changes:
+                    self.wfile.write(f"id: {change.seq}\nevent: change\ndata: {json.dumps(change._asdict())}\n\n".encode())
+                    since = change.seq
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_change_feed_server(host=CHANGES_HOST, port=CHANGES_PORT):
+    """Serve /events and /changes on a background thread (once per process)"""
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server or None
+        try:
+            _server = ThreadingHTTPServer((host, port), _ChangeFeedHandler)
+        except OSError as e:
+            logger.warning("Change feed server not started on %s:%s: %s", host, port, e)
+            _server = False
+            return None
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
@@ -0,0 +1,105 @@
+"""
+Coherence module for Blister Pack Scheduler
+Keeps in-process caches correct when several app replicas share one database
+
+Triggers bump a per-scope counter in the data_versions table whenever patients (or
+their rules), users and app assignments, or the business calendar change, whichever
+process made the change.
+Each process re-reads that small table at most every COHERENCE_CHECK_SECONDS, so a
+write in one replica invalidates the other replicas' cached reads within that delay.
+Remote patient changes are also published on the local change feed as a 'reset',
+so live widgets and SSE subscribers of every replica refresh.
+"""
+
+import logging
+import os
+import threading
+import time
+from modules.database import get_connection, record_write
+from modules.change_feed import publish
+from modules.metrics import record_cache
+
+COHERENCE_CHECK_SECONDS = float(os.environ.get('BLISTER_COHERENCE_SECONDS', '1.0'))
+
+logger = logging.getLogger(__name__)
+
+_versions = {}                    # scope -> version last read from the database
+_state = {'checked_at': 0.0}
+_lock = threading.Lock()
+_cache = {}                       # (scope, key) -> (version, value)
+
+def _read_versions():
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT scope, version FROM data_versions')
+    versions = dict(c.fetchall())
+    conn.close()
+    return versions
+
+def check_versions(force=False, local_scope=None):
+    """
+    Version of every scope, re-read from the database at most every COHERENCE_CHECK_SECONDS
+    A scope that moved (other than local_scope, which this process just wrote) is a
+    write by another replica: its cached reads are dropped and the change is published.
+    """
+    if not force and time.monotonic() - _state['checked_at'] < COHERENCE_CHECK_SECONDS:
+        return _versions
+    with _lock:
+        if not force and time.monotonic() - _state['checked_at'] < COHERENCE_CHECK_SECONDS:
+            return _versions
+        latest = _read_versions()
+        moved = {scope: version - _versions[scope] for scope, version in latest.items()
+                 if scope in _versions and version != _versions[scope]}
+        _versions.update(latest)
+        _state['checked_at'] = time.monotonic()
+        for key in [key for key in _cache if key[0] in moved]:
+            del _cache[key]
+
+    remote = moved.get('patients') if local_scope != 'patients' else None
+    if remote:
+        # Row counts are unknown here; the snapshot and subscribers just learn something changed.
+        # A version can only go back when a backup was restored, which is still a change.
+        record_write(max(remote, 1))
+        publish('reset')
+    return _versions
+
+def note_local_write(scope):
+    """
+    Re-read the versions right after this process committed a write to a scope, so its
+    own caches see the write at once and the watcher does not mistake it for a remote one
+    (a remote write landing in the same instant is then only picked up by the local publish)
+    """
+    check_versions(force=True, local_scope=scope)
+
+def cached_read(scope, key, loader):
+    """Result of loader(), shared by all sessions until the scope's data version moves"""
+    version = check_versions()[scope]
+    entry = _cache.get((scope, key))
+    if entry is not None and entry[0] == version:
+        record_cache(scope, hit=True)
+        return entry[1]
+    value = loader()
+    _cache[(scope, key)] = (version, value)
+    record_cache(scope, hit=False)
+    return value
+
+# Background Watcher
+_watcher = {'thread': None}
+_watcher_lock = threading.Lock()
+
+def _watch():
+    while True:
+        try:
+            check_versions()
+        except Exception as e:
+            logger.warning("Data version check failed: %s", e)
+        time.sleep(COHERENCE_CHECK_SECONDS)
+
+def start_coherence_watcher():
+    """Poll the data versions on a background thread (once per process)"""
+    with _watcher_lock:
+        if _watcher['thread'] is None:
+            check_versions(force=True)
+            _watcher['thread'] = threading.Thread(target=_watch, daemon=True)
+            _watcher['thread'].start()
+        return _watcher['thread']
@@ -5,20 +5,488 @@ Handles database connection, initialization, and schema management
 
 import sqlite3
 import os
+import re
+import glob
+import threading
+import time
+from datetime import datetime
+from modules.metrics import count_query, record_cache
 
 # Database Setup
-DB_FILE = 'blister.db'
+DB_FILE = os.environ.get('BLISTER_DB_FILE', 'blister.db')
+
+# Read-only snapshot used by reports and dashboards
+SNAPSHOT_FILE = os.environ.get('BLISTER_SNAPSHOT_FILE', os.path.splitext(DB_FILE)[0] + '_snapshot.db')
+SNAPSHOT_MAX_AGE_SECONDS = 60      # refresh when the snapshot is older than this
+SNAPSHOT_MAX_WRITES = 50           # ...or when this many writes hit the live database
+SNAPSHOT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Online backups
+BACKUP_DIR = 'backups'
+BACKUP_RETENTION = 7               # number of backup files kept
+BACKUP_PAGES_PER_STEP = 64         # pages copied per step while holding the read lock
+BACKUP_STEP_SLEEP_SECONDS = 0.05   # pause between steps so writers can get in
+BACKUP_MAX_RESTARTS = 3            # restarts caused by other writers before copying in one step
+
+# Chunked rewrite of old-format cycle history into the compact table
+HISTORY_MIGRATION_CHUNK = 5000            # rows copied per (short) write transaction
+HISTORY_MIGRATION_PAUSE_SECONDS = 0.05    # pause between chunks so other writers can get in
+
+# Change counters bumped by triggers, so every replica can tell when cached reads went stale
+DATA_VERSION_SCOPES = {
+    'patients': ('patients', 'recurrence_rules'),
+    'access': ('users', 'apps', 'user_apps'),
+    'calendar': ('locations', 'holidays', 'location_closures'),
+}
+
+_snapshot_lock = threading.Lock()
+_snapshot_state = {'refreshed_at': None, 'writes': 0, 'refreshing': False}
+_history_migration_lock = threading.Lock()
+_history_migration = {'running': False, 'copied': 0, 'error': None}
 
 def get_connection():
     """Get a database connection"""
     conn = sqlite3.connect(DB_FILE)
+    conn.set_trace_callback(count_query)
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+# Read Snapshot
+def record_write(count=1):
+    """Note writes to the live database so the snapshot knows it is falling behind"""
+    with _snapshot_lock:
+        _snapshot_state['writes'] += count
+
+def refresh_snapshot():
+    """
+    Copy the live database into the snapshot file with the sqlite3 backup API
+    The live database is in WAL mode, so the copy reads one consistent version while
+    writers carry on; the snapshot itself is switched back to a plain rollback journal.
+    """
+    tmp_file = f"{SNAPSHOT_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with _snapshot_lock:
+        writes_before = _snapshot_state['writes']
+    try:
+        source = get_connection()
+        target = sqlite3.connect(tmp_file)
+        try:
+            source.backup(target)
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        # Atomic swap: connections already open keep reading the previous copy
+        os.replace(tmp_file, SNAPSHOT_FILE)
+        with _snapshot_lock:
+            _snapshot_state['refreshed_at'] = time.time()
+            _snapshot_state['writes'] -= writes_before
+    finally:
+        with _snapshot_lock:
+            _snapshot_state['refreshing'] = False
+
+def _refresh_snapshot_in_background():
+    """Start a refresh unless one is already running"""
+    with _snapshot_lock:
+        if _snapshot_state['refreshing']:
+            return
+        _snapshot_state['refreshing'] = True
+    threading.Thread(target=refresh_snapshot, daemon=True).start()
+
+def snapshot_age():
+    """Seconds since the snapshot was last refreshed, or None if there is none yet"""
+    refreshed_at = _snapshot_state['refreshed_at']
+    return None if refreshed_at is None else time.time() - refreshed_at
+
+def snapshot_is_stale():
+    """True when the snapshot is past its age or write-count bound"""
+    age = snapshot_age()
+    return age is None or age > SNAPSHOT_MAX_AGE_SECONDS or _snapshot_state['writes'] >= SNAPSHOT_MAX_WRITES
+
+def get_snapshot_connection():
+    """
+    Get a read-only, memory-mapped connection to the report snapshot
+    A stale snapshot is refreshed in the background while the current copy is served;
+    callers can show snapshot_age() as the staleness of what they read.
+    """
+    if _snapshot_state['refreshed_at'] is None or not os.path.exists(SNAPSHOT_FILE):
+        record_cache('snapshot', hit=False)
+        refresh_snapshot()
+    elif snapshot_is_stale():
+        record_cache('snapshot', hit=False)
+        _refresh_snapshot_in_background()
+    else:
+        record_cache('snapshot', hit=True)
+    conn = sqlite3.connect(f'file:{SNAPSHOT_FILE}?mode=ro', uri=True)
+    conn.set_trace_callback(count_query)
+    conn.execute(f'PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}')
+    conn.execute('PRAGMA query_only = ON')
     return conn
 
+def get_read_connection(use_snapshot=False):
+    """Get a connection for reads: the live database, or the report snapshot"""
+    return get_snapshot_connection() if use_snapshot else get_connection()
+
+# Online Backup
+class _BackupRestarted(Exception):
+    """Raised from the progress callback to give up on a stepped backup that keeps restarting"""
+
+class BackupJob:
+    """
+    A throttled online backup of the live database running on a background thread
+    SQLite starts a stepped backup over whenever another connection writes between steps.
+    After max_restarts of those the job copies the rest in a single step, which in WAL mode
+    reads one consistent version without holding up writers.
+    """
+
+    def __init__(self, path, pages_per_step=BACKUP_PAGES_PER_STEP, sleep_seconds=BACKUP_STEP_SLEEP_SECONDS,
+                 max_restarts=BACKUP_MAX_RESTARTS):
+        self.path = path
+        self.pages_per_step = pages_per_step
+        self.sleep_seconds = sleep_seconds
+        self.max_restarts = max_restarts
+        self.status = 'pending'
+        self.error = None
+        self.verified = None
+        self.pages_total = 0
+        self.pages_done = 0
+        self.restarts = 0
+        self.single_step = False
+        self.max_step_seconds = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._step_started_at = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def _progress(self, status, remaining, total):
+        # Called between steps, after each has released its read lock. The time spent
+        # copying a step is the longest a writer could have waited on the backup.
+        self.max_step_seconds = max(self.max_step_seconds, time.time() - self._step_started_at)
+        if total - remaining < self.pages_done:
+            # Another connection wrote since the last step, so the copy began again
+            self.restarts += 1
+            if self.restarts > self.max_restarts:
+                raise _BackupRestarted()
+        self.pages_total = total
+        self.pages_done = total - remaining
+        # Connection.backup only sleeps when a step is busy, so pause here between batches
+        if remaining:
+            time.sleep(self.sleep_seconds)
+        self._step_started_at = time.time()
+
+    def run(self):
+        self.status = 'running'
+        self.started_at = self._step_started_at = time.time()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            source = get_connection()
+            target = sqlite3.connect(tmp_path)
+            try:
+                try:
+                    source.backup(target, pages=self.pages_per_step, progress=self._progress)
+                except _BackupRestarted:
+                    self.single_step = True
+                    source.backup(target)
+                    self.pages_total = self.pages_done = target.execute('PRAGMA page_count').fetchone()[0]
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+                source.close()
+            os.replace(tmp_path, self.path)
+            self.verified = verify_backup(self.path)
+            self.status = 'done' if self.verified else 'failed'
+            if not self.verified:
+                self.error = 'Integrity check failed'
+            _rotate_backups()
+        except Exception as e:
+            self.status = 'failed'
+            self.error = str(e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.finished_at = time.time()
+
+    def stats(self):
+        """Duration, throughput and worst stall of the backup"""
+        end = self.finished_at or time.time()
+        duration = end - self.started_at if self.started_at else 0.0
+        return {
+            'status': self.status,
+            'path': self.path,
+            'pages': self.pages_done,
+            'pages_total': self.pages_total,
+            'duration_seconds': round(duration, 3),
+            'pages_per_second': round(self.pages_done / duration, 1) if duration else 0.0,
+            'max_stall_seconds': round(self.max_step_seconds, 4),
+            'restarts': self.restarts,
+            'single_step': self.single_step,
+            'verified': self.verified,
+            'error': self.error,
+        }
+
+_backup_jobs = []
+
+def start_backup(pages_per_step=BACKUP_PAGES_PER_STEP, sleep_seconds=BACKUP_STEP_SLEEP_SECONDS):
+    """Start an online backup in the background and return its BackupJob"""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    path = os.path.join(BACKUP_DIR, f"blister-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.db")
+    job = BackupJob(path, pages_per_step, sleep_seconds)
+    _backup_jobs.append(job)
+    del _backup_jobs[:-BACKUP_RETENTION]
+    job.thread.start()
+    return job
+
+def get_backup_jobs():
+    """Backup jobs started by this process, newest first"""
+    return list(reversed(_backup_jobs))
+
+def list_backups():
+    """Backup files on disk, newest first"""
+    return sorted(glob.glob(os.path.join(BACKUP_DIR, 'blister-*.db')), reverse=True)
+
+def _rotate_backups():
+    """Delete backups beyond the retention count"""
+    for path in list_backups()[BACKUP_RETENTION:]:
+        os.remove(path)
+
+def verify_backup(path):
+    """Run an integrity check on a backup file"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()
+    finally:
+        conn.close()
+    return result is not None and result[0] == 'ok'
+
+def restore_backup(path):
+    """
+    Restore the live database from a verified backup file
+    Returns True on success, False if the backup fails verification
+    """
+    if not verify_backup(path):
+        return False
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    target = get_connection()
+    pre_restore = dict(target.execute('SELECT scope, version FROM data_versions').fetchall())
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    
+    # A backup from an older release may predate newer tables and triggers
+    init_db()
+    # The backup's data versions are older; move every scope past its pre-restore value so
+    # each replica sees a change, and never a version it has already cached data under
+    conn = get_connection()
+    conn.executemany('UPDATE data_versions SET version = MAX(version, ?) + 1 WHERE scope = ?',
+                     [(version, scope) for scope, version in pre_restore.items()])
+    conn.commit()
+    conn.close()
+    record_write()
+    return True
+
+# History Migration
+def _table_exists(c, name):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return c.fetchone() is not None
+
+def _create_history_view(c):
+    """
+    (Re)create the schedule_history view, which resolves patient and user names and ISO
+    dates at read time. While old-format rows are still being migrated it also serves
+    the rows not copied yet, so readers always see the full history.
+    """
+    include_legacy = _table_exists(c, 'schedule_records_legacy')
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'schedule_history'")
+    row = c.fetchone()
+    if row is not None and ('schedule_records_legacy' in row[0]) == include_legacy:
+        return
+    
+    c.execute('DROP VIEW IF EXISTS schedule_history')
+    view_sql = '''
+        CREATE VIEW schedule_history AS
+        SELECT h.id, h.patient_id, p.name AS patient_name,
+               date(h.previous_billing_day * 86400, 'unixepoch') AS previous_billing_date,
+               date(h.new_billing_day * 86400, 'unixepoch') AS new_billing_date,
+               date(h.new_next_schedule_day * 86400, 'unixepoch') AS new_next_schedule_date,
+               h.previous_billing_day, h.new_billing_day, h.new_next_schedule_day,
+               datetime(h.cycled_at, 'unixepoch') AS cycled_at,
+               h.cycled_by, u.full_name AS cycled_by_name
+        FROM schedule_records h
+        LEFT JOIN patients p ON p.id = h.patient_id
+        LEFT JOIN users u ON u.id = h.cycled_by
+    '''
+    if include_legacy:
+        view_sql += f'''
+        UNION ALL
+        SELECT l.id, l.patient_id, p.name,
+               l.previous_billing_date, l.new_billing_date, l.new_next_schedule_date,
+               {_day_number_sql('l.previous_billing_date')}, {_day_number_sql('l.new_billing_date')},
+               {_day_number_sql('l.new_next_schedule_date')},
+               l.cycled_at, NULL, NULL
+        FROM schedule_records_legacy l
+        JOIN patients p ON p.id = l.patient_id
+        WHERE NOT EXISTS (SELECT 1 FROM schedule_records h WHERE h.id = l.id)
+        '''
+    c.execute(view_sql)
+
+def _retire_legacy_history(c):
+    """
+    Move an old-format schedule_records table (patient_name and ISO date text on every
+    row) out of the way so the compact table can take its name. Renaming is a quick
+    schema change; the rows are copied later by migrate_legacy_history.
+    """
+    c.execute('PRAGMA table_info(schedule_records)')
+    if 'patient_name' not in [row[1] for row in c.fetchall()]:
+        return False
+    c.execute('ALTER TABLE schedule_records RENAME TO schedule_records_legacy')
+    # The old indexes keep their names after the rename; free them for the new table
+    c.execute('DROP INDEX IF EXISTS idx_schedule_records_patient')
+    c.execute('DROP INDEX IF EXISTS idx_schedule_records_new_billing_day')
+    _drop_foreign_keys(c, 'schedule_records_legacy')
+    return True
+
+def _drop_foreign_keys(c, table):
+    """
+    Remove a table's foreign key clauses without copying it, by editing its stored schema
+    (the procedure SQLite documents for constraint-only changes, which leave rows untouched)
+    The old-format history has a non-cascading key to patients, which would otherwise
+    block deleting patients until it is migrated; rows of deleted patients are skipped then.
+    """
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    table_sql = c.fetchone()[0]
+    new_sql = re.sub(r',\s*FOREIGN KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\)[^,)]*', '', table_sql)
+    if new_sql == table_sql:
+        return
+    c.connection.commit()
+    c.execute('BEGIN')
+    c.execute('PRAGMA schema_version')
+    schema_version = c.fetchone()[0]
+    c.execute('PRAGMA writable_schema = ON')
+    c.execute("UPDATE sqlite_master SET sql = ? WHERE type = 'table' AND name = ?", (new_sql, table))
+    c.execute(f'PRAGMA schema_version = {schema_version + 1}')
+    c.execute('PRAGMA writable_schema = OFF')
+    c.connection.commit()
+
+def migrate_legacy_history(chunk_size=HISTORY_MIGRATION_CHUNK, pause_seconds=HISTORY_MIGRATION_PAUSE_SECONDS):
+    """
+    Copy old-format history into the compact schedule_records table in id-range chunks,
+    committing after each chunk so no writer waits long, then drop the old table
+    Resumable: ids are preserved and already-copied rows are skipped.
+    Rows whose patient no longer exists are not carried over.
+    Returns the number of rows copied.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    if not _table_exists(c, 'schedule_records_legacy'):
+        conn.close()
+        return 0
+    
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM schedule_records_legacy')
+    legacy_max = c.fetchone()[0]
+    c.execute('SELECT COALESCE(MAX(id), 0) FROM schedule_records WHERE id <= ?', (legacy_max,))
+    last_id = c.fetchone()[0]
+    copied = 0
+    while last_id < legacy_max:
+        c.execute(f'''
+            INSERT OR IGNORE INTO schedule_records
+                (id, patient_id, previous_billing_day, new_billing_day, new_next_schedule_day, cycled_at)
+            SELECT l.id, l.patient_id, {_day_number_sql('l.previous_billing_date')},
+                   {_day_number_sql('l.new_billing_date')}, {_day_number_sql('l.new_next_schedule_date')},
+                   CAST(strftime('%s', l.cycled_at) AS INTEGER)
+            FROM schedule_records_legacy l
+            JOIN patients p ON p.id = l.patient_id
+            WHERE l.id > ? AND l.id <= ?
+        ''', (last_id, last_id + chunk_size))
+        copied += c.rowcount
+        conn.commit()
+        last_id += chunk_size
+        with _history_migration_lock:
+            _history_migration['copied'] += c.rowcount
+        time.sleep(pause_seconds)
+    
+    c.execute('DROP TABLE schedule_records_legacy')
+    _create_history_view(c)
+    conn.commit()
+    conn.close()
+    record_write(copied)
+    return copied
+
+def _migrate_history_in_background():
+    try:
+        migrate_legacy_history()
+    except Exception as e:
+        with _history_migration_lock:
+            _history_migration['error'] = str(e)
+    finally:
+        with _history_migration_lock:
+            _history_migration['running'] = False
+
+def start_history_migration():
+    """Start migrating old-format history on a background thread if there is any; False otherwise"""
+    conn = get_connection()
+    pending = _table_exists(conn.cursor(), 'schedule_records_legacy')
+    conn.close()
+    with _history_migration_lock:
+        if not pending or _history_migration['running']:
+            return False
+        _history_migration['running'] = True
+    threading.Thread(target=_migrate_history_in_background, daemon=True).start()
+    return True
+
+def get_history_migration():
+    """Progress of the background history migration"""
+    with _history_migration_lock:
+        return dict(_history_migration)
+
+def _day_number_sql(column):
+    """SQL expression turning an ISO date column into days since 1970-01-01"""
+    return f"CAST(julianday({column}) - julianday('1970-01-01') AS INTEGER)"
+
+def _add_column_if_missing(c, table, column, definition):
+    """Add a column to an existing table (used for in-place schema upgrades)"""
+    c.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def _rebuild_with_cascade(conn, table):
+    """
+    Rebuild a table so its foreign keys use ON DELETE CASCADE
+    SQLite cannot alter a foreign key in place, so the table is copied into a new one
+    (the documented create/copy/drop/rename procedure) with foreign keys switched off.
+    """
+    c = conn.cursor()
+    c.execute(f'PRAGMA foreign_key_list({table})')
+    if all(row[6] != 'NO ACTION' for row in c.fetchall()):
+        return
+    
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    table_sql = c.fetchone()[0]
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,))
+    index_sqls = [row[0] for row in c.fetchall()]
+    
+    new_sql = re.sub(r'(REFERENCES\s+\w+\s*\(\w+\))(?!\s*ON DELETE)', r'\1 ON DELETE CASCADE', table_sql)
+    new_sql = new_sql.replace(f'CREATE TABLE {table}', f'CREATE TABLE {table}__rebuild', 1)
+    
+    conn.commit()
+    c.execute('PRAGMA foreign_keys = OFF')
+    c.execute('BEGIN')
+    c.execute(new_sql)
+    c.execute(f'INSERT INTO {table}__rebuild SELECT * FROM {table}')
+    c.execute(f'DROP TABLE {table}')
+    c.execute(f'ALTER TABLE {table}__rebuild RENAME TO {table}')
+    for index_sql in index_sqls:
+        c.execute(index_sql)
+    conn.commit()
+    c.execute('PRAGMA foreign_keys = ON')
+
 def init_db():
     """Initialize database tables"""
     conn = get_connection()
     c = conn.cursor()
     
+    # Write-ahead log: readers (snapshot refreshes, backups, reports) never block writers
+    c.execute('PRAGMA journal_mode = WAL')
+    
     # Patients table
     c.execute('''
         CREATE TABLE IF NOT EXISTS patients (
@@ -30,21 +498,95 @@ def init_db():
             blister_schedule TEXT,
             billing_date TEXT NOT NULL,
             next_schedule_date TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 1,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
-    # Schedule records table
+    # Row version for optimistic concurrency (compare-and-swap updates)
+    _add_column_if_missing(c, 'patients', 'version', 'INTEGER NOT NULL DEFAULT 1')
+    
+    # Soft delete: discharged patients keep their history but leave the due lists
+    _add_column_if_missing(c, 'patients', 'discharged_at', 'DATETIME')
+    
+    # Contact address for due-pack reminders
+    _add_column_if_missing(c, 'patients', 'email', 'TEXT')
+    
+    # Integer day numbers (days since 1970-01-01) mirroring the ISO date columns;
+    # range and due queries filter on these, the text stays for display
+    _add_column_if_missing(c, 'patients', 'billing_day', 'INTEGER')
+    _add_column_if_missing(c, 'patients', 'next_schedule_day', 'INTEGER')
+    # Only rows still missing a day number whose date parses: dates julianday() cannot read
+    # would match again on every start (bumping the patients version each time), and are
+    # reported by the integrity scan as date_format issues instead. The small partial index
+    # holds just the rows missing a day number, so this check is cheap on every start.
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_patients_missing_day
+                 ON patients(id) WHERE billing_day IS NULL OR next_schedule_day IS NULL''')
+    c.execute(f'''UPDATE patients SET billing_day = COALESCE(billing_day, {_day_number_sql('billing_date')}),
+                                      next_schedule_day = COALESCE(next_schedule_day,
+                                                                   {_day_number_sql('next_schedule_date')})
+                  WHERE (billing_day IS NULL OR next_schedule_day IS NULL)
+                    AND ((billing_day IS NULL AND julianday(billing_date) IS NOT NULL)
+                         OR (next_schedule_day IS NULL AND julianday(next_schedule_date) IS NOT NULL))''')
+    # Due and range queries only read active patients, so these indexes leave discharged
+    # patients out (they replace earlier full indexes on the same columns)
+    c.execute('DROP INDEX IF EXISTS idx_patients_billing_day')
+    c.execute('DROP INDEX IF EXISTS idx_patients_next_schedule_day')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_patients_active_billing_day
+                 ON patients(billing_day) WHERE discharged_at IS NULL''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_patients_active_next_schedule_day
+                 ON patients(next_schedule_day) WHERE discharged_at IS NULL''')
+    
+    # Case-insensitive name index for the patient typeahead prefix search
+    c.execute('CREATE INDEX IF NOT EXISTS idx_patients_name_nocase ON patients(name COLLATE NOCASE)')
+    
+    # Recurrence rules table (custom schedules, one rule per patient)
     c.execute('''
-        CREATE TABLE IF NOT EXISTS schedule_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE IF NOT EXISTS recurrence_rules (
+            patient_id INTEGER PRIMARY KEY,
+            rule TEXT NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Monthly analytics rollups, maintained incrementally as cycles are recorded
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_rollups (
+            month TEXT NOT NULL,
+            insurer TEXT NOT NULL,
+            delivery TEXT NOT NULL,
+            schedule_type TEXT NOT NULL,
+            cycles INTEGER NOT NULL DEFAULT 0,
+            total_cost REAL NOT NULL DEFAULT 0,
+            patient_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (month, insurer, delivery, schedule_type)
+        )
+    ''')
+    
+    # Patients already counted in a rollup group (keeps patient_count distinct)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rollup_patients (
+            month TEXT NOT NULL,
+            insurer TEXT NOT NULL,
+            delivery TEXT NOT NULL,
+            schedule_type TEXT NOT NULL,
             patient_id INTEGER NOT NULL,
-            patient_name TEXT NOT NULL,
-            previous_billing_date TEXT NOT NULL,
-            new_billing_date TEXT NOT NULL,
-            new_next_schedule_date TEXT NOT NULL,
-            cycled_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients(id)
+            PRIMARY KEY (month, insurer, delivery, schedule_type, patient_id)
+        ) WITHOUT ROWID
+    ''')
+    
+    # Reminder dispatch log; each reminder's idempotency key is claimed here before it is
+    # sent, so it cannot be sent twice
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS notification_log (
+            idempotency_key TEXT PRIMARY KEY,
+            patient_id INTEGER,
+            recipient TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
@@ -79,12 +621,97 @@ def init_db():
             user_id INTEGER NOT NULL,
             app_id INTEGER NOT NULL,
             assigned_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(id),
-            FOREIGN KEY (app_id) REFERENCES apps(id),
+            FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY (app_id) REFERENCES apps(id) ON DELETE CASCADE,
             UNIQUE(user_id, app_id)
         )
     ''')
     
+    # Old-format history is renamed aside first, so the cascade upgrade below never copies it
+    legacy_history = _retire_legacy_history(c)
+    
+    # Upgrade tables created before foreign keys cascaded
+    for table in ('schedule_records', 'recurrence_rules', 'user_apps'):
+        _rebuild_with_cascade(conn, table)
+    
+    # Cycle history: compact integer rows; names and ISO dates come from the schedule_history view
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schedule_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER NOT NULL,
+            previous_billing_day INTEGER,
+            new_billing_day INTEGER,
+            new_next_schedule_day INTEGER,
+            cycled_at INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+            cycled_by INTEGER,
+            FOREIGN KEY (patient_id) REFERENCES patients(id) ON DELETE CASCADE,
+            FOREIGN KEY (cycled_by) REFERENCES users(id) ON DELETE SET NULL
+        )
+    ''')
+    if legacy_history:
+        # New cycles get ids above the old ones so migrated rows keep theirs
+        c.execute('''INSERT INTO sqlite_sequence (name, seq)
+                     SELECT 'schedule_records', COALESCE(MAX(id), 0) FROM schedule_records_legacy
+                     WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'schedule_records')''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedule_records_patient ON schedule_records(patient_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_schedule_records_new_billing_day ON schedule_records(new_billing_day)')
+    _create_history_view(c)
+    
+    # Business calendar: open weekdays and closures per location, holidays for every location
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS locations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            weekmask TEXT NOT NULL DEFAULT '1111110',
+            roll TEXT NOT NULL DEFAULT 'preceding',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS holidays (
+            day INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS location_closures (
+            location_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            reason TEXT,
+            PRIMARY KEY (location_id, day),
+            FOREIGN KEY (location_id) REFERENCES locations(id) ON DELETE CASCADE
+        )
+    ''')
+    _add_column_if_missing(c, 'patients', 'location_id', 'INTEGER REFERENCES locations(id) ON DELETE SET NULL')
+    
+    # Data versions: one counter per scope, bumped on every row change by any process
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            scope TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for scope, tables in DATA_VERSION_SCOPES.items():
+        c.execute('INSERT OR IGNORE INTO data_versions (scope) VALUES (?)', (scope,))
+        for table in tables:
+            for event in ('INSERT', 'UPDATE', 'DELETE'):
+                c.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE data_versions SET version = version + 1 WHERE scope = '{scope}';
+                    END
+                ''')
+    
+    # History rows only move between patients when duplicates are merged; copies of the
+    # history (the analytics engine) reload when this counter moves
+    c.execute("INSERT OR IGNORE INTO data_versions (scope) VALUES ('history')")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS schedule_records_repoint_version AFTER UPDATE OF patient_id ON schedule_records
+        BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE scope = 'history';
+        END
+    ''')
+    
     conn.commit()
     conn.close()
 
@@ -113,5 +740,10 @@ def init_default_data():
             VALUES (?, ?, ?)
         ''', ('Blister Pack Scheduler', 'blister_scheduler', 'Manage patient medication cycles'))
     
+    # Create default location if no locations exist (open Monday to Saturday)
+    c.execute('SELECT COUNT(*) FROM locations')
+    if c.fetchone()[0] == 0:
+        c.execute('INSERT INTO locations (name) VALUES (?)', ('Main Pharmacy',))
+    
     conn.commit()
     conn.close()
@@ -0,0 +1,171 @@
+"""
+Dedupe module for Blister Pack Scheduler
+Finds patients entered more than once, by name (normalized and phonetic), insurance,
+email and billing date
+
+Patients are only compared within blocks that share a phonetic name key, so the work
+grows with the number of patients rather than the number of pairs. Blocks too large to
+compare in full (very common names) are sorted by billing date and each patient is
+compared with its nearest neighbours only. Merging a pair is merge_patients in
+patient_management.
+"""
+
+import re
+import unicodedata
+from difflib import SequenceMatcher
+from functools import lru_cache
+import pandas as pd
+from modules.database import get_read_connection
+
+DEFAULT_THRESHOLD = 0.8       # minimum score (0-1) for a pair to be reported
+FULL_BLOCK_LIMIT = 50         # blocks up to this size compare every pair
+NEIGHBOUR_WINDOW = 10         # larger blocks compare each patient with this many billing-date neighbours
+BILLING_WINDOW_DAYS = 14      # billing dates further apart than this add nothing to the score
+
+# Score weights; a detail missing on either side counts half
+NAME_WEIGHT = 0.6
+INSURANCE_WEIGHT = 0.15
+BILLING_WEIGHT = 0.15
+EMAIL_WEIGHT = 0.1
+
+TITLES = {'mr', 'mrs', 'ms', 'miss', 'dr', 'jr', 'sr'}
+SOUNDEX_CODES = {letter: digit for digit, letters in
+                 {'1': 'bfpv', '2': 'cgjkqsxz', '3': 'dt', '4': 'l', '5': 'mn', '6': 'r'}.items()
+                 for letter in letters}
+
+# Name Keys
+def name_tokens(name):
+    """Lower-case, accent-free name words without punctuation or titles, in written order"""
+    text = name or ''
+    if not text.isascii():
+        text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    text = text.lower()
+    return [token for token in re.split(r'[^a-z0-9]+', text) if token and token not in TITLES]
+
+def normalize_name(name):
+    """Name words in sorted order, so 'Doe, John' and 'john doe' match"""
+    return ' '.join(sorted(name_tokens(name)))
+
+@lru_cache(maxsize=65536)
+def soundex(token):
+    """American Soundex code of a word ('robert' -> 'R163')"""
+    if not token:
+        return ''
+    code, last = token[0].upper(), SOUNDEX_CODES.get(token[0])
+    for letter in token[1:]:
+        digit = SOUNDEX_CODES.get(letter)
+        if digit and digit != last:
+            code += digit
+        if letter not in 'hw':
+            last = digit
+    return (code + '000')[:4]
+
+def blocking_keys(tokens):
+    """
+    Keys a patient is filed under: the phonetic code of the whole name, and of its first
+    and last words only (so a middle name or initial on one record does not hide a match),
+    plus the first letters of those words (so does a typo that changes the phonetic code)
+    """
+    codes = [soundex(token) for token in tokens]
+    if not codes:
+        return set()
+    return {'name:' + ' '.join(sorted(codes)),
+            'ends:' + ' '.join(sorted((codes[0], codes[-1]))),
+            'prefix:' + ' '.join(sorted((tokens[0][:3], tokens[-1][:3])))}
+
+# Scoring
+def _score(a, b, threshold):
+    """
+    Score (0-1) and reasons for a candidate pair of patient records, or None below threshold
+    The other details are scored first; names are compared only when they could still
+    lift the pair over the threshold, with the cheap upper bounds tried before the ratio.
+    """
+    score = 0.0
+    reasons = []
+    for weight, field, label in ((INSURANCE_WEIGHT, 'insurance', 'insurance'), (EMAIL_WEIGHT, 'email', 'email')):
+        left, right = a[field], b[field]
+        if not left or not right:
+            score += weight / 2
+        elif left == right:
+            score += weight
+            reasons.append(f"same {label}")
+
+    if a['billing_day'] is None or b['billing_day'] is None:
+        score += BILLING_WEIGHT / 2
+    else:
+        apart = abs(a['billing_day'] - b['billing_day'])
+        if apart < BILLING_WINDOW_DAYS:
+            score += BILLING_WEIGHT * (1 - apart / BILLING_WINDOW_DAYS)
+            reasons.append(f"billing {apart} day(s) apart")
+
+    needed = (threshold - score) / NAME_WEIGHT
+    if needed > 1:
+        return None
+    matcher = SequenceMatcher(None, a['normalized'], b['normalized'])
+    if matcher.real_quick_ratio() < needed or matcher.quick_ratio() < needed:
+        return None
+    name_similarity = matcher.ratio()
+    if name_similarity < needed:
+        return None
+    return round(score + NAME_WEIGHT * name_similarity, 3), [f"names {name_similarity:.0%} alike"] + reasons
+
+def _candidate_pairs(block, records):
+    """Index pairs to compare within one block"""
+    if len(block) <= FULL_BLOCK_LIMIT:
+        return ((block[i], block[j]) for i in range(len(block)) for j in range(i + 1, len(block)))
+    ordered = sorted(block, key=lambda i: (records[i]['billing_day'] is None, records[i]['billing_day'] or 0))
+    return ((ordered[i], ordered[j]) for i in range(len(ordered))
+            for j in range(i + 1, min(i + 1 + NEIGHBOUR_WINDOW, len(ordered))))
+
+def _clean(value):
+    return value.strip().lower() or None if value else None
+
+# Detection
+def find_duplicates(threshold=DEFAULT_THRESHOLD, include_discharged=False, use_snapshot=False):
+    """
+    Likely duplicate patients, best matches first
+    The older record (lower id) is suggested as the one to keep.
+    Returns DataFrame: keep_id, keep_name, keep_billing_date, duplicate_id, duplicate_name,
+    duplicate_billing_date, score, reasons
+    """
+    conn = get_read_connection(use_snapshot)
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT id, name, insurance, email, billing_date, billing_day
+        FROM patients
+        {'' if include_discharged else 'WHERE discharged_at IS NULL'}
+        ORDER BY id
+    ''')
+    patients = c.fetchall()
+    conn.close()
+
+    records = []
+    blocks = {}
+    for patient_id, name, insurance, email, billing_date, billing_day in patients:
+        tokens = name_tokens(name)
+        records.append({
+            'id': patient_id, 'name': name, 'billing_date': billing_date, 'billing_day': billing_day,
+            'normalized': ' '.join(sorted(tokens)), 'insurance': _clean(insurance), 'email': _clean(email),
+        })
+        for key in blocking_keys(tokens):
+            blocks.setdefault(key, []).append(len(records) - 1)
+
+    matches = {}
+    for block in blocks.values():
+        for pair in _candidate_pairs(block, records):
+            pair = tuple(sorted(pair))   # records are in id order, so the older one comes first
+            if pair in matches:
+                continue
+            matches[pair] = _score(records[pair[0]], records[pair[1]], threshold)
+
+    rows = []
+    for (i, j), match in matches.items():
+        if match is None:
+            continue
+        score, reasons = match
+        keep, duplicate = records[i], records[j]
+        rows.append((keep['id'], keep['name'], keep['billing_date'], duplicate['id'], duplicate['name'],
+                     duplicate['billing_date'], score, ', '.join(reasons)))
+    result = pd.DataFrame(rows, columns=['keep_id', 'keep_name', 'keep_billing_date', 'duplicate_id',
+                                         'duplicate_name', 'duplicate_billing_date', 'score', 'reasons'])
+    return result.sort_values(['score', 'keep_id'], ascending=[False, True], ignore_index=True)
@@ -0,0 +1,141 @@
+"""
+Due index module for Blister Pack Scheduler
+A process-wide min-heap of active patients ordered by billing day, so due lists and
+counts come from the k entries that are due instead of a scan over every patient
+
+The index is built from the database on first use and kept current by the patient
+write hook, which re-reads just the patients a write touched. A write by another
+replica (seen as a data version this process did not make) triggers a rebuild.
+"""
+
+import heapq
+import threading
+from modules.database import get_connection
+from modules.coherence import check_versions
+
+class DueIndex:
+    """
+    Min-heap of (billing_day, name, patient_id) with lazy deletion
+    Replaced and removed entries stay in the heap until popped past or compacted;
+    an entry is live while _entries maps its patient to that exact tuple.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.version = None
+
+    def rebuild(self, rows, version):
+        """Replace the contents with (patient_id, name, billing_day) rows"""
+        with self._lock:
+            self._entries = {patient_id: (billing_day, name, patient_id) for patient_id, name, billing_day in rows}
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+            self.version = version
+
+    def upsert(self, patient_id, name, billing_day):
+        with self._lock:
+            entry = (billing_day, name, patient_id)
+            self._entries[patient_id] = entry
+            heapq.heappush(self._heap, entry)
+            self._compact()
+
+    def remove(self, patient_id):
+        with self._lock:
+            self._entries.pop(patient_id, None)
+            self._compact()
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def _walk(self):
+        """Live entries in order without popping: best-first over the heap array, O(log k) each"""
+        heap = self._heap
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            entry, i = heapq.heappop(frontier)
+            if self._entries.get(entry[2]) is entry:
+                yield entry
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def due_by(self, day):
+        """Patient ids with billing day on or before day, by billing day then name"""
+        with self._lock:
+            due = []
+            for billing_day, _, patient_id in self._walk():
+                if billing_day > day:
+                    break
+                due.append(patient_id)
+            return due
+
+    def next_due(self, k):
+        """The k patients due soonest as (patient_id, billing_day)"""
+        with self._lock:
+            result = []
+            for billing_day, _, patient_id in self._walk():
+                if len(result) == k:
+                    break
+                result.append((patient_id, billing_day))
+            return result
+
+    def count_due(self, day):
+        return len(self.due_by(day))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+DUE_INDEX = DueIndex()
+_build_lock = threading.Lock()
+
+def _active_rows(conn, patient_ids=None):
+    query = '''SELECT id, name, billing_day FROM patients
+               WHERE discharged_at IS NULL AND billing_day IS NOT NULL'''
+    c = conn.cursor()
+    if patient_ids is None:
+        c.execute(query)
+    else:
+        c.execute(query + f" AND id IN ({','.join('?' * len(patient_ids))})", patient_ids)
+    return c.fetchall()
+
+def get_due_index():
+    """The index, rebuilt first if it was never built or another replica changed patients"""
+    version = check_versions()['patients']
+    if DUE_INDEX.version != version:
+        with _build_lock:
+            if DUE_INDEX.version != version:
+                conn = get_connection()
+                DUE_INDEX.rebuild(_active_rows(conn), version)
+                conn.close()
+    return DUE_INDEX
+
+def refresh_patients(patient_ids, versions=None):
+    """
+    Re-index patients after this process committed a write to them
+    versions is (version the write transaction started from, version it committed), both
+    read inside the transaction while it held the write lock. An index current at the
+    first is current at the second once these patients are re-read; otherwise another
+    replica's write lies in between, and the index is left to rebuild on next use.
+    """
+    if DUE_INDEX.version is None:
+        return
+    patient_ids = [int(pid) for pid in patient_ids]
+    conn = get_connection()
+    rows = [row for start in range(0, len(patient_ids), 500)
+            for row in _active_rows(conn, patient_ids[start:start + 500])]
+    conn.close()
+    with _build_lock:
+        active = set()
+        for patient_id, name, billing_day in rows:
+            DUE_INDEX.upsert(patient_id, name, billing_day)
+            active.add(patient_id)
+        for patient_id in patient_ids:
+            if patient_id not in active:
+                DUE_INDEX.remove(patient_id)
+        if versions is not None and DUE_INDEX.version == versions[0]:
+            DUE_INDEX.version = versions[1]
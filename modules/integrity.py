@@ -0,0 +1,197 @@
+"""
+Integrity module for Blister Pack Scheduler
+Scans patients, schedule_records and user_apps for broken invariants in id-range
+chunks across a process pool, producing a machine-readable report and optional
+repair statements
+
+Usage:
+    python -m modules.integrity --workers 4 --report integrity.json --repair-sql repair.sql
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from modules import database
+
+CHUNK_SIZE = 5000
+
+def _sql_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _valid_date(value):
+    """True for a real calendar date written exactly as YYYY-MM-DD"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') == value
+    except (TypeError, ValueError):
+        return False
+
+def _issue(table, row_id, check, detail, repair=None):
+    return {'table': table, 'id': row_id, 'check': check, 'detail': detail, 'repair': repair}
+
+# Chunk Checks (run in worker processes)
+def _check_patients(c, start, end):
+    from modules.patient_management import calculate_next_schedule, to_day_number
+    from modules.business_calendar import load_calendars
+
+    issues = []
+    calendars = load_calendars(c.connection)
+    c.execute('''
+        SELECT p.id, p.billing_date, p.next_schedule_date, p.blister_schedule, r.rule,
+               p.billing_day, p.next_schedule_day, p.location_id
+        FROM patients p
+        LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+        WHERE p.id >= ? AND p.id < ?
+    ''', (start, end))
+    for (patient_id, billing_date, next_schedule_date, schedule, rule, billing_day, next_day,
+         location_id) in c.fetchall():
+        bad = [name for name, value in (('billing_date', billing_date), ('next_schedule_date', next_schedule_date))
+               if not _valid_date(value)]
+        if bad:
+            issues.append(_issue('patients', patient_id, 'date_format',
+                                 f"{', '.join(bad)} not YYYY-MM-DD: {billing_date!r}, {next_schedule_date!r}"))
+            continue
+        if (billing_day, next_day) != (to_day_number(billing_date), to_day_number(next_schedule_date)):
+            issues.append(_issue(
+                'patients', patient_id, 'day_number_mismatch',
+                f"day numbers {billing_day}, {next_day} do not match {billing_date}, {next_schedule_date}",
+                f"UPDATE patients SET billing_day = {to_day_number(billing_date)}, "
+                f"next_schedule_day = {to_day_number(next_schedule_date)} WHERE id = {patient_id};"))
+        try:
+            expected = calculate_next_schedule(billing_date, schedule, rule, location_id, calendars)
+        except ValueError as e:
+            issues.append(_issue('patients', patient_id, 'invalid_rule', str(e)))
+            continue
+        if expected != next_schedule_date:
+            issues.append(_issue(
+                'patients', patient_id, 'next_schedule_mismatch',
+                f"next_schedule_date {next_schedule_date} but {schedule or 'default'} schedule from "
+                f"billing_date {billing_date} gives {expected}",
+                f"UPDATE patients SET next_schedule_date = {_sql_literal(expected)}, "
+                f"next_schedule_day = {to_day_number(expected)} WHERE id = {patient_id};"))
+    return issues
+
+def _check_schedule_records(c, start, end):
+    issues = []
+    c.execute('''
+        SELECT r.id, r.patient_id, p.id, r.previous_billing_day, r.new_billing_day, r.new_next_schedule_day
+        FROM schedule_records r
+        LEFT JOIN patients p ON p.id = r.patient_id
+        WHERE r.id >= ? AND r.id < ?
+    ''', (start, end))
+    for record_id, patient_id, found_id, *days in c.fetchall():
+        if found_id is None:
+            issues.append(_issue('schedule_records', record_id, 'orphaned_history',
+                                 f"patient {patient_id} does not exist",
+                                 f"DELETE FROM schedule_records WHERE id = {record_id};"))
+            continue
+        if None in days:
+            issues.append(_issue('schedule_records', record_id, 'missing_day_number',
+                                 f"day numbers {days} (source dates were not YYYY-MM-DD)"))
+        elif days[2] <= days[1]:
+            issues.append(_issue('schedule_records', record_id, 'history_dates_out_of_order',
+                                 f"next schedule day {days[2]} is not after billing day {days[1]}"))
+    return issues
+
+def _check_user_apps(c, start, end):
+    issues = []
+    c.execute('''
+        SELECT ua.id, ua.user_id, ua.app_id, u.id, a.id
+        FROM user_apps ua
+        LEFT JOIN users u ON u.id = ua.user_id
+        LEFT JOIN apps a ON a.id = ua.app_id
+        WHERE ua.id >= ? AND ua.id < ? AND (u.id IS NULL OR a.id IS NULL)
+    ''', (start, end))
+    for row_id, user_id, app_id, found_user, found_app in c.fetchall():
+        missing = [f"user {user_id}"] if found_user is None else []
+        missing += [f"app {app_id}"] if found_app is None else []
+        issues.append(_issue('user_apps', row_id, 'orphaned_assignment', f"{' and '.join(missing)} missing",
+                             f"DELETE FROM user_apps WHERE id = {row_id};"))
+    return issues
+
+CHECKS = {
+    'patients': _check_patients,
+    'schedule_records': _check_schedule_records,
+    'user_apps': _check_user_apps,
+}
+
+def scan_chunk(db_file, table, start, end):
+    """Run one table's checks over the id range [start, end)"""
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    try:
+        return CHECKS[table](conn.cursor(), start, end)
+    finally:
+        conn.close()
+
+# Scanning
+def _chunks(db_file, chunk_size):
+    conn = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    c = conn.cursor()
+    chunks = []
+    for table in CHECKS:
+        c.execute(f'SELECT MIN(id), MAX(id) FROM {table}')
+        low, high = c.fetchone()
+        if low is None:
+            continue
+        for start in range(low, high + 1, chunk_size):
+            chunks.append((table, start, start + chunk_size))
+    conn.close()
+    return chunks
+
+def scan(db_file=None, workers=None, chunk_size=CHUNK_SIZE):
+    """Scan the database in parallel and return the report dict"""
+    db_file = os.path.abspath(db_file or database.DB_FILE)
+    started = time.time()
+    chunks = _chunks(db_file, chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(scan_chunk, db_file, table, start, end) for table, start, end in chunks]
+        issues = [issue for future in futures for issue in future.result()]
+
+    counts = {}
+    for issue in issues:
+        counts[issue['check']] = counts.get(issue['check'], 0) + 1
+    return {
+        'database': db_file,
+        'generated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_seconds': round(time.time() - started, 2),
+        'chunks': len(chunks),
+        'issue_counts': counts,
+        'issues': issues,
+    }
+
+def repair_statements(report):
+    """SQL statements that fix the repairable issues in a report, as one transaction"""
+    statements = [issue['repair'] for issue in report['issues'] if issue['repair']]
+    return ['BEGIN;'] + statements + ['COMMIT;'] if statements else []
+
+def main():
+    parser = argparse.ArgumentParser(description='Check Blister Pack Scheduler data integrity')
+    parser.add_argument('--db', help='database file (defaults to the app database)')
+    parser.add_argument('--workers', type=int, help='worker processes (defaults to CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='rows per id-range chunk')
+    parser.add_argument('--report', help='write the JSON report here instead of stdout')
+    parser.add_argument('--repair-sql', help='write repair statements to this file')
+    args = parser.parse_args()
+
+    report = scan(args.db, args.workers, args.chunk_size)
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+        print(f"{sum(report['issue_counts'].values())} issue(s) in {report['duration_seconds']}s: "
+              f"{report['issue_counts']}")
+    else:
+        print(output)
+
+    if args.repair_sql:
+        with open(args.repair_sql, 'w') as f:
+            f.write('\n'.join(repair_statements(report)) + '\n')
+
+    sys.exit(1 if report['issues'] else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+Metrics module for Blister Pack Scheduler
+In-process counters and latency histograms, exposed in Prometheus text format
+on a local HTTP port that runs alongside Streamlit
+"""
+
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_HOST = os.environ.get('BLISTER_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('BLISTER_METRICS_PORT', '9464'))
+RERUN_P95_ALERT_SECONDS = float(os.environ.get('BLISTER_RERUN_P95_ALERT_SECONDS', '2.0'))
+RERUN_WINDOW = 500  # reruns kept for the rolling p95
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    """A value that can go up and down"""
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, optionally split by labels"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labels + ('le',), label_values + ('+Inf',))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                labels = _format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+# Registry
+PAGE_LATENCY = Histogram('blister_page_render_seconds', 'Render time of each page function', labels=('page',))
+RERUN_LATENCY = Histogram('blister_rerun_seconds', 'Wall time of a full app.py rerun')
+RERUN_P95 = Gauge('blister_rerun_p95_seconds', 'Rolling p95 of rerun time over the last reruns')
+RERUN_P95_ALERT = Gauge('blister_rerun_p95_alert', '1 while the rolling rerun p95 is above the alert threshold')
+CYCLES = Counter('blister_cycles_total', 'Patient cycles recorded')
+CYCLE_CONFLICTS = Counter('blister_cycle_conflicts_total', 'Cycles rejected because the patient changed first')
+LOGINS = Counter('blister_logins_total', 'Successful logins')
+FAILED_LOGINS = Counter('blister_failed_logins_total', 'Failed login attempts')
+DB_QUERIES = Counter('blister_db_queries_total', 'SQL statements executed')
+CACHE_REQUESTS = Counter('blister_cache_requests_total', 'Cache lookups', labels=('cache', 'result'))
+CACHE_HIT_RATIO = Gauge('blister_cache_hit_ratio', 'Cache hit ratio since start', labels=('cache',))
+
+METRICS = [PAGE_LATENCY, RERUN_LATENCY, RERUN_P95, RERUN_P95_ALERT, CYCLES, CYCLE_CONFLICTS,
+           LOGINS, FAILED_LOGINS, DB_QUERIES, CACHE_REQUESTS, CACHE_HIT_RATIO]
+
+# Caches that keep their own statistics (e.g. functools.lru_cache) report through these
+_cache_info_sources = {}
+
+_recent_reruns = deque(maxlen=RERUN_WINDOW)
+
+
+# Recording
+def count_query(statement):
+    """sqlite3 trace callback counting executed statements"""
+    DB_QUERIES.inc()
+
+
+def record_cache(cache, hit):
+    """Record a hit or miss for a named cache"""
+    CACHE_REQUESTS.inc(cache, 'hit' if hit else 'miss')
+
+
+def register_cache_info(cache, info_func):
+    """Report a cache exposing lru_cache-style cache_info() (hits, misses)"""
+    _cache_info_sources[cache] = info_func
+
+
+def _update_cache_ratios():
+    caches = {label_values[0] for label_values in list(CACHE_REQUESTS._values)}
+    for cache in caches:
+        hits, misses = CACHE_REQUESTS.value(cache, 'hit'), CACHE_REQUESTS.value(cache, 'miss')
+        if hits + misses:
+            CACHE_HIT_RATIO.set(hits / (hits + misses), cache)
+    for cache, info_func in _cache_info_sources.items():
+        info = info_func()
+        if info.hits + info.misses:
+            CACHE_HIT_RATIO.set(info.hits / (info.hits + info.misses), cache)
+
+
+def rerun_p95():
+    """Rolling p95 of recent rerun times in seconds, or None before any rerun"""
+    if not _recent_reruns:
+        return None
+    ordered = sorted(_recent_reruns)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def observe_rerun(seconds):
+    """Record a rerun and raise the alert gauge when p95 crosses the threshold"""
+    RERUN_LATENCY.observe(seconds)
+    _recent_reruns.append(seconds)
+    p95 = rerun_p95()
+    RERUN_P95.set(p95)
+    alerting = p95 > RERUN_P95_ALERT_SECONDS
+    if alerting and not RERUN_P95_ALERT.value():
+        logger.warning("Rerun p95 %.2fs is above the %.2fs threshold", p95, RERUN_P95_ALERT_SECONDS)
+    RERUN_P95_ALERT.set(1 if alerting else 0)
+
+
+@contextmanager
+def track_rerun():
+    """Time a full script rerun, including reruns cut short by st.rerun()"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_rerun(time.perf_counter() - started)
+
+
+def timed_page(func):
+    """Decorator recording the render latency of a page function"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            PAGE_LATENCY.observe(time.perf_counter() - started, func.__name__)
+    return wrapper
+
+
+# Exposition
+def render_metrics():
+    """All metrics in Prometheus text exposition format"""
+    _update_cache_ratios()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics on a background thread (once per process)"""
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server or None
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            # Another replica on this host already owns the port
+            logger.warning("Metrics server not started on %s:%s: %s", host, port, e)
+            _server = False
+            return None
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
@@ -0,0 +1,275 @@
+"""
+Notifications module for Blister Pack Scheduler
+Builds reminders for due and upcoming packs from the patients table and dispatches
+them asynchronously with bounded concurrency, retries and idempotency keys
+
+Each message's key is claimed in notification_log (unique per key) just before it is
+sent and its outcome is written as soon as it is known, so two runs at once (on one
+replica or several) never send the same reminder, and a run that dies part way only
+leaves the messages it had in flight unconfirmed. Those stay 'sending' and are not
+retried, since they may already have gone out; failed sends are retried by later runs.
+
+Transports are pluggable. Configure with environment variables:
+    BLISTER_NOTIFY_TRANSPORT   smtp | http (default smtp)
+    BLISTER_SMTP_HOST / BLISTER_SMTP_PORT / BLISTER_SMTP_SENDER
+    BLISTER_NOTIFY_URL         endpoint receiving one JSON POST per message
+    BLISTER_DRIVER_EMAIL       optional address receiving the home-delivery digest
+Both transports can be pointed at a local stand-in (a debugging SMTP server or a
+small HTTP listener) to test the pipeline end to end.
+"""
+
+import asyncio
+import json
+import os
+import smtplib
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from string import Template
+from modules.database import get_connection
+from modules.patient_management import to_day_number
+
+DISPATCH_CONCURRENCY = 20
+DISPATCH_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 1.0
+
+TEMPLATES = {
+    'patient_due': (
+        Template("Your blister pack is due on $billing_date"),
+        Template("Hello $name,\n\nYour medication blister pack is due on $billing_date "
+                 "($delivery).\n\nPharmalife Pharmacy"),
+    ),
+    'driver_digest': (
+        Template("Home deliveries due by $until ($count)"),
+        Template("Blister packs for home delivery due by $until:\n\n$lines\n"),
+    ),
+}
+
+Message = namedtuple('Message', ['idempotency_key', 'patient_id', 'recipient', 'subject', 'body'])
+
+def render(template_name, **values):
+    """Render a (subject, body) pair from a named template"""
+    subject, body = TEMPLATES[template_name]
+    return subject.safe_substitute(values), body.safe_substitute(values)
+
+# Transports
+class SmtpTransport:
+    """Send messages through an SMTP server"""
+
+    def __init__(self, host=None, port=None, sender=None):
+        self.host = host or os.environ.get('BLISTER_SMTP_HOST', 'localhost')
+        self.port = int(port or os.environ.get('BLISTER_SMTP_PORT', '25'))
+        self.sender = sender or os.environ.get('BLISTER_SMTP_SENDER', 'reminders@pharmalife.local')
+
+    def _send(self, message):
+        email = EmailMessage()
+        email['From'] = self.sender
+        email['To'] = message.recipient
+        email['Subject'] = message.subject
+        email['Message-ID'] = f"<{message.idempotency_key}@blister-scheduler>"
+        email.set_content(message.body)
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            smtp.send_message(email)
+
+    async def send(self, message):
+        await asyncio.to_thread(self._send, message)
+
+
+class HttpTransport:
+    """POST each message as JSON to a webhook (SMS gateway, chat bridge, ...)"""
+
+    def __init__(self, url=None):
+        self.url = url or os.environ.get('BLISTER_NOTIFY_URL', 'http://127.0.0.1:8025/notify')
+
+    def _send(self, message):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(message._asdict()).encode(),
+            headers={'Content-Type': 'application/json', 'Idempotency-Key': message.idempotency_key},
+            method='POST',
+        )
+        with urllib.request.urlopen(request, timeout=30) as response:
+            if response.status >= 300:
+                raise RuntimeError(f"HTTP {response.status}")
+
+    async def send(self, message):
+        await asyncio.to_thread(self._send, message)
+
+
+def get_transport():
+    """The transport selected by BLISTER_NOTIFY_TRANSPORT"""
+    if os.environ.get('BLISTER_NOTIFY_TRANSPORT', 'smtp') == 'http':
+        return HttpTransport()
+    return SmtpTransport()
+
+# Building Reminders
+def build_reminders(today=None, days_ahead=1):
+    """
+    Messages for every active patient with an email whose pack is due by today + days_ahead,
+    plus an optional home-delivery digest for drivers
+    """
+    today = today or datetime.now().date()
+    until = (today + timedelta(days=days_ahead)).strftime('%Y-%m-%d')
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT id, name, email, delivery, billing_date
+        FROM patients
+        WHERE billing_day <= ? AND discharged_at IS NULL
+        ORDER BY billing_day
+    ''', (to_day_number(today) + days_ahead,))
+    rows = c.fetchall()
+    conn.close()
+
+    messages = []
+    deliveries = []
+    for patient_id, name, email, delivery, billing_date in rows:
+        if email:
+            subject, body = render('patient_due', name=name, billing_date=billing_date,
+                                   delivery=delivery or 'pickup')
+            messages.append(Message(f"due:{patient_id}:{billing_date}", patient_id, email, subject, body))
+        if delivery == 'Home Delivery':
+            deliveries.append(f"- {name} (#{patient_id}) due {billing_date}")
+
+    driver_email = os.environ.get('BLISTER_DRIVER_EMAIL')
+    if driver_email and deliveries:
+        subject, body = render('driver_digest', until=until, count=len(deliveries), lines='\n'.join(deliveries))
+        messages.append(Message(f"drivers:{until}", None, driver_email, subject, body))
+    return messages
+
+# Dispatch
+def _already_sent(keys):
+    """Idempotency keys that were sent on an earlier run"""
+    if not keys:
+        return set()
+    conn = get_connection()
+    c = conn.cursor()
+    sent = set()
+    keys = list(keys)
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        c.execute(f'''SELECT idempotency_key FROM notification_log
+                      WHERE status = 'sent' AND idempotency_key IN ({','.join('?' * len(chunk))})''', chunk)
+        sent.update(row[0] for row in c.fetchall())
+    conn.close()
+    return sent
+
+
+def _claim(message):
+    """
+    Claim a message's idempotency key before sending it
+    Returns False when the key was already sent, or is being sent by another run.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO notification_log (idempotency_key, patient_id, recipient, status, attempts)
+        VALUES (?, ?, ?, 'sending', 0)
+        ON CONFLICT(idempotency_key) DO UPDATE SET
+            status = 'sending',
+            error = NULL,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE notification_log.status = 'failed'
+    ''', (message.idempotency_key, message.patient_id, message.recipient))
+    claimed = c.rowcount == 1
+    conn.commit()
+    conn.close()
+    return claimed
+
+
+def _record_outcome(outcome):
+    """Replace a claim with the delivery outcome"""
+    key, _, _, status, attempts, error = outcome
+    conn = get_connection()
+    conn.execute('''
+        UPDATE notification_log
+        SET status = ?, attempts = attempts + ?, error = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE idempotency_key = ?
+    ''', (status, attempts, error, key))
+    conn.commit()
+    conn.close()
+
+
+async def _send_with_retries(transport, message, semaphore, retries, backoff):
+    """Claim, send and record one message; None if another run has (or had) it"""
+    async with semaphore:
+        if not await asyncio.to_thread(_claim, message):
+            return None
+        outcome = None
+        for attempt in range(1, retries + 1):
+            try:
+                await transport.send(message)
+                outcome = (message.idempotency_key, message.patient_id, message.recipient, 'sent', attempt, None)
+                break
+            except Exception as e:
+                error = str(e)
+                if attempt < retries:
+                    await asyncio.sleep(backoff * 2 ** (attempt - 1))
+        outcome = outcome or (message.idempotency_key, message.patient_id, message.recipient, 'failed', retries, error)
+        await asyncio.to_thread(_record_outcome, outcome)
+        return outcome
+
+
+async def dispatch(messages, transport, concurrency=DISPATCH_CONCURRENCY, retries=DISPATCH_RETRIES,
+                   backoff=RETRY_BACKOFF_SECONDS):
+    """
+    Send messages concurrently (at most `concurrency` in flight), skipping any whose
+    idempotency key was already sent or is claimed by another run. Returns a summary dict.
+    """
+    started = time.time()
+    sent_before = _already_sent(message.idempotency_key for message in messages)
+    pending = [message for message in messages if message.idempotency_key not in sent_before]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*(
+        _send_with_retries(transport, message, semaphore, retries, backoff) for message in pending
+    ))
+    outcomes = [outcome for outcome in results if outcome is not None]
+
+    failed = [outcome for outcome in outcomes if outcome[3] == 'failed']
+    return {
+        'started_at': datetime.fromtimestamp(started).strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_seconds': round(time.time() - started, 2),
+        'sent': len(outcomes) - len(failed),
+        'failed': len(failed),
+        'skipped_duplicates': len(messages) - len(outcomes),
+        'errors': sorted({outcome[5] for outcome in failed})[:5],
+    }
+
+
+def send_due_reminders(days_ahead=1, transport=None):
+    """Build and dispatch today's reminders (blocking); returns the summary"""
+    messages = build_reminders(days_ahead=days_ahead)
+    return asyncio.run(dispatch(messages, transport or get_transport()))
+
+# Background runs for the UI
+_reminder_run = {'running': False, 'summary': None}
+_reminder_lock = threading.Lock()
+
+def _run_in_background(days_ahead):
+    try:
+        summary = send_due_reminders(days_ahead)
+    except Exception as e:
+        summary = {'error': str(e)}
+    with _reminder_lock:
+        _reminder_run['summary'] = summary
+        _reminder_run['running'] = False
+
+
+def start_reminder_run(days_ahead=1):
+    """Dispatch reminders on a background thread so the page is not blocked; False if one is running"""
+    with _reminder_lock:
+        if _reminder_run['running']:
+            return False
+        _reminder_run['running'] = True
+    threading.Thread(target=_run_in_background, args=(days_ahead,), daemon=True).start()
+    return True
+
+
+def get_reminder_run():
+    """Whether a run is in progress and the summary of the last finished run"""
+    with _reminder_lock:
+        return dict(_reminder_run)
@@ -4,104 +4,605 @@ Handles patient CRUD operations, scheduling, and cycle management
 """
 
 import pandas as pd
-from datetime import datetime, timedelta
-from modules.database import get_connection
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from modules.database import get_connection, get_read_connection, record_write
+from modules.metrics import CYCLES, CYCLE_CONFLICTS
+from modules.change_feed import publish
+from modules.coherence import cached_read, note_local_write
+from modules.due_index import get_due_index, refresh_patients
+from modules.analytics import record_cycle_rollup
+from modules.business_calendar import get_calendars
+from modules.recurrence import (
+    rule_for_schedule, next_occurrence, compile_rule, EveryNDays,
+    get_patient_rule, save_patient_rule, parse_rule
+)
+
+# Result of a compare-and-swap write. On conflict, version holds the row's
+# current version (None if the patient no longer exists) so callers can reload and retry.
+WriteResult = namedtuple('WriteResult', ['success', 'conflict', 'version'])
+
+# Result of a batched edit: ids written, ids changed by someone else meanwhile (skipped),
+# and patient_id -> message for rows rejected as invalid (also skipped)
+BulkWriteResult = namedtuple('BulkWriteResult', ['updated', 'conflicts', 'errors'])
+
+# Columns the bulk editor may change; the schedule ones move the next schedule date
+EDITABLE_COLUMNS = ('name', 'delivery', 'insurance', 'cost', 'blister_schedule', 'billing_date', 'custom_rule',
+                    'email', 'location_id')
+SCHEDULE_COLUMNS = ('blister_schedule', 'billing_date', 'custom_rule', 'location_id')
 
 # Helper Functions
-def calculate_next_schedule(billing_date_str, schedule_type="Monthly"):
-    """Calculate next schedule date based on schedule type"""
-    billing_date = datetime.strptime(billing_date_str, '%Y-%m-%d')
-    
-    if schedule_type == "Weekly":
-        days = 7
-    elif schedule_type == "Bi-weekly":
-        days = 14
-    elif schedule_type == "Monthly":
-        days = 28
-    else:
-        days = 28  # Default to 28 days
-        
-    next_schedule = billing_date + timedelta(days=days)
-    return next_schedule.strftime('%Y-%m-%d')
+def calculate_next_schedule(billing_date_str, schedule_type="Monthly", custom_rule=None, location_id=None,
+                            calendars=None):
+    """
+    Calculate next schedule date based on schedule type (and custom rule if any),
+    moved off days the patient's location is closed
+    calendars (from load_calendars) defaults to the live database's calendars
+    """
+    billing_date = datetime.strptime(billing_date_str, '%Y-%m-%d').date()
+    next_schedule = next_occurrence(rule_for_schedule(schedule_type, custom_rule), billing_date)
+    calendars = calendars if calendars is not None else get_calendars()
+    calendar = calendars.get(location_id) or calendars[None]
+    return calendar.roll_date(next_schedule, after=billing_date).strftime('%Y-%m-%d')
+
+# Dates are stored as ISO text for display plus an integer day number (days since
+# 1970-01-01) that range filters and their indexes work on
+EPOCH = date(1970, 1, 1)
+
+def to_day_number(value):
+    """Day number for a date, datetime or 'YYYY-MM-DD' string"""
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%d').date()
+    elif isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+def from_day_number(day):
+    """'YYYY-MM-DD' string for a day number"""
+    return (EPOCH + timedelta(days=int(day))).strftime('%Y-%m-%d')
+
+def validate_custom_rule(schedule_type, custom_rule):
+    """Return an error message for an invalid custom schedule, or None"""
+    if schedule_type != "Custom":
+        return None
+    if not custom_rule:
+        return "Custom schedules need a recurrence rule"
+    try:
+        parse_rule(custom_rule)
+    except ValueError as e:
+        return str(e)
+    return None
+
+def _patients_version(conn):
+    """The patients data version as seen by conn (inside its transaction, if one is open)"""
+    return conn.execute("SELECT version FROM data_versions WHERE scope = 'patients'").fetchone()[0]
+
+def _begin_write(conn):
+    """
+    Open a patient write transaction holding the write lock from the start, and return
+    the patients data version it starts from (no other write can land before it commits)
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    return _patients_version(conn)
+
+def _after_write(kind, patient_ids, versions=None):
+    """
+    Write hook run after every committed patient change: marks the report snapshot
+    stale, refreshes this process's cached reads and due index, and publishes the
+    change to the feed that live screens listen on
+    versions is (version the transaction started from, version it committed), both read
+    inside the write transaction; without it the due index rebuilds on next use.
+    """
+    patient_ids = [int(pid) for pid in patient_ids]
+    record_write(max(len(patient_ids), 1))
+    note_local_write('patients')
+    refresh_patients(patient_ids, versions)
+    publish(kind, patient_ids)
 
 # Patient CRUD Operations
-def add_patient(name, billing_date, delivery=None, insurance=None, cost=None, blister_schedule="Monthly"):
+def add_patient(name, billing_date, delivery=None, insurance=None, cost=None, blister_schedule="Monthly", custom_rule=None,
+                email=None, location_id=None):
     """Add a new patient"""
-    next_schedule = calculate_next_schedule(billing_date, blister_schedule)
+    next_schedule = calculate_next_schedule(billing_date, blister_schedule, custom_rule, location_id)
     conn = get_connection()
     c = conn.cursor()
+    start_version = _begin_write(conn)
     c.execute('''INSERT INTO patients 
-                 (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule_date) 
-                 VALUES (?, ?, ?, ?, ?, ?, ?)''',
-              (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule))
+                 (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule_date, email,
+                  billing_day, next_schedule_day, location_id) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule, email,
+               to_day_number(billing_date), to_day_number(next_schedule), location_id))
+    patient_id = c.lastrowid
+    save_patient_rule(conn, patient_id, blister_schedule, custom_rule)
+    versions = (start_version, _patients_version(conn))
     conn.commit()
     conn.close()
+    _after_write('added', [patient_id], versions)
 
-def update_patient(patient_id, name, delivery, insurance, cost, blister_schedule, billing_date):
-    """Update an existing patient"""
+def _current_version(c, patient_id):
+    """Read a patient's current row version, or None if it no longer exists"""
+    c.execute('SELECT version FROM patients WHERE id = ?', (patient_id,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+def update_patient(patient_id, name, delivery, insurance, cost, blister_schedule, billing_date, custom_rule=None,
+                   expected_version=None, email=None, location_id=None):
+    """
+    Update an existing patient
+    If expected_version is given the update only applies when the row is still at that version
+    Returns WriteResult
+    """
     # Recalculate next schedule based on new billing date and schedule type
-    next_schedule = calculate_next_schedule(billing_date, blister_schedule)
+    next_schedule = calculate_next_schedule(billing_date, blister_schedule, custom_rule, location_id)
     
     conn = get_connection()
     c = conn.cursor()
-    c.execute('''UPDATE patients 
+    start_version = _begin_write(conn)
+    query = '''UPDATE patients 
                  SET name = ?, delivery = ?, insurance = ?, cost = ?, blister_schedule = ?, 
-                     billing_date = ?, next_schedule_date = ?
-                 WHERE id = ?''',
-              (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule, patient_id))
+                     billing_date = ?, next_schedule_date = ?, email = ?, version = version + 1,
+                     billing_day = ?, next_schedule_day = ?, location_id = ?
+                 WHERE id = ?'''
+    params = [name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule, email,
+              to_day_number(billing_date), to_day_number(next_schedule), location_id, patient_id]
+    if expected_version is not None:
+        query += ' AND version = ?'
+        params.append(int(expected_version))
+    c.execute(query, params)
+    
+    if c.rowcount == 0:
+        conn.rollback()
+        result = WriteResult(False, True, _current_version(c, patient_id))
+        conn.close()
+        return result
+    
+    save_patient_rule(conn, patient_id, blister_schedule, custom_rule)
+    result = WriteResult(True, False, _current_version(c, patient_id))
+    versions = (start_version, _patients_version(conn))
+    conn.commit()
+    conn.close()
+    _after_write('updated', [patient_id], versions)
+    return result
+
+def update_patients(changes, chunk_size=500):
+    """
+    Apply edits to many patients in one transaction
+    changes: iterable of (patient_id, expected_version, {column: new value}) holding only the
+    changed EDITABLE_COLUMNS. Only those columns are written; rows whose billing date,
+    schedule, rule or location changed get their next schedule date recomputed together.
+    Rows no longer at expected_version, or with invalid values, are skipped.
+    Returns BulkWriteResult
+    """
+    changes = [(int(pid), int(version), dict(fields)) for pid, version, fields in changes if fields]
+    for _, _, fields in changes:
+        unknown = set(fields) - set(EDITABLE_COLUMNS)
+        if unknown:
+            raise ValueError(f"Columns cannot be edited in bulk: {', '.join(sorted(unknown))}")
+    if not changes:
+        return BulkWriteResult([], [], {})
+    
+    conn = get_connection()
+    c = conn.cursor()
+    # Take the write lock first so the versions read below cannot change before the writes
+    start_version = _begin_write(conn)
+    current = {}
+    ids = [pid for pid, _, _ in changes]
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        c.execute(f'''SELECT p.id, p.version, p.blister_schedule, p.billing_date, r.rule, p.location_id
+                      FROM patients p
+                      LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+                      WHERE p.id IN ({','.join('?' * len(chunk))})''', chunk)
+        for pid, version, schedule, billing_date, rule, location_id in c.fetchall():
+            current[pid] = {'version': version, 'blister_schedule': schedule, 'billing_date': billing_date,
+                            'custom_rule': rule, 'location_id': location_id}
+    
+    conflicts, errors, accepted = [], {}, []
+    for pid, expected_version, fields in changes:
+        row = current.get(pid)
+        if row is None or row['version'] != expected_version:
+            conflicts.append(pid)
+            continue
+        merged = {**row, **fields}
+        if 'name' in fields and not (fields['name'] or '').strip():
+            errors[pid] = "Patient name cannot be empty"
+            continue
+        try:
+            billing_day = to_day_number(merged['billing_date'])
+        except (TypeError, ValueError):
+            errors[pid] = f"Billing date must be YYYY-MM-DD, got {merged['billing_date']!r}"
+            continue
+        rule_error = validate_custom_rule(merged['blister_schedule'], merged['custom_rule'])
+        if rule_error:
+            errors[pid] = rule_error
+            continue
+        if 'billing_date' in fields:
+            fields['billing_date'] = from_day_number(billing_day)
+        accepted.append((pid, fields, merged, billing_day))
+    
+    # Next schedule dates for every row whose schedule inputs changed, computed together
+    rescheduled = [(pid, merged, billing_day) for pid, fields, merged, billing_day in accepted
+                   if any(column in fields for column in SCHEDULE_COLUMNS)]
+    next_days = {}
+    if rescheduled:
+        schedule_df = pd.DataFrame({
+            'billing_day': [billing_day for _, _, billing_day in rescheduled],
+            'blister_schedule': [merged['blister_schedule'] for _, merged, _ in rescheduled],
+            'rule': [merged['custom_rule'] for _, merged, _ in rescheduled],
+            'location_id': pd.array([merged['location_id'] for _, merged, _ in rescheduled], dtype='Int64'),
+        })
+        next_days = dict(zip([pid for pid, _, _ in rescheduled], _next_schedule_days(schedule_df)))
+    
+    # Rows changing the same columns share one executemany
+    statements = {}
+    for pid, fields, merged, billing_day in accepted:
+        values = {column: value for column, value in fields.items() if column != 'custom_rule'}
+        if 'billing_date' in fields:
+            values['billing_day'] = billing_day
+        if pid in next_days:
+            values['next_schedule_date'] = from_day_number(next_days[pid])
+            values['next_schedule_day'] = int(next_days[pid])
+        columns = tuple(sorted(values))
+        statements.setdefault(columns, []).append([values[column] for column in columns] + [pid])
+    for columns, rows in statements.items():
+        assignments = ''.join(f'{column} = ?, ' for column in columns)
+        c.executemany(f'UPDATE patients SET {assignments}version = version + 1 WHERE id = ?', rows)
+    for pid, fields, merged, _ in accepted:
+        if 'blister_schedule' in fields or 'custom_rule' in fields:
+            save_patient_rule(conn, pid, merged['blister_schedule'], merged['custom_rule'])
+    versions = (start_version, _patients_version(conn))
     conn.commit()
     conn.close()
+    
+    updated = [pid for pid, _, _, _ in accepted]
+    if updated:
+        _after_write('updated', updated, versions)
+    return BulkWriteResult(updated, conflicts, errors)
 
 def delete_patient(patient_id):
     """Delete a patient"""
+    delete_patients([patient_id])
+
+def delete_patients(patient_ids):
+    """
+    Permanently delete many patients in one transaction
+    History and custom rules go with them through ON DELETE CASCADE
+    Returns the number of patients deleted
+    """
+    ids = [(int(pid),) for pid in patient_ids]
+    conn = get_connection()
+    c = conn.cursor()
+    start_version = _begin_write(conn)
+    c.executemany('DELETE FROM patients WHERE id = ?', ids)
+    deleted = c.rowcount
+    versions = (start_version, _patients_version(conn))
+    conn.commit()
+    conn.close()
+    _after_write('deleted', [pid for (pid,) in ids], versions)
+    return deleted
+
+def merge_patients(keep_id, duplicate_id, keep_version, duplicate_version):
+    """
+    Merge a duplicate patient into the one kept, in one transaction
+    Cycle history, reminder log entries and analytics rollup membership move to the kept
+    patient, which also takes any detail it is missing from the duplicate; the duplicate
+    is then deleted. Applies only if both are still at the versions the caller displayed.
+    Returns WriteResult (with the kept patient's version)
+    """
+    keep_id, duplicate_id = int(keep_id), int(duplicate_id)
+    if keep_id == duplicate_id:
+        raise ValueError("A patient cannot be merged into itself")
     conn = get_connection()
     c = conn.cursor()
-    c.execute('DELETE FROM schedule_records WHERE patient_id = ?', (patient_id,))
-    c.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
+    start_version = _begin_write(conn)
+    c.execute('''UPDATE patients
+                 SET delivery = COALESCE(NULLIF(delivery, ''), (SELECT delivery FROM patients WHERE id = :dup)),
+                     insurance = COALESCE(NULLIF(insurance, ''), (SELECT insurance FROM patients WHERE id = :dup)),
+                     cost = COALESCE(cost, (SELECT cost FROM patients WHERE id = :dup)),
+                     email = COALESCE(NULLIF(email, ''), (SELECT email FROM patients WHERE id = :dup)),
+                     location_id = COALESCE(location_id, (SELECT location_id FROM patients WHERE id = :dup)),
+                     version = version + 1
+                 WHERE id = :keep AND version = :version''',
+              {'keep': keep_id, 'dup': duplicate_id, 'version': int(keep_version)})
+    kept = c.rowcount
+    if kept == 0 or _current_version(c, duplicate_id) != int(duplicate_version):
+        conn.rollback()
+        result = WriteResult(False, True, _current_version(c, keep_id))
+        conn.close()
+        return result
+    
+    c.execute('UPDATE schedule_records SET patient_id = ? WHERE patient_id = ?', (keep_id, duplicate_id))
+    c.execute('UPDATE notification_log SET patient_id = ? WHERE patient_id = ?', (keep_id, duplicate_id))
+    # Rollup groups that counted both patients now count one
+    c.execute('''UPDATE monthly_rollups SET patient_count = patient_count - 1
+                 WHERE (month, insurer, delivery, schedule_type) IN (
+                     SELECT d.month, d.insurer, d.delivery, d.schedule_type
+                     FROM rollup_patients d
+                     JOIN rollup_patients k ON k.month = d.month AND k.insurer = d.insurer
+                          AND k.delivery = d.delivery AND k.schedule_type = d.schedule_type
+                     WHERE d.patient_id = ? AND k.patient_id = ?
+                 )''', (duplicate_id, keep_id))
+    c.execute('UPDATE OR IGNORE rollup_patients SET patient_id = ? WHERE patient_id = ?', (keep_id, duplicate_id))
+    c.execute('DELETE FROM rollup_patients WHERE patient_id = ?', (duplicate_id,))
+    c.execute('DELETE FROM patients WHERE id = ?', (duplicate_id,))
+    versions = (start_version, _patients_version(conn))
     conn.commit()
     conn.close()
+    _after_write('merged', [keep_id, duplicate_id], versions)
+    return WriteResult(True, False, int(keep_version) + 1)
 
-def get_patients():
-    """Get all patients"""
+def discharge_patients(patient_ids):
+    """
+    Soft-delete patients: keep them and their history, but drop them from due lists
+    Returns the number of patients discharged
+    """
+    ids = [(int(pid),) for pid in patient_ids]
     conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM patients ORDER BY next_schedule_date ASC", conn)
+    c = conn.cursor()
+    start_version = _begin_write(conn)
+    c.executemany('''UPDATE patients SET discharged_at = CURRENT_TIMESTAMP, version = version + 1
+                     WHERE id = ? AND discharged_at IS NULL''', ids)
+    discharged = c.rowcount
+    versions = (start_version, _patients_version(conn))
+    conn.commit()
+    conn.close()
+    _after_write('discharged', [pid for (pid,) in ids], versions)
+    return discharged
+
+def readmit_patient(patient_id):
+    """Bring a discharged patient back onto the active lists"""
+    conn = get_connection()
+    c = conn.cursor()
+    start_version = _begin_write(conn)
+    c.execute('UPDATE patients SET discharged_at = NULL, version = version + 1 WHERE id = ?', (int(patient_id),))
+    versions = (start_version, _patients_version(conn))
+    conn.commit()
+    conn.close()
+    _after_write('readmitted', [patient_id], versions)
+
+def get_discharged_patients():
+    """Get discharged patients, most recently discharged first"""
+    conn = get_connection()
+    df = pd.read_sql_query(
+        "SELECT * FROM patients WHERE discharged_at IS NOT NULL ORDER BY discharged_at DESC", conn)
+    conn.close()
+    return df
+
+def get_patients(use_snapshot=False):
+    """
+    Get all active patients (with their custom rule, if any), optionally from the report snapshot
+    Live reads are shared across sessions until any replica changes a patient.
+    """
+    def load():
+        conn = get_read_connection(use_snapshot)
+        df = pd.read_sql_query('''
+            SELECT p.*, r.rule AS custom_rule
+            FROM patients p
+            LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+            WHERE p.discharged_at IS NULL
+            ORDER BY p.next_schedule_day ASC
+        ''', conn)
+        conn.close()
+        return df
+    return load() if use_snapshot else cached_read('patients', 'active_patients', load)
+
+# Date Range Queries (filtered in SQL on the indexed day-number columns)
+def get_due_patients(as_of=None, use_snapshot=False):
+    """
+    Active patients whose billing date is on or before as_of (default today)
+    Live reads take the due ids from the in-memory due index and fetch just those rows.
+    """
+    day = to_day_number(as_of or date.today())
+    select = 'SELECT p.*, r.rule AS custom_rule FROM patients p LEFT JOIN recurrence_rules r ON r.patient_id = p.id'
+    conn = get_read_connection(use_snapshot)
+    if use_snapshot:
+        df = pd.read_sql_query(select + ' WHERE p.billing_day <= ? AND p.discharged_at IS NULL '
+                               'ORDER BY p.billing_day, p.name', conn, params=(day,))
+    else:
+        due_ids = get_due_index().due_by(day)
+        frames = [pd.read_sql_query(select + f" WHERE p.id IN ({','.join('?' * len(chunk))})", conn, params=chunk)
+                  for chunk in (due_ids[start:start + 500] for start in range(0, len(due_ids), 500))]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.read_sql_query(select + ' WHERE 0', conn)
+        order = {patient_id: position for position, patient_id in enumerate(due_ids)}
+        df = df.sort_values('id', key=lambda ids: ids.map(order), ignore_index=True)
+    conn.close()
+    return df
+
+def get_patients_scheduled_between(start, end, use_snapshot=False):
+    """Active patients whose next schedule date falls within [start, end]"""
+    conn = get_read_connection(use_snapshot)
+    df = pd.read_sql_query('''
+        SELECT id, name, billing_date, next_schedule_date, next_schedule_day
+        FROM patients
+        WHERE next_schedule_day BETWEEN ? AND ? AND discharged_at IS NULL
+        ORDER BY next_schedule_day, name
+    ''', conn, params=(to_day_number(start), to_day_number(end)))
+    conn.close()
+    return df
+
+def get_schedule_counts(as_of=None):
+    """Counts of active, due and upcoming patients as of a date (default today), and of recorded cycles"""
+    day = to_day_number(as_of or date.today())
+    due = get_due_index().count_due(day)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('''
+        SELECT (SELECT COUNT(*) FROM patients WHERE discharged_at IS NULL),
+               (SELECT COUNT(*) FROM patients WHERE next_schedule_day > ? AND discharged_at IS NULL),
+               (SELECT COUNT(*) FROM schedule_history)
+    ''', (day,))
+    total, upcoming, cycles = c.fetchone()
+    conn.close()
+    return {'total': total, 'due': due, 'upcoming': upcoming, 'cycles': cycles}
+
+def get_patient(patient_id):
+    """Get a single patient by id as a dict, or None"""
+    conn = get_connection()
+    df = pd.read_sql_query('''
+        SELECT p.*, r.rule AS custom_rule
+        FROM patients p
+        LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+        WHERE p.id = ?
+    ''', conn, params=(patient_id,))
+    conn.close()
+    return df.iloc[0].to_dict() if not df.empty else None
+
+def search_patients(prefix, limit=10):
+    """
+    Find patients whose name starts with a prefix (case-insensitive)
+    Uses the NOCASE name index as a range scan, so cost grows with limit, not table size.
+    Each row carries its version, for cycling the patient exactly as it was shown.
+    """
+    prefix = (prefix or '').strip()
+    conn = get_connection()
+    df = pd.read_sql_query('''
+        SELECT id, name, billing_date, next_schedule_date, insurance, delivery, version
+        FROM patients
+        WHERE name COLLATE NOCASE >= ? AND name COLLATE NOCASE < ?
+          AND discharged_at IS NULL
+        ORDER BY name COLLATE NOCASE, id
+        LIMIT ?
+    ''', conn, params=(prefix, prefix + '\U0010ffff', limit))
     conn.close()
     return df
 
 # Schedule Management
-def cycle_patient(patient_id, patient_name, current_billing_date, current_next_schedule, manual_billing_date=None):
-    """Cycle a patient to the next billing period"""
-    # Get patient's schedule type
+def cycle_patient(patient_id, expected_version, manual_billing_date=None, user_id=None):
+    """
+    Cycle a patient to the next billing period
+    The cycle only applies if the patient is still at expected_version (the version the
+    caller displayed), so a double click or a concurrent cycle cannot advance it twice.
+    user_id (the staff member cycling) is kept in the history row.
+    Returns WriteResult
+    """
+    patient_id = int(patient_id)
     conn = get_connection()
     c = conn.cursor()
-    c.execute('SELECT blister_schedule FROM patients WHERE id = ?', (patient_id,))
-    result = c.fetchone()
-    schedule_type = result[0] if result else "Monthly"
+    start_version = _begin_write(conn)
+    c.execute('''SELECT name, billing_date, next_schedule_date, blister_schedule, version,
+                        insurance, delivery, cost, billing_day, location_id
+                 FROM patients WHERE id = ?''', (patient_id,))
+    row = c.fetchone()
+    if row is None or row[4] != int(expected_version):
+        conn.close()
+        CYCLE_CONFLICTS.inc()
+        return WriteResult(False, True, row[4] if row else None)
+    
+    (patient_name, current_billing_date, current_next_schedule, schedule_type, version,
+     insurance, delivery, cost, current_billing_day, location_id) = row
+    custom_rule = get_patient_rule(patient_id, conn)
     
     if manual_billing_date:
         new_billing_date = manual_billing_date
     else:
         new_billing_date = current_next_schedule
         
-    new_next_schedule = calculate_next_schedule(new_billing_date, schedule_type)
+    new_next_schedule = calculate_next_schedule(new_billing_date, schedule_type or "Monthly", custom_rule, location_id)
+    
+    # Compare-and-swap the patient record; losing the race means someone else cycled first
+    c.execute('''UPDATE patients SET billing_date = ?, next_schedule_date = ?, version = version + 1,
+                                     billing_day = ?, next_schedule_day = ?
+                 WHERE id = ? AND version = ?''',
+              (new_billing_date, new_next_schedule, to_day_number(new_billing_date),
+               to_day_number(new_next_schedule), patient_id, version))
+    if c.rowcount == 0:
+        conn.rollback()
+        result = WriteResult(False, True, _current_version(c, patient_id))
+        conn.close()
+        CYCLE_CONFLICTS.inc()
+        return result
     
     # Save the cycle record to history
     c.execute('''
         INSERT INTO schedule_records 
-        (patient_id, patient_name, previous_billing_date, new_billing_date, new_next_schedule_date)
+        (patient_id, previous_billing_day, new_billing_day, new_next_schedule_day, cycled_by)
         VALUES (?, ?, ?, ?, ?)
-    ''', (patient_id, patient_name, current_billing_date, new_billing_date, new_next_schedule))
+    ''', (patient_id, current_billing_day, to_day_number(new_billing_date), to_day_number(new_next_schedule),
+          user_id))
     
-    # Update the patient record
-    c.execute('UPDATE patients SET billing_date = ?, next_schedule_date = ? WHERE id = ?',
-              (new_billing_date, new_next_schedule, patient_id))
+    # Roll the cycle into this month's analytics in the same transaction
+    record_cycle_rollup(conn, patient_id, new_billing_date, insurance, delivery, schedule_type, cost)
     
+    versions = (start_version, _patients_version(conn))
     conn.commit()
     conn.close()
+    _after_write('cycled', [patient_id], versions)
+    CYCLES.inc()
+    return WriteResult(True, False, version + 1)
+
+def _next_schedule_days(df):
+    """
+    Next schedule day numbers for a DataFrame of billing_day, blister_schedule, rule and location_id
+    Plain every-N-day rules are stepped as one array per rule, and each location's dates
+    are rolled onto its open days as one array.
+    """
+    df = df.assign(rule_text=[rule_for_schedule(schedule, rule if pd.notna(rule) else None)
+                              for schedule, rule in zip(df['blister_schedule'], df['rule'])],
+                   raw_day=0)
+    
+    # Raw next occurrence per rule: vectorized for plain every-N rules, rule by rule otherwise
+    for rule_text, group in df.groupby('rule_text'):
+        compiled = compile_rule(rule_text)
+        if isinstance(compiled.evaluator, EveryNDays) and not compiled.skip_dates:
+            df.loc[group.index, 'raw_day'] = group['billing_day'] + compiled.evaluator.days
+        else:
+            df.loc[group.index, 'raw_day'] = [to_day_number(compiled.next_after(EPOCH + timedelta(days=int(day))))
+                                              for day in group['billing_day']]
+    
+    # Roll each location's dates onto its open days
+    calendars = get_calendars()
+    new_days = df['raw_day'].copy()
+    for location_id, group in df.groupby(df['location_id'].astype('Int64'), dropna=False):
+        location_id = None if pd.isna(location_id) else int(location_id)
+        calendar = calendars.get(location_id) or calendars[None]
+        new_days[group.index] = calendar.roll_days(group['raw_day'].to_numpy(), group['billing_day'].to_numpy())
+    return new_days
 
-def get_schedule_history():
-    """Get all schedule history records"""
+def recompute_next_schedules(chunk_size=500):
+    """
+    Recompute every active patient's next schedule date from their billing date, rule and
+    location calendar, e.g. after holidays or opening days change
+    Plain every-N-day rules are stepped as one array per rule, and each location's dates
+    are rolled onto open days as one array, so this stays fast across all patients.
+    Only rows whose date changed are written (bumping their version). The write lock is
+    taken before the patients are read, so no edit can land between the read and the write.
+    Returns the number of patients whose next schedule date moved.
+    """
     conn = get_connection()
-    df = pd.read_sql_query("SELECT * FROM schedule_records ORDER BY cycled_at DESC", conn)
+    start_version = _begin_write(conn)
+    df = pd.read_sql_query('''
+        SELECT p.id, p.blister_schedule, r.rule, p.billing_day, p.next_schedule_day, p.location_id
+        FROM patients p
+        LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+        WHERE p.discharged_at IS NULL AND p.billing_day IS NOT NULL
+    ''', conn)
+    if df.empty:
+        conn.rollback()
+        conn.close()
+        return 0
+    df['new_day'] = _next_schedule_days(df)
+    changed = df[df['new_day'] != df['next_schedule_day']]
+    updates = [(from_day_number(day), int(day), int(pid)) for pid, day in zip(changed['id'], changed['new_day'])]
+    c = conn.cursor()
+    for start in range(0, len(updates), chunk_size):
+        c.executemany('''UPDATE patients SET next_schedule_date = ?, next_schedule_day = ?, version = version + 1
+                         WHERE id = ?''', updates[start:start + chunk_size])
+    versions = (start_version, _patients_version(conn))
+    conn.commit()
+    conn.close()
+    if updates:
+        _after_write('updated', [pid for _, _, pid in updates], versions)
+    return len(updates)
+
+def get_schedule_history(use_snapshot=False, limit=None):
+    """Get schedule history records, newest first (names resolved at read time), optionally from the report snapshot"""
+    conn = get_read_connection(use_snapshot)
+    query = "SELECT * FROM schedule_history ORDER BY id DESC"
+    params = ()
+    if limit:
+        query += " LIMIT ?"
+        params = (limit,)
+    df = pd.read_sql_query(query, conn, params=params)
     conn.close()
     return df
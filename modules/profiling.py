@@ -0,0 +1,99 @@
+"""
+Profiling module for Blister Pack Scheduler
+Opt-in cProfile and tracemalloc capture of whole app.py reruns, kept in a small
+in-memory ring buffer for the admin page
+
+Enable with BLISTER_PROFILE=1 or the toggle on the User Management page.
+When disabled, profile_rerun() only checks a flag, so normal reruns pay nothing.
+"""
+
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+PROFILE_KEEP = int(os.environ.get('BLISTER_PROFILE_KEEP', '20'))  # profiles kept in memory
+PROFILE_TOP = 30                                                  # rows kept per table
+TRACEMALLOC_FRAMES = 5
+
+Profile = namedtuple('Profile', ['id', 'started_at', 'user', 'duration_seconds', 'peak_kib',
+                                 'functions', 'allocations', 'prof'])
+
+_profiles = deque(maxlen=PROFILE_KEEP)
+_state = {'enabled': os.environ.get('BLISTER_PROFILE', '') not in ('', '0'), 'next_id': 1}
+_lock = threading.Lock()
+# cProfile and tracemalloc are process-wide in practice; profile one rerun at a time
+_capture_lock = threading.Lock()
+
+def profiling_enabled():
+    return _state['enabled']
+
+def set_profiling(enabled):
+    """Turn per-rerun profiling on or off for this process"""
+    _state['enabled'] = bool(enabled)
+
+def _top_functions(profiler):
+    """Top functions by cumulative time as dicts ready for a table"""
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+    return [{
+        'function': f"{func} ({os.path.basename(filename)}:{line})" if line else func,
+        'calls': calls,
+        'total_ms': round(total * 1000, 2),
+        'cumulative_ms': round(cumulative * 1000, 2),
+    } for (filename, line, func), (_, calls, total, cumulative, _) in rows]
+
+def _top_allocations(snapshot):
+    """Allocation sites still holding memory at the end of the rerun, largest first"""
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return [{
+        'site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+        'size_kib': round(stat.size / 1024, 1),
+        'blocks': stat.count,
+    } for stat in snapshot.statistics('lineno')[:PROFILE_TOP]]
+
+@contextmanager
+def profile_rerun(user=None):
+    """Profile the wrapped rerun when profiling is on (reruns cut short by st.rerun() included)"""
+    if not _state['enabled'] or not _capture_lock.acquire(blocking=False):
+        yield
+        return
+
+    started_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    started = time.perf_counter()
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        duration = time.perf_counter() - started
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        _capture_lock.release()
+
+        profiler.create_stats()
+        prof = marshal.dumps(profiler.stats)  # same format as Profile.dump_stats()
+        with _lock:
+            profile_id = _state['next_id']
+            _state['next_id'] += 1
+        _profiles.append(Profile(
+            profile_id, started_at, user, round(duration, 3), round(peak / 1024, 1),
+            _top_functions(profiler), _top_allocations(snapshot), prof,
+        ))
+
+def get_profiles():
+    """Captured profiles, newest first"""
+    return list(reversed(_profiles))
+
+def clear_profiles():
+    _profiles.clear()
@@ -0,0 +1,190 @@
+"""
+Recurrence module for Blister Pack Scheduler
+Parses, compiles and evaluates per-patient recurrence rules for Custom schedules
+
+A rule is a semicolon separated list of key=value parts, for example:
+    every=10                      every 10 days
+    weekdays=MON,THU              next Monday or Thursday
+    monthday=15                   the 15th of the month (clamped to month end)
+    every=21;skip=2025-12-25      any rule may add skip dates
+"""
+
+import calendar
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from modules.database import get_connection
+from modules.metrics import register_cache_info
+
+WEEKDAY_NAMES = ['MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN']
+
+# Built-in schedule types expressed as rules so every path shares one evaluator
+STANDARD_RULES = {
+    "Weekly": "every=7",
+    "Bi-weekly": "every=14",
+    "Monthly": "every=28",
+}
+DEFAULT_RULE = "every=28"
+
+# Compiled Evaluators
+class EveryNDays:
+    """Occurs every N days after the anchor date"""
+
+    def __init__(self, days):
+        self.days = days
+
+    def next_after(self, after):
+        return after + timedelta(days=self.days)
+
+
+class Weekdays:
+    """Occurs on a fixed set of weekdays"""
+
+    def __init__(self, weekdays):
+        self.weekdays = frozenset(weekdays)
+        # Offset (in days) to the next matching weekday, indexed by weekday()
+        self._offsets = []
+        for wd in range(7):
+            offset = 1
+            while (wd + offset) % 7 not in self.weekdays:
+                offset += 1
+            self._offsets.append(offset)
+
+    def next_after(self, after):
+        return after + timedelta(days=self._offsets[after.weekday()])
+
+
+class MonthDay:
+    """Occurs on a calendar day of the month, clamped to short months"""
+
+    def __init__(self, day):
+        self.day = day
+
+    def next_after(self, after):
+        year, month = after.year, after.month
+        candidate = date(year, month, min(self.day, calendar.monthrange(year, month)[1]))
+        if candidate > after:
+            return candidate
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return date(year, month, min(self.day, calendar.monthrange(year, month)[1]))
+
+
+class CompiledRule:
+    """A base evaluator plus the dates it must skip over"""
+
+    def __init__(self, text, evaluator, skip_dates):
+        self.text = text
+        self.evaluator = evaluator
+        self.skip_dates = frozenset(skip_dates)
+
+    def next_after(self, after):
+        """Return the first occurrence strictly after the given date"""
+        candidate = self.evaluator.next_after(after)
+        # A rule whose every occurrence is skipped would loop forever; cap it
+        for _ in range(366):
+            if candidate not in self.skip_dates:
+                return candidate
+            candidate = self.evaluator.next_after(candidate)
+        raise ValueError(f"Rule '{self.text}' has no occurrence that is not skipped")
+
+
+# Parsing
+def normalize_rule(text):
+    """Return a canonical form of a rule so equal rules share a cache entry"""
+    parts = [part.strip() for part in (text or '').split(';') if part.strip()]
+    return ';'.join(sorted(part.replace(' ', '').lower() for part in parts))
+
+
+def parse_rule(text):
+    """Parse rule text into a dict of its parts, raising ValueError if invalid"""
+    parsed = {'skip': []}
+    for part in normalize_rule(text).split(';'):
+        if not part:
+            continue
+        if '=' not in part:
+            raise ValueError(f"Invalid rule part '{part}', expected key=value")
+        key, value = part.split('=', 1)
+
+        if key == 'every':
+            if not value.isdigit() or int(value) < 1:
+                raise ValueError("'every' must be a positive number of days")
+            parsed['every'] = int(value)
+        elif key == 'weekdays':
+            names = [name.upper()[:3] for name in value.split(',') if name]
+            unknown = [name for name in names if name not in WEEKDAY_NAMES]
+            if not names or unknown:
+                raise ValueError(f"'weekdays' must list days from {', '.join(WEEKDAY_NAMES)}")
+            parsed['weekdays'] = [WEEKDAY_NAMES.index(name) for name in names]
+        elif key == 'monthday':
+            if not value.isdigit() or not 1 <= int(value) <= 31:
+                raise ValueError("'monthday' must be between 1 and 31")
+            parsed['monthday'] = int(value)
+        elif key == 'skip':
+            try:
+                parsed['skip'] += [datetime.strptime(d, '%Y-%m-%d').date() for d in value.split(',') if d]
+            except ValueError:
+                raise ValueError("'skip' dates must be in YYYY-MM-DD format")
+        else:
+            raise ValueError(f"Unknown rule key '{key}'")
+
+    kinds = [key for key in ('every', 'weekdays', 'monthday') if key in parsed]
+    if len(kinds) != 1:
+        raise ValueError("A rule needs exactly one of 'every', 'weekdays' or 'monthday'")
+    return parsed
+
+
+@lru_cache(maxsize=4096)
+def _compile_normalized(text):
+    parsed = parse_rule(text)
+    if 'every' in parsed:
+        evaluator = EveryNDays(parsed['every'])
+    elif 'weekdays' in parsed:
+        evaluator = Weekdays(parsed['weekdays'])
+    else:
+        evaluator = MonthDay(parsed['monthday'])
+    return CompiledRule(text, evaluator, parsed['skip'])
+
+
+register_cache_info('recurrence_rules', _compile_normalized.cache_info)
+
+
+def compile_rule(text):
+    """Compile rule text into a cached evaluator object"""
+    return _compile_normalized(normalize_rule(text))
+
+
+def rule_for_schedule(schedule_type, custom_rule=None):
+    """Return the rule text that drives a schedule type"""
+    if schedule_type == "Custom" and custom_rule:
+        return custom_rule
+    return STANDARD_RULES.get(schedule_type, DEFAULT_RULE)
+
+
+# Evaluation
+def next_occurrence(rule_text, after):
+    """Return the next occurrence of a rule strictly after a date"""
+    return compile_rule(rule_text).next_after(after)
+
+
+# Rule Storage
+def get_patient_rule(patient_id, conn=None):
+    """Get the custom rule text for a patient, or None"""
+    own_conn = conn is None
+    conn = conn or get_connection()
+    c = conn.cursor()
+    c.execute('SELECT rule FROM recurrence_rules WHERE patient_id = ?', (patient_id,))
+    row = c.fetchone()
+    if own_conn:
+        conn.close()
+    return row[0] if row else None
+
+
+def save_patient_rule(conn, patient_id, schedule_type, custom_rule):
+    """Store or clear a patient's custom rule inside the caller's transaction"""
+    c = conn.cursor()
+    if schedule_type == "Custom" and custom_rule:
+        c.execute('''
+            INSERT INTO recurrence_rules (patient_id, rule) VALUES (?, ?)
+            ON CONFLICT(patient_id) DO UPDATE SET rule = excluded.rule, updated_at = CURRENT_TIMESTAMP
+        ''', (patient_id, normalize_rule(custom_rule)))
+    else:
+        c.execute('DELETE FROM recurrence_rules WHERE patient_id = ?', (patient_id,))
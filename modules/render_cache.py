@@ -0,0 +1,46 @@
+"""
+Render cache module for Blister Pack Scheduler
+Process-wide LRU caches for rendered page pieces (calendar grid HTML, due-card lists),
+shared by every session so identical views are built once
+"""
+
+import threading
+from collections import OrderedDict
+from modules.metrics import record_cache
+
+class RenderCache:
+    """
+    Bounded LRU of rendered output
+    The key must include everything the output depends on (month, today, data version);
+    entries are never invalidated, they simply stop being asked for and age out.
+    """
+
+    def __init__(self, name, maxsize=64):
+        self.name = name
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """Cached output for key, calling render() to build it on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                record_cache(self.name, hit=True)
+                return self._entries[key]
+        # Render outside the lock; two sessions missing on the same key both render, one wins
+        value = render()
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        record_cache(self.name, hit=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -4,7 +4,7 @@ Reusable UI components and helpers
 """
 
 import streamlit as st
-from modules.database import get_connection
+from modules.database import get_connection, snapshot_age
 from modules.auth import get_user_apps
 
 def show_debug_info(user_id, username, role):
@@ -44,3 +44,9 @@ def check_app_access(user_id, role, app_key='blister_scheduler'):
         not user_apps.empty and app_key in user_apps['app_key'].values
     )
     return has_access
+
+def show_snapshot_caption():
+    """Tell the user how stale report data read from the snapshot may be"""
+    age = snapshot_age()
+    if age is not None:
+        st.caption(f"📸 Report data as of {int(age)}s ago")
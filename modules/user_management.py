@@ -3,10 +3,16 @@ User Management module for Blister Pack Scheduler
 Handles user CRUD operations and app assignments
 """
 
+import csv
+import io
+import logging
 import sqlite3
 import pandas as pd
 from modules.database import get_connection
 from modules.auth import hash_password
+from modules.coherence import note_local_write
+
+logger = logging.getLogger(__name__)
 
 # User CRUD Operations
 def get_all_users():
@@ -29,6 +35,7 @@ def create_user(username, password, full_name, role):
         conn.commit()
         user_id = c.lastrowid
         conn.close()
+        note_local_write('access')
         return True, user_id
     except sqlite3.IntegrityError:
         conn.close()
@@ -44,6 +51,7 @@ def update_user(user_id, full_name, role, is_active):
     ''', (full_name, role, is_active, user_id))
     conn.commit()
     conn.close()
+    note_local_write('access')
 
 def delete_user(user_id):
     """Delete a user"""
@@ -53,6 +61,7 @@ def delete_user(user_id):
     c.execute('DELETE FROM users WHERE id = ?', (user_id,))
     conn.commit()
     conn.close()
+    note_local_write('access')
 
 # App Management
 def get_all_apps():
@@ -64,47 +73,117 @@ def get_all_apps():
 
 def assign_app_to_user(user_id, app_id):
     """Assign an app to a user"""
-    print(f"DEBUG assign_app_to_user called with user_id={user_id}, app_id={app_id}")
-    print(f"DEBUG user_id type: {type(user_id)}, app_id type: {type(app_id)}")
-    
-    conn = get_connection()
-    c = conn.cursor()
     try:
-        # Check if assignment already exists
-        c.execute('SELECT COUNT(*) FROM user_apps WHERE user_id = ? AND app_id = ?', (user_id, app_id))
-        if c.fetchone()[0] > 0:
-            conn.close()
-            print(f"DEBUG Assignment already exists")
-            return True  # Already assigned
-        
-        # Insert new assignment
-        print(f"DEBUG Inserting user_id={user_id}, app_id={app_id}")
-        c.execute('INSERT INTO user_apps (user_id, app_id) VALUES (?, ?)', (user_id, app_id))
-        conn.commit()
-        
-        # Verify the insert worked
-        c.execute('SELECT * FROM user_apps WHERE user_id = ? AND app_id = ?', (user_id, app_id))
-        result = c.fetchone()
-        print(f"DEBUG After insert, query result: {result}")
-        
-        success = result is not None
-        
-        conn.close()
-        return success
-    except Exception as e:
-        print(f"Error assigning app: {e}")
-        import traceback
-        traceback.print_exc()
-        conn.close()
+        assign_apps_to_users([user_id], [app_id])
+        return True
+    except sqlite3.Error as e:
+        logger.warning("Could not assign app %s to user %s: %s", app_id, user_id, e)
         return False
 
 def remove_app_from_user(user_id, app_id):
     """Remove an app from a user"""
+    revoke_apps_from_users([user_id], [app_id])
+
+def assign_apps_to_users(user_ids, app_ids):
+    """
+    Assign every app in app_ids to every user in user_ids in one transaction
+    Existing assignments are left alone; returns the number of new assignments
+    """
+    pairs = [(int(user_id), int(app_id)) for user_id in user_ids for app_id in app_ids]
+    conn = get_connection()
+    c = conn.cursor()
+    c.executemany('INSERT OR IGNORE INTO user_apps (user_id, app_id) VALUES (?, ?)', pairs)
+    added = c.rowcount  # rows this statement changed, not the data-version trigger updates
+    conn.commit()
+    conn.close()
+    note_local_write('access')
+    return added
+
+def revoke_apps_from_users(user_ids, app_ids):
+    """Remove every app in app_ids from every user in user_ids in one transaction"""
+    pairs = [(int(user_id), int(app_id)) for user_id in user_ids for app_id in app_ids]
+    conn = get_connection()
+    c = conn.cursor()
+    c.executemany('DELETE FROM user_apps WHERE user_id = ? AND app_id = ?', pairs)
+    removed = c.rowcount
+    conn.commit()
+    conn.close()
+    note_local_write('access')
+    return removed
+
+def get_app_assignment_counts():
+    """Number of users assigned to each app: dict app_id -> count"""
     conn = get_connection()
     c = conn.cursor()
-    c.execute('DELETE FROM user_apps WHERE user_id = ? AND app_id = ?', (user_id, app_id))
+    c.execute('SELECT app_id, COUNT(*) FROM user_apps GROUP BY app_id')
+    counts = dict(c.fetchall())
+    conn.close()
+    return counts
+
+# Bulk Provisioning
+CSV_COLUMNS = ['username', 'password', 'full_name', 'role']
+
+def provision_users_from_csv(csv_file):
+    """
+    Create users (and their app assignments) from a CSV file in one transaction
+    Columns: username, password, full_name, role and an optional apps column
+    holding app keys separated by semicolons. Existing usernames are skipped.
+    Returns dict with 'created', 'skipped' and 'errors' lists
+    """
+    if isinstance(csv_file, (bytes, bytearray)):
+        csv_file = io.StringIO(csv_file.decode('utf-8-sig'))
+    elif hasattr(csv_file, 'getvalue') and isinstance(csv_file.getvalue(), bytes):
+        csv_file = io.StringIO(csv_file.getvalue().decode('utf-8-sig'))
+    reader = csv.DictReader(csv_file)
+    missing = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        return {'created': [], 'skipped': [], 'errors': [f"Missing column(s): {', '.join(missing)}"]}
+    
+    summary = {'created': [], 'skipped': [], 'errors': []}
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('SELECT app_key, id FROM apps')
+    app_ids = dict(c.fetchall())
+    
+    users = []
+    app_keys_by_username = {}
+    for line_number, row in enumerate(reader, start=2):
+        username = (row.get('username') or '').strip()
+        role = (row.get('role') or 'user').strip()
+        if not username or not row.get('password') or not row.get('full_name'):
+            summary['errors'].append(f"Line {line_number}: username, password and full_name are required")
+            continue
+        if role not in ('user', 'admin'):
+            summary['errors'].append(f"Line {line_number}: unknown role '{role}'")
+            continue
+        keys = [key.strip() for key in (row.get('apps') or '').split(';') if key.strip()]
+        unknown = [key for key in keys if key not in app_ids]
+        if unknown:
+            summary['errors'].append(f"Line {line_number}: unknown app(s) {', '.join(unknown)}")
+            continue
+        users.append((username, hash_password(row['password']), row['full_name'].strip(), role))
+        app_keys_by_username[username] = keys
+    
+    for user in users:
+        c.execute('''
+            INSERT OR IGNORE INTO users (username, password_hash, full_name, role, is_active)
+            VALUES (?, ?, ?, ?, 1)
+        ''', user)
+        (summary['created'] if c.rowcount else summary['skipped']).append(user[0])
+    
+    # Resolve the new user ids with one query, then assign apps set-wise
+    if summary['created']:
+        placeholders = ','.join('?' * len(summary['created']))
+        c.execute(f'SELECT username, id FROM users WHERE username IN ({placeholders})', summary['created'])
+        user_ids = dict(c.fetchall())
+        pairs = [(user_ids[username], app_ids[key])
+                 for username in summary['created'] for key in app_keys_by_username[username]]
+        c.executemany('INSERT OR IGNORE INTO user_apps (user_id, app_id) VALUES (?, ?)', pairs)
+    
     conn.commit()
     conn.close()
+    note_local_write('access')
+    return summary
 
 def get_user_assigned_apps(user_id):
     """Get app IDs assigned to a user"""
@@ -0,0 +1,113 @@
+"""
+Workload module for Blister Pack Scheduler
+Projects how many packs fall due on each day over the coming months and which
+patients they belong to
+
+Standard schedules repeat every N days from the billing date, so their occurrences
+are expanded and counted per day inside SQLite with one recursive aggregate query.
+Custom rules (weekdays, day of month, skip dates) are walked with their compiled
+evaluator, which only touches the few patients that have one.
+"""
+
+import pandas as pd
+from datetime import date, timedelta
+from modules.database import get_read_connection
+from modules.patient_management import to_day_number, from_day_number
+from modules.recurrence import STANDARD_RULES, DEFAULT_RULE, parse_rule, compile_rule
+
+DRILL_DOWN_PAGE_SIZE = 25
+
+def _step_sql():
+    """CASE expression giving the repeat interval in days of a standard schedule"""
+    whens = ' '.join(f"WHEN '{schedule}' THEN {parse_rule(rule)['every']}" for schedule, rule in STANDARD_RULES.items())
+    return f"CASE p.blister_schedule {whens} ELSE {parse_rule(DEFAULT_RULE)['every']} END"
+
+# Active patients driven by an every-N-days schedule (everyone without a custom rule)
+_INTERVAL_PATIENTS = '''
+    FROM patients p
+    LEFT JOIN recurrence_rules r ON r.patient_id = p.id
+    WHERE p.discharged_at IS NULL AND p.billing_day IS NOT NULL
+      AND NOT (p.blister_schedule = 'Custom' AND r.rule IS NOT NULL)
+'''
+
+def _custom_rule_occurrences(conn, start_day, end_day):
+    """(patient_id, name, day) for every custom-rule occurrence within [start_day, end_day]"""
+    c = conn.cursor()
+    c.execute('''
+        SELECT p.id, p.name, p.billing_date, r.rule
+        FROM patients p
+        JOIN recurrence_rules r ON r.patient_id = p.id
+        WHERE p.blister_schedule = 'Custom' AND p.discharged_at IS NULL
+          AND p.billing_day <= ?
+    ''', (end_day,))
+    end = date.fromisoformat(from_day_number(end_day))
+    occurrences = []
+    for patient_id, name, billing_date, rule in c.fetchall():
+        compiled = compile_rule(rule)
+        current = date.fromisoformat(billing_date)
+        while current <= end:
+            day = to_day_number(current)
+            if day >= start_day:
+                occurrences.append((patient_id, name, day))
+            current = compiled.next_after(current)
+    return occurrences
+
+def get_daily_workload(start=None, months=12, use_snapshot=True):
+    """
+    Due-pack counts for every day from start (default: first of this month) for a number of months
+    Returns DataFrame: date, day, due (days without packs have due = 0)
+    """
+    start = start or date.today().replace(day=1)
+    end_month = start.month - 1 + months
+    end = date(start.year + end_month // 12, end_month % 12 + 1, 1) - timedelta(days=1)
+    start_day, end_day = to_day_number(start), to_day_number(end)
+
+    conn = get_read_connection(use_snapshot)
+    counts = pd.read_sql_query(f'''
+        WITH RECURSIVE occurrences(day, step) AS (
+            SELECT p.billing_day, {_step_sql()}
+            {_INTERVAL_PATIENTS} AND p.billing_day <= :end_day
+            UNION ALL
+            SELECT day + step, step FROM occurrences WHERE day + step <= :end_day
+        )
+        SELECT day, COUNT(*) AS due
+        FROM occurrences
+        WHERE day >= :start_day
+        GROUP BY day
+    ''', conn, params={'start_day': start_day, 'end_day': end_day})
+    custom = _custom_rule_occurrences(conn, start_day, end_day)
+    conn.close()
+
+    due = pd.Series(0, index=range(start_day, end_day + 1))
+    due = due.add(counts.set_index('day')['due'], fill_value=0)
+    if custom:
+        due = due.add(pd.Series([day for _, _, day in custom]).value_counts(), fill_value=0)
+    workload = due.astype(int).rename('due').rename_axis('day').reset_index()
+    workload.insert(0, 'date', pd.to_datetime(workload['day'], unit='D'))
+    return workload
+
+def get_patients_due_on(day, page=0, page_size=DRILL_DOWN_PAGE_SIZE, use_snapshot=True):
+    """
+    One page of the patients whose pack falls due on a day (date or 'YYYY-MM-DD')
+    Returns (DataFrame of the page, total number of patients due that day)
+    """
+    day = to_day_number(day)
+    conn = get_read_connection(use_snapshot)
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT p.id, p.name
+        {_INTERVAL_PATIENTS}
+          AND p.billing_day <= :day AND (:day - p.billing_day) % ({_step_sql()}) = 0
+    ''', {'day': day})
+    due = c.fetchall() + [(patient_id, name) for patient_id, name, _ in _custom_rule_occurrences(conn, day, day)]
+    due.sort(key=lambda patient: (patient[1].lower(), patient[0]))
+
+    page_ids = [patient_id for patient_id, _ in due[page * page_size:(page + 1) * page_size]]
+    df = pd.read_sql_query(f'''
+        SELECT id, name, blister_schedule, delivery, insurance, billing_date, next_schedule_date
+        FROM patients
+        WHERE id IN ({','.join('?' * len(page_ids))})
+        ORDER BY name COLLATE NOCASE, id
+    ''', conn, params=page_ids)
+    conn.close()
+    return df, len(due)
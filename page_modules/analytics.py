@@ -0,0 +1,98 @@
+"""
+Analytics page - Cost and cycle trends from the monthly rollups, plus long-range
+reports over the full cycle history
+"""
+import time
+import streamlit as st
+from datetime import datetime
+from modules.analytics import get_monthly_rollups
+from modules.analytics_engine import engine_name, cycles_by_month, schedule_adherence, cost_by_year
+from modules.patient_management import to_day_number
+from modules.ui_components import show_snapshot_caption
+from modules.metrics import timed_page
+
+DIMENSIONS = {"Insurer": "insurer", "Delivery Method": "delivery", "Schedule Type": "schedule_type"}
+MEASURES = {"Cycles": "cycles", "Total Cost": "total_cost", "Patients": "patient_count"}
+REPORT_DIMENSIONS = {"Insurer": "insurance", "Delivery Method": "delivery", "Schedule Type": "blister_schedule"}
+REPORTS = ["Cost by Year", "Schedule Adherence", "Cycles per Month"]
+
+def _show_long_range_reports(start):
+    """Reports over the whole cycle history, run on the analytics engine"""
+    st.markdown("### Long-range Reports")
+    col1, col2 = st.columns(2)
+    with col1:
+        report = st.selectbox("Report", REPORTS)
+    with col2:
+        dimension_label = st.selectbox("Group by", list(REPORT_DIMENSIONS), key="report_dimension",
+                                       disabled=report != "Cycles per Month")
+    
+    started = time.perf_counter()
+    if report == "Cost by Year":
+        df = cost_by_year()
+    elif report == "Schedule Adherence":
+        df = schedule_adherence(to_day_number(start))
+    else:
+        df = cycles_by_month(REPORT_DIMENSIONS[dimension_label], to_day_number(start))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    
+    if df.empty:
+        st.info("No cycle history for this report yet.")
+    elif report == "Cost by Year":
+        st.bar_chart(df.set_index('year')['total_cost'])
+        st.dataframe(df, width="stretch", hide_index=True)
+    elif report == "Schedule Adherence":
+        st.line_chart(df.set_index('month')['on_time_pct'])
+        st.dataframe(df, width="stretch", hide_index=True)
+    else:
+        dimension = REPORT_DIMENSIONS[dimension_label]
+        st.bar_chart(df.pivot_table(index='month', columns=dimension, values='cycles', aggfunc='sum', fill_value=0))
+        st.dataframe(df, width="stretch", hide_index=True)
+    st.caption(f"⚡ {engine_name()} · {elapsed_ms:.0f} ms")
+
+@timed_page
+def show_analytics_page():
+    """Display cycle and cost trends read only from the rollup tables"""
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        months_back = st.selectbox("Period", [3, 6, 12, 24, 60], index=2, format_func=lambda m: f"Last {m} months")
+    with col2:
+        dimension_label = st.selectbox("Break down by", list(DIMENSIONS))
+    with col3:
+        measure_label = st.selectbox("Measure", list(MEASURES))
+    
+    now = datetime.now()
+    start_year, start_month = divmod(now.year * 12 + now.month - 1 - (months_back - 1), 12)
+    rollups_df = get_monthly_rollups(f"{start_year}-{start_month + 1:02d}")
+    
+    if rollups_df.empty:
+        st.info("No cycles recorded in this period yet.")
+        _show_long_range_reports(datetime(start_year, start_month + 1, 1).date())
+        return
+    
+    # Headline numbers for the period
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("🔄 Cycles", int(rollups_df['cycles'].sum()))
+    with col2:
+        st.metric("💰 Total Cost", f"${rollups_df['total_cost'].sum():,.2f}")
+    with col3:
+        cycles = rollups_df['cycles'].sum()
+        st.metric("📦 Avg Cost per Cycle", f"${rollups_df['total_cost'].sum() / cycles:,.2f}" if cycles else "$0.00")
+    
+    dimension = DIMENSIONS[dimension_label]
+    measure = MEASURES[measure_label]
+    trend = rollups_df.pivot_table(index='month', columns=dimension, values=measure, aggfunc='sum', fill_value=0)
+    
+    st.markdown(f"### {measure_label} per Month by {dimension_label}")
+    if measure == 'total_cost':
+        st.line_chart(trend)
+    else:
+        st.bar_chart(trend)
+    
+    st.markdown(f"### {measure_label} by {dimension_label}")
+    totals = rollups_df.groupby(dimension)[['cycles', 'total_cost']].sum().sort_values('cycles', ascending=False)
+    st.dataframe(totals, width="stretch")
+    show_snapshot_caption()
+    
+    _show_long_range_reports(datetime(start_year, start_month + 1, 1).date())
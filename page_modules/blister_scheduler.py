@@ -2,197 +2,369 @@
 Blister Scheduler page - Clean FinPlanner-inspired design
 """
 import streamlit as st
-from datetime import datetime
-from modules.patient_management import get_patients, cycle_patient, get_schedule_history
+import pandas as pd
+import altair as alt
+import calendar
+import html
+from datetime import date, datetime
+from streamlit.errors import StreamlitAPIException
+from modules.patient_management import (
+    get_patients, cycle_patient, get_schedule_history, search_patients,
+    get_due_patients, get_patients_scheduled_between, get_schedule_counts, to_day_number
+)
+from modules.ui_components import show_snapshot_caption
+from modules.metrics import timed_page
+from modules.notifications import start_reminder_run, get_reminder_run
+from modules.workload import get_daily_workload, get_patients_due_on, DRILL_DOWN_PAGE_SIZE
+from modules.change_feed import latest_seq
+from modules.render_cache import RenderCache
 
-def show_blister_scheduler_page():
-    """Display the blister scheduler page"""
+# How often live widgets check the change feed (an in-memory comparison, no query)
+LIVE_REFRESH_SECONDS = 3
+
+# Rendered output shared across sessions, keyed on what it shows and the data version
+CALENDAR_HTML = RenderCache('calendar_html', maxsize=48)
+DUE_CARDS = RenderCache('due_cards', maxsize=8)
+
+DAY_CELL_STYLE = "border-radius: 6px; padding: 8px; min-height: 80px;"
+PATIENT_BADGE_STYLE = ("background-color: #10B981; color: white; font-size: 0.7rem; padding: 2px 4px; border-radius: 4px; "
+                       "margin-bottom: 2px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;")
+
+def _patient_label(row):
+    """Label that tells apart patients who share a name"""
+    details = [f"#{row['id']}", f"billing {row['billing_date']}"]
+    if pd.notna(row['insurance']) and row['insurance']:
+        details.append(row['insurance'])
+    return f"{row['name']} ({' · '.join(details)})"
+
+def _handle_cycle_result(result, patient_name, notice_key):
+    """Queue a success or conflict notice for the fragment's next run"""
+    if result.success:
+        st.session_state[notice_key] = ('success', f"✅ Cycled {patient_name}!")
+    elif result.version is None:
+        st.session_state[notice_key] = ('warning', f"⚠️ {patient_name} no longer exists.")
+    else:
+        st.session_state[notice_key] = (
+            'warning',
+            f"⚠️ {patient_name} was changed by someone else before your cycle was saved. "
+            "The list has been refreshed; check the dates and try again if needed."
+        )
+
+@st.fragment
+def _show_year_overview():
+    """Heatmap of due packs per day for the next 12 months, with a drill-down into one day"""
+    workload = get_daily_workload()
+    start = workload['date'].iloc[0]
+    # GitHub-style grid: one column per week, one row per weekday
+    workload['week'] = (workload['date'] - pd.to_timedelta(workload['date'].dt.weekday, unit='D') -
+                        (start - pd.Timedelta(days=start.weekday()))).dt.days // 7
+    workload['weekday'] = workload['date'].dt.strftime('%a')
+    workload['day_label'] = workload['date'].dt.strftime('%Y-%m-%d')
     
-    # Fetch data
-    patients_df = get_patients()
-    today = datetime.now().strftime('%Y-%m-%d')
-    history_df = get_schedule_history()
+    busiest = workload.loc[workload['due'].idxmax()]
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Packs Due (12 months)", int(workload['due'].sum()))
+    col2.metric("Busiest Day", busiest['day_label'], f"{int(busiest['due'])} packs", delta_color="off")
+    col3.metric("Average per Working Day", round(workload.loc[workload['date'].dt.weekday < 5, 'due'].mean(), 1))
     
-    # Statistics cards
+    selected_day = alt.selection_point(name="day", fields=['day_label'])
+    chart = alt.Chart(workload).mark_rect(stroke='#111827', strokeWidth=1).encode(
+        x=alt.X('week:O', title=None, axis=None),
+        y=alt.Y('weekday:O', title=None, sort=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']),
+        color=alt.Color('due:Q', title='Packs due', scale=alt.Scale(scheme='greens')),
+        tooltip=[alt.Tooltip('day_label:N', title='Date'), alt.Tooltip('due:Q', title='Packs due')],
+    ).add_params(selected_day).properties(height=220)
+    event = st.altair_chart(chart, on_select="rerun", key="workload_heatmap", width="stretch")
+    show_snapshot_caption()
+    
+    selection = event.selection.get('day') if event else None
+    if not selection:
+        st.caption("Click a day to see which patients are due.")
+        return
+    
+    day_label = selection[0]['day_label']
+    page = st.session_state.get(f"workload_page_{day_label}", 1)
+    page_df, total = get_patients_due_on(day_label, page=page - 1)
+    st.markdown(f"#### {total} patient(s) due on {day_label}")
+    if total:
+        st.dataframe(page_df, width="stretch", hide_index=True)
+        pages = -(-total // DRILL_DOWN_PAGE_SIZE)
+        if pages > 1:
+            st.number_input("Page", min_value=1, max_value=pages, step=1, key=f"workload_page_{day_label}")
+            st.caption(f"Page {page} of {pages}")
+
+def _calendar_html(year, month, today):
+    """The month grid (weekday header and day cells with the patients due) as one HTML block"""
+    month_start = date(year, month, 1)
+    month_end = month_start.replace(day=calendar.monthrange(year, month)[1])
+    patients = get_patients_scheduled_between(month_start, month_end)
+    names_by_day = patients.groupby('next_schedule_day')['name'].apply(list).to_dict()
+    month_start_day = to_day_number(month_start)
+    
+    cells = [f"<div style='text-align: center; font-weight: bold; color: #9CA3AF;'>{day}</div>"
+             for day in ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']]
+    for week in calendar.monthcalendar(year, month):
+        for day in week:
+            if day == 0:
+                cells.append("<div style='min-height: 80px;'></div>")
+                continue
+            # Style for today
+            is_today = date(year, month, day) == today
+            bg_color = "#374151" if is_today else "#1F2937"
+            border_color = "#10B981" if is_today else "#374151"
+            badges = ''.join(
+                f'<div style="{PATIENT_BADGE_STYLE}" title="{html.escape(name)}">{html.escape(name)}</div>'
+                for name in names_by_day.get(month_start_day + day - 1, [])
+            )
+            cells.append(f'<div style="background-color: {bg_color}; border: 1px solid {border_color}; {DAY_CELL_STYLE}">'
+                         f'<div style="text-align: right; color: #9CA3AF; font-size: 0.8rem; margin-bottom: 4px;">{day}</div>'
+                         f'{badges}</div>')
+    return ("<div style='display: grid; grid-template-columns: repeat(7, minmax(0, 1fr)); gap: 8px;'>"
+            + ''.join(cells) + "</div>")
+
+def _due_cards():
+    """(id, version, name, card HTML) for every patient due today"""
+    return tuple(
+        (row['id'], row['version'], row['name'],
+         f"""<div style="background: #1F2937; padding: 1rem; border-radius: 6px; border: 1px solid #374151; margin-bottom: 0.5rem;">
+                <div style="color: #F9FAFB; font-weight: 600; margin-bottom: 0.3rem;">{html.escape(row['name'])}</div>
+                <div style="color: #9CA3AF; font-size: 0.85rem;">Billing: {row['billing_date']} | Next: {row['next_schedule_date']}</div>
+            </div>""")
+        for _, row in get_due_patients().iterrows()
+    )
+
+def _feed_cached(cache_key, loader):
+    """Result of loader(), re-read only when the change feed (or the date) has moved since it was cached"""
+    version = (latest_seq(), date.today())
+    cached = st.session_state.get(cache_key)
+    if cached is None or cached[0] != version:
+        cached = (version, loader())
+        st.session_state[cache_key] = cached
+    return cached[1]
+
+def _rerun_fragment():
+    """Rerun only the calling fragment (or the whole page when the fragment is running as part of it)"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+def _show_notice(notice_key):
+    """Show the outcome of an action taken on this fragment's previous run"""
+    if notice_key in st.session_state:
+        level, message = st.session_state.pop(notice_key)
+        getattr(st, level)(message)
+
+# Fragments: each one reruns on its own when its widgets are used, so a month change
+# only redraws the calendar and a cycle only the due list. Widgets that show live data
+# also poll the change feed and redraw themselves when anyone writes.
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def _metrics_row():
+    """Statistics cards"""
+    counts = _feed_cached('counts_cache', get_schedule_counts)
     col1, col2, col3, col4 = st.columns(4)
     
     with col1:
-        total_patients = len(patients_df) if not patients_df.empty else 0
-        st.metric("Total Patients", total_patients)
+        st.metric("Total Patients", counts['total'])
     
     with col2:
-        due_count = len(patients_df[patients_df['billing_date'] <= today]) if not patients_df.empty else 0
-        st.metric("Due Today", due_count)
+        st.metric("Due Today", counts['due'])
     
     with col3:
-        upcoming_count = len(patients_df[patients_df['next_schedule_date'] > today]) if not patients_df.empty else 0
-        st.metric("Upcoming", upcoming_count)
+        st.metric("Upcoming", counts['upcoming'])
     
     with col4:
-        history_count = len(history_df) if not history_df.empty else 0
-        st.metric("Total Cycles", history_count)
+        st.metric("Total Cycles", counts['cycles'])
+
+@st.fragment
+def _reminders():
+    """Send Reminders button and the outcome of the last run"""
+    # Reminders go out on a background thread so the page never waits on SMTP/HTTP
+    col_rem1, col_rem2 = st.columns([1, 3])
+    reminder_run = get_reminder_run()
+    with col_rem1:
+        if st.button("📨 Send Reminders", key="send_reminders", disabled=reminder_run['running']):
+            start_reminder_run()
+            reminder_run = get_reminder_run()
+    with col_rem2:
+        if reminder_run['running']:
+            st.caption("Sending reminders in the background...")
+        elif reminder_run['summary']:
+            summary = reminder_run['summary']
+            if 'error' in summary:
+                st.caption(f"Last reminder run failed: {summary['error']}")
+            else:
+                st.caption(f"Last run {summary['started_at']}: {summary['sent']} sent, {summary['failed']} failed, "
+                           f"{summary['skipped_duplicates']} already sent ({summary['duration_seconds']}s)")
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def _actions_required():
+    """Patients due now and the active patient list"""
+    _show_notice('actions_notice')
+    due_cards = DUE_CARDS.get_or_render((date.today(), latest_seq()), _due_cards)
     
-    st.markdown("")
+    if due_cards:
+        for patient_id, version, name, card_html in due_cards:
+            with st.container():
+                st.markdown(card_html, unsafe_allow_html=True)
+                if st.button("Start Cycle", key=f"cycle_{patient_id}", type="primary"):
+                    result = cycle_patient(patient_id, version, user_id=st.session_state.user_id)
+                    _handle_cycle_result(result, name, 'actions_notice')
+                    _rerun_fragment()
+    else:
+        st.success("✅ All clear! No actions required.")
     
-    # Tabs for different sections
-    tab1, tab2, tab3, tab4 = st.tabs(["📋 Actions Required", "📅 Schedule Calendar", "🔄 Manual Cycle", "📊 Recent History"])
+    st.markdown("")
+    st.markdown("### Active Patients")
     
-    with tab1:
-        st.markdown("### Actions Required")
+    patients_df = _feed_cached('active_patients_cache', get_patients)
+    if not patients_df.empty:
+        st.dataframe(
+            patients_df[['name', 'billing_date', 'next_schedule_date']],
+            width="stretch",
+            hide_index=True
+        )
+    else:
+        st.info("No patients yet.")
+
+@st.fragment
+def _schedule_calendar():
+    """Month calendar of next schedule dates"""
+    # Calendar controls
+    if 'cal_year' not in st.session_state:
+        st.session_state.cal_year = datetime.now().year
+    if 'cal_month' not in st.session_state:
+        st.session_state.cal_month = datetime.now().month
         
-        if not patients_df.empty:
-            due_patients = patients_df[patients_df['billing_date'] <= today]
+    col_cal1, col_cal2, col_cal3 = st.columns([1, 5, 1])
+    with col_cal1:
+        if st.button("◀ Prev", key="prev_month"):
+            if st.session_state.cal_month == 1:
+                st.session_state.cal_month = 12
+                st.session_state.cal_year -= 1
+            else:
+                st.session_state.cal_month -= 1
+            _rerun_fragment()
             
-            if not due_patients.empty:
-                for index, row in due_patients.iterrows():
-                    with st.container():
-                        st.markdown(f"""<div style="background: #1F2937; padding: 1rem; border-radius: 6px; border: 1px solid #374151; margin-bottom: 0.5rem;">
-                                <div style="color: #F9FAFB; font-weight: 600; margin-bottom: 0.3rem;">{row['name']}</div>
-                                <div style="color: #9CA3AF; font-size: 0.85rem;">Billing: {row['billing_date']} | Next: {row['next_schedule_date']}</div>
-                            </div>""", unsafe_allow_html=True)
-                        if st.button("Start Cycle", key=f"cycle_{row['id']}", type="primary"):
-                            cycle_patient(row['id'], row['name'], row['billing_date'], row['next_schedule_date'])
-                            st.success(f"✅ Cycled {row['name']}!")
-                            st.rerun()
+    with col_cal2:
+        month_name = datetime(st.session_state.cal_year, st.session_state.cal_month, 1).strftime("%B %Y")
+        st.markdown(f"<h3 style='text-align: center; margin: 0;'>{month_name}</h3>", unsafe_allow_html=True)
+        
+    with col_cal3:
+        if st.button("Next ▶", key="next_month"):
+            if st.session_state.cal_month == 12:
+                st.session_state.cal_month = 1
+                st.session_state.cal_year += 1
             else:
-                st.success("✅ All clear! No actions required.")
-        else:
-            st.info("No patients found.")
+                st.session_state.cal_month += 1
+            _rerun_fragment()
+    
+    st.markdown("")
+    
+    # Calendar Grid: one HTML block shared by every session viewing the same month and data
+    year, month, today = st.session_state.cal_year, st.session_state.cal_month, date.today()
+    grid_html = CALENDAR_HTML.get_or_render((year, month, today, latest_seq()),
+                                            lambda: _calendar_html(year, month, today))
+    st.markdown(grid_html, unsafe_allow_html=True)
+
+@st.fragment
+def _manual_cycle():
+    """Cycle a searched-for patient with a chosen billing date"""
+    _show_notice('manual_cycle_notice')
+    if _feed_cached('counts_cache', get_schedule_counts)['total']:
+        col_man1, col_man2, col_man3 = st.columns([2, 2, 1])
         
-        st.markdown("")
-        st.markdown("### Active Patients")
+        with col_man1:
+            search_prefix = st.text_input(
+                "Search Patient",
+                placeholder="Type the start of a name...",
+                key="manual_patient_search"
+            )
+            matches = search_patients(search_prefix, limit=20)
+            labels = {row['id']: _patient_label(row) for _, row in matches.iterrows()}
+            picked = {row['id']: (row['name'], row['version']) for _, row in matches.iterrows()}
+            selected_patient_id = st.selectbox(
+                "Select Patient", 
+                options=list(labels.keys()),
+                format_func=labels.get,
+                key="manual_patient_select"
+            )
         
-        if not patients_df.empty:
-            st.dataframe(
-                patients_df[['name', 'billing_date', 'next_schedule_date']],
-                width="stretch",
-                hide_index=True
+        with col_man2:
+            manual_date = st.date_input(
+                "New Billing Date",
+                value=datetime.now(),
+                key="manual_billing_date"
             )
-        else:
-            st.info("No patients yet.")
+            
+        with col_man3:
+            st.write("") # Spacing
+            st.write("") # Spacing
+            # The button key carries the version on screen: once the patient changes (this
+            # cycle, or someone else's), a click made on the old screen matches no button
+            patient_name, patient_version = picked.get(selected_patient_id, (None, None))
+            if st.button("Start Cycle", type="primary", key=f"manual_start_btn_{selected_patient_id}_{patient_version}",
+                         width="stretch", disabled=selected_patient_id is None):
+                result = cycle_patient(
+                    selected_patient_id,
+                    patient_version,
+                    manual_billing_date=manual_date.strftime('%Y-%m-%d'),
+                    user_id=st.session_state.user_id
+                )
+                _handle_cycle_result(result, patient_name, 'manual_cycle_notice')
+                _rerun_fragment()
+    else:
+        st.info("No patients available.")
+
+@st.fragment
+def _recent_history():
+    """Latest cycles from the report snapshot"""
+    recent = get_schedule_history(use_snapshot=True, limit=10)
+    
+    if not recent.empty:
+        st.dataframe(
+            recent[['patient_name', 'previous_billing_date', 'new_billing_date', 'cycled_at', 'cycled_by_name']],
+            width="stretch",
+            hide_index=True
+        )
+        total_cycles = _feed_cached('counts_cache', get_schedule_counts)['cycles']
+        if total_cycles > 10:
+            st.caption(f"Showing 10 of {total_cycles} total cycles")
+        show_snapshot_caption()
+    else:
+        st.info("No history yet.")
+
+@timed_page
+def show_blister_scheduler_page():
+    """Display the blister scheduler page"""
+    
+    # Statistics cards
+    _metrics_row()
+    
+    st.markdown("")
+    
+    # Tabs for different sections
+    tab1, tab2, tab_year, tab3, tab4 = st.tabs(["📋 Actions Required", "📅 Schedule Calendar", "🗓️ Year Overview",
+                                                "🔄 Manual Cycle", "📊 Recent History"])
+    
+    with tab1:
+        st.markdown("### Actions Required")
+        _reminders()
+        _actions_required()
     
     with tab2:
         st.markdown("### 📅 Schedule Calendar")
-        
-        # Calendar controls
-        if 'cal_year' not in st.session_state:
-            st.session_state.cal_year = datetime.now().year
-        if 'cal_month' not in st.session_state:
-            st.session_state.cal_month = datetime.now().month
-            
-        col_cal1, col_cal2, col_cal3 = st.columns([1, 5, 1])
-        with col_cal1:
-            if st.button("◀ Prev", key="prev_month"):
-                if st.session_state.cal_month == 1:
-                    st.session_state.cal_month = 12
-                    st.session_state.cal_year -= 1
-                else:
-                    st.session_state.cal_month -= 1
-                st.rerun()
-                
-        with col_cal2:
-            month_name = datetime(st.session_state.cal_year, st.session_state.cal_month, 1).strftime("%B %Y")
-            st.markdown(f"<h3 style='text-align: center; margin: 0;'>{month_name}</h3>", unsafe_allow_html=True)
-            
-        with col_cal3:
-            if st.button("Next ▶", key="next_month"):
-                if st.session_state.cal_month == 12:
-                    st.session_state.cal_month = 1
-                    st.session_state.cal_year += 1
-                else:
-                    st.session_state.cal_month += 1
-                st.rerun()
-        
-        st.markdown("")
-        
-        # Calendar Grid
-        import calendar
-        cal = calendar.monthcalendar(st.session_state.cal_year, st.session_state.cal_month)
-        
-        # Days header
-        cols = st.columns(7)
-        days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
-        for idx, day in enumerate(days):
-            cols[idx].markdown(f"<div style='text-align: center; font-weight: bold; color: #9CA3AF;'>{day}</div>", unsafe_allow_html=True)
-        
-        # Calendar days
-        for week in cal:
-            cols = st.columns(7)
-            for idx, day in enumerate(week):
-                with cols[idx]:
-                    if day != 0:
-                        # Check for patients due on this day
-                        date_str = f"{st.session_state.cal_year}-{st.session_state.cal_month:02d}-{day:02d}"
-                        due_on_day = patients_df[patients_df['next_schedule_date'] == date_str]
-                        
-                        # Style for today
-                        is_today = date_str == datetime.now().strftime('%Y-%m-%d')
-                        bg_color = "#374151" if is_today else "#1F2937"
-                        border_color = "#10B981" if is_today else "#374151"
-                        
-                        # Create day cell
-                        html_content = f"""<div style="background-color: {bg_color}; border: 1px solid {border_color}; border-radius: 6px; padding: 8px; min-height: 80px; margin-bottom: 8px;">
-                        <div style="text-align: right; color: #9CA3AF; font-size: 0.8rem; margin-bottom: 4px;">{day}</div>"""
-                        
-                        if not due_on_day.empty:
-                            for _, p in due_on_day.iterrows():
-                                html_content += f"""<div style="background-color: #10B981; color: white; font-size: 0.7rem; padding: 2px 4px; border-radius: 4px; margin-bottom: 2px; white-space: nowrap; overflow: hidden; text-overflow: ellipsis;" title="{p['name']}">{p['name']}</div>"""
-                        
-                        html_content += "</div>"
-                        st.markdown(html_content, unsafe_allow_html=True)
-                    else:
-                        st.markdown("<div style='min-height: 80px;'></div>", unsafe_allow_html=True)
+        _schedule_calendar()
+    
+    with tab_year:
+        st.markdown("### 🗓️ Year Overview")
+        _show_year_overview()
     
     with tab3:
         st.markdown("### 🔄 Manual Cycle Start")
         st.markdown("Select a patient to manually start a new cycle with a custom billing date.")
-        
-        if not patients_df.empty:
-            col_man1, col_man2, col_man3 = st.columns([2, 2, 1])
-            
-            with col_man1:
-                selected_patient_name = st.selectbox(
-                    "Select Patient", 
-                    options=patients_df['name'].tolist(),
-                    key="manual_patient_select"
-                )
-            
-            with col_man2:
-                manual_date = st.date_input(
-                    "New Billing Date",
-                    value=datetime.now(),
-                    key="manual_billing_date"
-                )
-                
-            with col_man3:
-                st.write("") # Spacing
-                st.write("") # Spacing
-                if st.button("Start Cycle", type="primary", key="manual_start_btn", width="stretch"):
-                    # Get patient details
-                    patient_row = patients_df[patients_df['name'] == selected_patient_name].iloc[0]
-                    cycle_patient(
-                        patient_row['id'], 
-                        patient_row['name'], 
-                        patient_row['billing_date'], 
-                        patient_row['next_schedule_date'],
-                        manual_billing_date=manual_date.strftime('%Y-%m-%d')
-                    )
-                    st.success(f"✅ Manually cycled {selected_patient_name}!")
-                    st.rerun()
-        else:
-            st.info("No patients available.")
+        _manual_cycle()
     
     with tab4:
         st.markdown("### 📊 Recent Schedule History")
-        
-        if not history_df.empty:
-            recent = history_df.head(10)
-            st.dataframe(
-                recent[['patient_name', 'previous_billing_date', 'new_billing_date', 'cycled_at']],
-                width="stretch",
-                hide_index=True
-            )
-            if len(history_df) > 10:
-                st.caption(f"Showing 10 of {len(history_df)} total cycles")
-        else:
-            st.info("No history yet.")
+        _recent_history()
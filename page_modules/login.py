@@ -4,7 +4,9 @@ Login page for Blister Pack Scheduler
 
 import streamlit as st
 from modules.auth import authenticate_user
+from modules.metrics import timed_page, LOGINS, FAILED_LOGINS
 
+@timed_page
 def show_login_page():
     """Display the login page"""
     # Center the title and description
@@ -24,6 +26,7 @@ def show_login_page():
             if submit:
                 user = authenticate_user(username, password)
                 if user:
+                    LOGINS.inc()
                     st.session_state.logged_in = True
                     st.session_state.user_id = user[0]
                     st.session_state.username = user[1]
@@ -32,6 +35,7 @@ def show_login_page():
                     st.success(f"Welcome, {user[2]}!")
                     st.rerun()
                 else:
+                    FAILED_LOGINS.inc()
                     st.error("Invalid username or password")
         
         st.info("**Default credentials:** Username: `admin` | Password: `admin123`")
@@ -3,13 +3,27 @@ Patient Management page - Full CRUD operations for patients with modern design
 """
 import streamlit as st
 import pandas as pd
-from modules.patient_management import get_patients, add_patient, update_patient, delete_patient
+from modules.patient_management import (
+    get_patients, add_patient, update_patient, delete_patient, validate_custom_rule,
+    delete_patients, discharge_patients, readmit_patient, get_discharged_patients,
+    get_patient, merge_patients, update_patients
+)
+from modules.dedupe import find_duplicates, DEFAULT_THRESHOLD
+from modules.business_calendar import get_locations
+from modules.metrics import timed_page
 
+RULE_HELP = "For Custom schedules, e.g. every=10, weekdays=MON,THU or monthday=15. Add ;skip=YYYY-MM-DD,... to skip dates."
+DELIVERY_OPTIONS = ["", "Home Delivery", "Pickup", "Mail", "Other"]
+SCHEDULE_OPTIONS = ["", "Weekly", "Bi-weekly", "Monthly", "Custom"]
+GRID_COLUMNS = ['name', 'delivery', 'insurance', 'cost', 'blister_schedule', 'billing_date', 'custom_rule', 'email']
+
+@timed_page
 def show_patient_management_page():
     """Display the patient management page with modern Airtable-inspired styling"""
     
     # Fetch patients
     patients_df = get_patients()
+    location_names = {location['id']: location['name'] for location in get_locations()}
     # Statistics with modern design
     st.markdown("## Patient Statistics")
     col1, col2, col3 = st.columns(3)
@@ -23,7 +37,7 @@ def show_patient_management_page():
         st.metric("💰 Avg Cost", f"${avg_cost:.2f}")
     
     # Tabs
-    tab1, tab2 = st.tabs(["📋 All Patients", "➕ Add New Patient"])
+    tab1, tab2, tab3, tab4 = st.tabs(["📋 All Patients", "➕ Add New Patient", "📤 Discharged", "👥 Duplicates"])
     
     with tab1:
         st.markdown("### Manage Patients")
@@ -38,71 +52,126 @@ def show_patient_management_page():
                 filtered_df = patients_df
             
             st.caption(f"Showing {len(filtered_df)} of {len(patients_df)} patients")
-            # Display patients in modern expanders
-            for index, patient in filtered_df.iterrows():
-                with st.expander(f"👤 **{patient['name']}** - Next: {patient['next_schedule_date']}", expanded=False):
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        st.markdown("**📦 Delivery**")
-                        st.write(patient.get('delivery', 'N/A'))
-                        st.markdown("**🏥 Insurance**")
-                        st.write(patient.get('insurance', 'N/A'))
-                        st.markdown("**💰 Cost**")
-                        st.write(f"${patient.get('cost', 0.0):.2f}" if patient.get('cost') else "N/A")
-                    
-                    with col2:
-                        st.markdown("**📋 Blister Schedule**")
-                        st.write(patient.get('blister_schedule', 'N/A'))
-                        st.markdown("**📅 Billing Date**")
-                        st.write(patient['billing_date'])
-                        st.markdown("**🔄 Next Schedule**")
-                        st.write(patient['next_schedule_date'])
-                    
-                    st.markdown("**Edit Patient**")
-                    
-                    with st.form(key=f"edit_form_{patient['id']}"):
-                        col_a, col_b = st.columns(2)
+            
+            # Bulk removal of the patients currently shown
+            with st.expander("🧹 Bulk discharge / delete"):
+                labels = {row['id']: f"{row['name']} (#{row['id']})" for _, row in filtered_df.iterrows()}
+                select_all = st.checkbox(f"Select all {len(labels)} shown patients", key="bulk_select_all")
+                bulk_ids = list(labels) if select_all else st.multiselect(
+                    "Patients", options=list(labels), format_func=labels.get, key="bulk_patient_ids")
+                bulk_mode = st.radio("Action", ["Discharge (keep history)", "Delete permanently"],
+                                     horizontal=True, key="bulk_mode")
+                confirm_bulk = st.checkbox("I have checked this list", key="bulk_confirm")
+                if st.button(f"Apply to {len(bulk_ids)} patient(s)", type="primary",
+                             disabled=not (bulk_ids and confirm_bulk)):
+                    if bulk_mode.startswith("Discharge"):
+                        count = discharge_patients(bulk_ids)
+                        st.success(f"✅ Discharged {count} patient(s)")
+                    else:
+                        count = delete_patients(bulk_ids)
+                        st.success(f"✅ Deleted {count} patient(s)")
+                    st.rerun()
+            
+            grid_mode = st.toggle("✏️ Grid editor", key="patient_grid_mode",
+                                  help="Edit many patients at once and save them together")
+            if grid_mode:
+                _show_grid_editor(filtered_df, location_names)
+            else:
+                # Display patients in modern expanders
+                for index, patient in filtered_df.iterrows():
+                    with st.expander(f"👤 **{patient['name']}** - Next: {patient['next_schedule_date']}", expanded=False):
+                        col1, col2 = st.columns(2)
                         
-                        with col_a:
-                            edit_name = st.text_input("Patient Name", value=patient['name'], key=f"name_{patient['id']}")
-                            edit_delivery = st.selectbox("Delivery", 
-                                                        ["", "Home Delivery", "Pickup", "Mail", "Other"],
-                                                        index=["", "Home Delivery", "Pickup", "Mail", "Other"].index(patient.get('delivery', '')) if patient.get('delivery') in ["", "Home Delivery", "Pickup", "Mail", "Other"] else 0,
-                                                        key=f"delivery_{patient['id']}")
-                            edit_insurance = st.text_input("Insurance", value=patient.get('insurance', ''), key=f"insurance_{patient['id']}")
+                        with col1:
+                            st.markdown("**📦 Delivery**")
+                            st.write(patient.get('delivery', 'N/A'))
+                            st.markdown("**🏥 Insurance**")
+                            st.write(patient.get('insurance', 'N/A'))
+                            st.markdown("**💰 Cost**")
+                            st.write(f"${patient.get('cost', 0.0):.2f}" if patient.get('cost') else "N/A")
                         
-                        with col_b:
-                            edit_cost = st.number_input("Cost ($)", value=float(patient.get('cost', 0.0)) if patient.get('cost') else 0.0, 
-                                                       min_value=0.0, step=0.01, key=f"cost_{patient['id']}")
-                            edit_blister_schedule = st.selectbox("Blister Schedule",
-                                                                ["", "Weekly", "Bi-weekly", "Monthly", "Custom"],
-                                                                index=["", "Weekly", "Bi-weekly", "Monthly", "Custom"].index(patient.get('blister_schedule', '')) if patient.get('blister_schedule') in ["", "Weekly", "Bi-weekly", "Monthly", "Custom"] else 0,
-                                                                key=f"schedule_{patient['id']}")
-                            edit_billing_date = st.date_input("Billing Date", 
-                                                              value=pd.to_datetime(patient['billing_date']).date() if patient['billing_date'] else None,
-                                                              key=f"billing_{patient['id']}")
+                        with col2:
+                            st.markdown("**📋 Blister Schedule**")
+                            st.write(patient.get('blister_schedule', 'N/A'))
+                            if pd.notna(patient.get('custom_rule')):
+                                st.caption(f"Rule: {patient['custom_rule']}")
+                            st.markdown("**📅 Billing Date**")
+                            st.write(patient['billing_date'])
+                            st.markdown("**🔄 Next Schedule**")
+                            st.write(patient['next_schedule_date'])
                         
-                        col_btn1, col_btn2 = st.columns(2)
-                        with col_btn1:
-                            if st.form_submit_button("💾 Update Patient", type="primary", width="stretch"):
-                                update_patient(
-                                    patient['id'],
-                                    edit_name,
-                                    edit_delivery if edit_delivery else None,
-                                    edit_insurance if edit_insurance else None,
-                                    edit_cost if edit_cost > 0 else None,
-                                    edit_blister_schedule if edit_blister_schedule else None,
-                                    edit_billing_date.strftime('%Y-%m-%d')
-                                )
-                                st.success(f"✅ Updated {edit_name}!")
-                                st.rerun()
+                        st.markdown("**Edit Patient**")
                         
-                        with col_btn2:
-                            if st.form_submit_button("🗑️ Delete Patient", type="secondary", width="stretch"):
-                                delete_patient(patient['id'])
-                                st.success(f"✅ Deleted {patient['name']}!")
-                                st.rerun()
+                        with st.form(key=f"edit_form_{patient['id']}"):
+                            col_a, col_b = st.columns(2)
+                            
+                            with col_a:
+                                edit_name = st.text_input("Patient Name", value=patient['name'], key=f"name_{patient['id']}")
+                                edit_delivery = st.selectbox("Delivery", 
+                                                            ["", "Home Delivery", "Pickup", "Mail", "Other"],
+                                                            index=["", "Home Delivery", "Pickup", "Mail", "Other"].index(patient.get('delivery', '')) if patient.get('delivery') in ["", "Home Delivery", "Pickup", "Mail", "Other"] else 0,
+                                                            key=f"delivery_{patient['id']}")
+                                edit_insurance = st.text_input("Insurance", value=patient.get('insurance', ''), key=f"insurance_{patient['id']}")
+                                edit_email = st.text_input("Reminder Email", value=patient['email'] if pd.notna(patient.get('email')) else '',
+                                                           key=f"email_{patient['id']}")
+                                edit_location = int(patient['location_id']) if pd.notna(patient.get('location_id')) else None
+                                if len(location_names) > 1:
+                                    location_ids = list(location_names)
+                                    edit_location = st.selectbox("Location", location_ids, format_func=location_names.get,
+                                                                 index=location_ids.index(edit_location) if edit_location in location_names else 0,
+                                                                 key=f"location_{patient['id']}")
+                            
+                            with col_b:
+                                edit_cost = st.number_input("Cost ($)", value=float(patient.get('cost', 0.0)) if patient.get('cost') else 0.0, 
+                                                           min_value=0.0, step=0.01, key=f"cost_{patient['id']}")
+                                edit_blister_schedule = st.selectbox("Blister Schedule",
+                                                                    ["", "Weekly", "Bi-weekly", "Monthly", "Custom"],
+                                                                    index=["", "Weekly", "Bi-weekly", "Monthly", "Custom"].index(patient.get('blister_schedule', '')) if patient.get('blister_schedule') in ["", "Weekly", "Bi-weekly", "Monthly", "Custom"] else 0,
+                                                                    key=f"schedule_{patient['id']}")
+                                edit_billing_date = st.date_input("Billing Date", 
+                                                                  value=pd.to_datetime(patient['billing_date']).date() if patient['billing_date'] else None,
+                                                                  key=f"billing_{patient['id']}")
+                                edit_custom_rule = st.text_input("Custom Rule", value=patient['custom_rule'] if pd.notna(patient.get('custom_rule')) else '',
+                                                                 help=RULE_HELP, key=f"rule_{patient['id']}")
+                            
+                            col_btn1, col_btn2, col_btn3 = st.columns(3)
+                            with col_btn1:
+                                if st.form_submit_button("💾 Update Patient", type="primary", width="stretch"):
+                                    rule_error = validate_custom_rule(edit_blister_schedule, edit_custom_rule)
+                                    if rule_error:
+                                        st.error(f"❌ {rule_error}")
+                                    else:
+                                        result = update_patient(
+                                            patient['id'],
+                                            edit_name,
+                                            edit_delivery if edit_delivery else None,
+                                            edit_insurance if edit_insurance else None,
+                                            edit_cost if edit_cost > 0 else None,
+                                            edit_blister_schedule if edit_blister_schedule else None,
+                                            edit_billing_date.strftime('%Y-%m-%d'),
+                                            custom_rule=edit_custom_rule or None,
+                                            expected_version=patient['version'],
+                                            email=edit_email.strip() or None,
+                                            location_id=edit_location
+                                        )
+                                        if result.success:
+                                            st.success(f"✅ Updated {edit_name}!")
+                                            st.rerun()
+                                        else:
+                                            st.warning(f"⚠️ {patient['name']} was changed by someone else. "
+                                                       "Reload the page to see the latest details before editing.")
+                            
+                            with col_btn2:
+                                if st.form_submit_button("📤 Discharge", type="secondary", width="stretch"):
+                                    discharge_patients([patient['id']])
+                                    st.success(f"✅ Discharged {patient['name']}!")
+                                    st.rerun()
+                            
+                            with col_btn3:
+                                if st.form_submit_button("🗑️ Delete Patient", type="secondary", width="stretch"):
+                                    delete_patient(patient['id'])
+                                    st.success(f"✅ Deleted {patient['name']}!")
+                                    st.rerun()
         else:
             st.info("📝 No patients found. Add your first patient using the 'Add New Patient' tab!")
     
@@ -117,12 +186,17 @@ def show_patient_management_page():
                 new_name = st.text_input("Patient Name *", placeholder="e.g., John Doe")
                 new_delivery = st.selectbox("Delivery Method", ["", "Home Delivery", "Pickup", "Mail", "Other"])
                 new_insurance = st.text_input("Insurance Provider", placeholder="e.g., Blue Cross, Medicare")
+                new_email = st.text_input("Reminder Email", placeholder="e.g., jane@example.com")
+                new_location = None
+                if len(location_names) > 1:
+                    new_location = st.selectbox("Location", list(location_names), format_func=location_names.get)
             
             with col2:
                 st.markdown("**Schedule & Billing**")
                 new_cost = st.number_input("Medication Cost ($)", min_value=0.0, step=0.01, value=0.0)
                 new_blister_schedule = st.selectbox("Blister Schedule", ["", "Weekly", "Bi-weekly", "Monthly", "Custom"])
                 new_billing_date = st.date_input("Billing Date *")
+                new_custom_rule = st.text_input("Custom Rule", placeholder="e.g., every=10", help=RULE_HELP)
             
             st.divider()
             
@@ -130,14 +204,20 @@ def show_patient_management_page():
             
             with col_submit1:
                 if st.form_submit_button("➕ Add Patient", type="primary", width="stretch"):
-                    if new_name and new_billing_date:
+                    rule_error = validate_custom_rule(new_blister_schedule, new_custom_rule)
+                    if new_name and new_billing_date and rule_error:
+                        st.error(f"❌ {rule_error}")
+                    elif new_name and new_billing_date:
                         add_patient(
                             new_name,
                             new_billing_date.strftime('%Y-%m-%d'),
                             new_delivery if new_delivery else None,
                             new_insurance if new_insurance else None,
                             new_cost if new_cost > 0 else None,
-                            new_blister_schedule if new_blister_schedule else None
+                            new_blister_schedule if new_blister_schedule else None,
+                            custom_rule=new_custom_rule or None,
+                            email=new_email.strip() or None,
+                            location_id=new_location
                         )
                         st.success(f"✅ Successfully added {new_name}!")
                         st.rerun()
@@ -147,4 +227,143 @@ def show_patient_management_page():
             with col_submit2:
                 st.form_submit_button("🔄 Clear Form", type="secondary", width="stretch")
     
+    with tab3:
+        st.markdown("### Discharged Patients")
+        st.caption("Discharged patients keep their cycle history but no longer appear in due lists.")
+        
+        discharged_df = get_discharged_patients()
+        if not discharged_df.empty:
+            for _, patient in discharged_df.iterrows():
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.write(f"👤 **{patient['name']}** (#{patient['id']}) - discharged {patient['discharged_at']}")
+                with col2:
+                    if st.button("↩️ Readmit", key=f"readmit_{patient['id']}"):
+                        readmit_patient(patient['id'])
+                        st.success(f"✅ Readmitted {patient['name']}!")
+                        st.rerun()
+        else:
+            st.info("No discharged patients.")
+    
+    with tab4:
+        _show_duplicates()
 
+def _show_duplicates():
+    """Find likely duplicate patients and merge a chosen pair"""
+    st.markdown("### Possible Duplicates")
+    st.caption("Matches patients on similar or similar-sounding names, insurance, email and billing date. "
+               "Merging moves the duplicate's cycle history to the patient kept, then deletes the duplicate.")
+    
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        threshold = st.slider("Minimum match score", 0.5, 1.0, DEFAULT_THRESHOLD, 0.05)
+    with col2:
+        st.write("")
+        if st.button("🔍 Find Duplicates", type="primary", width="stretch"):
+            st.session_state.duplicate_pairs = find_duplicates(threshold)
+    
+    pairs = st.session_state.get('duplicate_pairs')
+    if pairs is None:
+        return
+    if pairs.empty:
+        st.info("No likely duplicates found.")
+        return
+    
+    st.dataframe(pairs, width="stretch", hide_index=True)
+    pair_index = st.selectbox(
+        "Pair to merge", pairs.index,
+        format_func=lambda i: f"{pairs.at[i, 'keep_name']} (#{pairs.at[i, 'keep_id']}) ↔ "
+                              f"{pairs.at[i, 'duplicate_name']} (#{pairs.at[i, 'duplicate_id']}) · {pairs.at[i, 'score']}"
+    )
+    pair = pairs.loc[pair_index]
+    left, right = get_patient(int(pair['keep_id'])), get_patient(int(pair['duplicate_id']))
+    if left is None or right is None:
+        st.warning("⚠️ One of these patients no longer exists. Run the search again.")
+        return
+    
+    records = {left['id']: left, right['id']: right}
+    keep_id = st.radio("Keep", list(records), horizontal=True,
+                       format_func=lambda i: f"{records[i]['name']} (#{i} · billing {records[i]['billing_date']})")
+    keep, duplicate = records[keep_id], right if keep_id == left['id'] else left
+    columns = ['name', 'billing_date', 'next_schedule_date', 'blister_schedule', 'insurance', 'delivery', 'cost', 'email']
+    st.dataframe(pd.DataFrame([{'role': 'keep', **{c: keep[c] for c in columns}},
+                               {'role': 'merge & delete', **{c: duplicate[c] for c in columns}}]),
+                 width="stretch", hide_index=True)
+    
+    if st.button("🔗 Merge", type="primary"):
+        result = merge_patients(keep['id'], duplicate['id'], keep['version'], duplicate['version'])
+        if result.success:
+            gone = int(duplicate['id'])
+            st.session_state.duplicate_pairs = pairs[(pairs['keep_id'] != gone) & (pairs['duplicate_id'] != gone)]
+            st.success(f"✅ Merged #{gone} into {keep['name']} (#{keep['id']})")
+            st.rerun()
+        else:
+            st.warning("⚠️ One of these patients was changed by someone else. Review them and try again.")
+
+def _grid_values(df):
+    """Grid cells as stored values: blanks and NaN become None, dates ISO strings"""
+    df = df.astype(object).where(df.notna(), None)
+    for column in df.columns:
+        df[column] = [None if value == '' else value for value in df[column]]
+    df['billing_date'] = [value.isoformat() if hasattr(value, 'isoformat') else value for value in df['billing_date']]
+    return df
+
+def _show_grid_editor(patients_df, location_names):
+    """Edit many patients in a grid; saving writes only the changed cells in one transaction"""
+    notice = st.session_state.pop('patient_grid_notice', None)
+    if notice:
+        getattr(st, notice[0])(notice[1])
+    
+    columns = GRID_COLUMNS + (['location'] if len(location_names) > 1 else [])
+    grid = patients_df[['id', 'version'] + GRID_COLUMNS + ['location_id', 'next_schedule_date']].reset_index(drop=True)
+    grid['billing_date'] = pd.to_datetime(grid['billing_date'], errors='coerce').dt.date
+    grid['location'] = [location_names.get(int(lid)) if pd.notna(lid) else None for lid in grid['location_id']]
+    grid = grid[['id', 'version'] + columns + ['next_schedule_date']]
+    
+    st.caption("Edit cells, then save once. Only changed cells are written, and next schedule dates are "
+               "recomputed for rows whose billing date, schedule, rule or location changed.")
+    generation = st.session_state.get('patient_grid_generation', 0)
+    edited = st.data_editor(
+        grid, key=f"patient_grid_{generation}", hide_index=True, width="stretch", num_rows="fixed",
+        disabled=['id', 'next_schedule_date'],
+        column_config={
+            'id': st.column_config.NumberColumn("ID"),
+            'version': None,
+            'name': st.column_config.TextColumn("Patient Name", required=True),
+            'delivery': st.column_config.SelectboxColumn("Delivery", options=DELIVERY_OPTIONS),
+            'insurance': st.column_config.TextColumn("Insurance"),
+            'cost': st.column_config.NumberColumn("Cost ($)", min_value=0.0, step=0.01, format="$%.2f"),
+            'blister_schedule': st.column_config.SelectboxColumn("Blister Schedule", options=SCHEDULE_OPTIONS),
+            'billing_date': st.column_config.DateColumn("Billing Date", format="YYYY-MM-DD", required=True),
+            'custom_rule': st.column_config.TextColumn("Custom Rule", help=RULE_HELP),
+            'email': st.column_config.TextColumn("Reminder Email"),
+            'location': st.column_config.SelectboxColumn("Location", options=list(location_names.values())),
+            'next_schedule_date': st.column_config.TextColumn("Next Schedule"),
+        },
+    )
+    
+    # Diff the grid against what was loaded, cell by cell
+    before, after = _grid_values(grid[columns]), _grid_values(edited[columns])
+    changed = ~((before == after) | (before.isna() & after.isna()))
+    location_ids = {name: lid for lid, name in location_names.items()}
+    changes = []
+    for row in changed.index[changed.any(axis=1)]:
+        fields = {column: after.at[row, column] for column in columns if changed.at[row, column]}
+        if 'location' in fields:
+            fields['location_id'] = location_ids.get(fields.pop('location'))
+        changes.append((grid.at[row, 'id'], grid.at[row, 'version'], fields))
+    
+    if st.button(f"💾 Save changes ({len(changes)} patient(s))", type="primary", disabled=not changes):
+        result = update_patients(changes)
+        messages = [f"✅ Saved {len(result.updated)} patient(s)"]
+        level = 'success'
+        if result.conflicts:
+            level = 'warning'
+            messages.append(f"⚠️ {len(result.conflicts)} patient(s) were changed by someone else and were not saved: "
+                            + ', '.join(f"#{pid}" for pid in result.conflicts))
+        if result.errors:
+            level = 'warning'
+            messages += [f"❌ #{pid}: {error}" for pid, error in result.errors.items()]
+        st.session_state.patient_grid_notice = (level, "  \n".join(messages))
+        st.session_state.patient_grid_generation = generation + 1
+        st.rerun()
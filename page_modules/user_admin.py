@@ -2,16 +2,43 @@
 User Administration page - User management and app assignments
 """
 
+import os
+import sqlite3
 import streamlit as st
+from modules.database import start_backup, get_backup_jobs, list_backups, verify_backup, restore_backup
 from modules.user_management import (
     get_all_users, create_user, update_user, delete_user,
-    get_all_apps, assign_app_to_user, remove_app_from_user, get_user_assigned_apps
+    get_all_apps, assign_app_to_user, remove_app_from_user, get_user_assigned_apps,
+    get_app_assignment_counts, assign_apps_to_users, revoke_apps_from_users,
+    provision_users_from_csv, CSV_COLUMNS
 )
+from modules.metrics import timed_page
+from modules.profiling import profiling_enabled, set_profiling, get_profiles, clear_profiles
+from modules.business_calendar import (
+    get_locations, add_location, update_location, get_holidays, set_holiday, remove_holiday,
+    get_closures, set_closure, remove_closure, WEEKDAY_LABELS, ROLLS
+)
+from modules.patient_management import recompute_next_schedules
+
+ROLL_LABELS = {'preceding': 'Previous open day', 'following': 'Next open day'}
+
+def _weekmask(open_days):
+    return ''.join('1' if label in open_days else '0' for label in WEEKDAY_LABELS)
+
+def _recompute_schedules():
+    """Move next schedule dates after a calendar change and report how many moved"""
+    moved = recompute_next_schedules()
+    st.success(f"Calendar saved; {moved} patient(s) had their next schedule date moved")
 
+@timed_page
 def show_user_admin_page():
     """Display the user administration page"""
     
-    tab1, tab2 = st.tabs(["Users", "App Assignments"])
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["Users", "App Assignments", "Backups", "Profiling", "Calendar"])
+    
+    # Loaded once per run and shared by both tabs
+    users_df = get_all_users()
+    user_labels = {row['id']: f"{row['full_name']} (@{row['username']})" for _, row in users_df.iterrows()}
     
     with tab1:
         st.subheader("Manage Users")
@@ -35,9 +62,21 @@ def show_user_admin_page():
                     else:
                         st.error("Please fill in all fields")
         
+        # Provision many users from a CSV file
+        with st.expander("📄 Import Users from CSV"):
+            st.caption(f"Columns: {', '.join(CSV_COLUMNS)} and optionally apps (app keys separated by ';')")
+            csv_file = st.file_uploader("CSV file", type=["csv"], key="provision_csv")
+            if csv_file is not None and st.button("Import Users", type="primary"):
+                summary = provision_users_from_csv(csv_file)
+                if summary['created']:
+                    st.success(f"Created {len(summary['created'])} user(s)")
+                if summary['skipped']:
+                    st.info(f"Skipped existing usernames: {', '.join(summary['skipped'])}")
+                for error in summary['errors']:
+                    st.error(error)
+        
         # List users
         st.subheader("Existing Users")
-        users_df = get_all_users()
         
         if not users_df.empty:
             for index, user in users_df.iterrows():
@@ -74,29 +113,40 @@ def show_user_admin_page():
     with tab2:
         st.subheader("App Assignments")
         
-        users_df = get_all_users()
         apps_df = get_all_apps()
         
         if not users_df.empty and not apps_df.empty:
-            selected_user = st.selectbox("Select User", 
-                                        users_df['username'].tolist(),
-                                        format_func=lambda x: f"{users_df[users_df['username']==x]['full_name'].values[0]} (@{x})")
+            app_labels = {row['id']: row['app_name'] for _, row in apps_df.iterrows()}
             
-            user_id = int(users_df[users_df['username'] == selected_user]['id'].values[0])
-            assigned_apps = get_user_assigned_apps(user_id)
+            # Bulk assignment for many users at once
+            with st.expander("👥 Bulk Assign / Revoke"):
+                bulk_user_ids = st.multiselect("Users", list(user_labels), format_func=user_labels.get,
+                                               key="bulk_user_ids")
+                bulk_app_ids = st.multiselect("Apps", list(app_labels), format_func=app_labels.get,
+                                              key="bulk_app_ids")
+                col_bulk1, col_bulk2 = st.columns(2)
+                with col_bulk1:
+                    if st.button("Assign to selected", type="primary", disabled=not (bulk_user_ids and bulk_app_ids)):
+                        added = assign_apps_to_users(bulk_user_ids, bulk_app_ids)
+                        st.success(f"✅ Added {added} assignment(s)")
+                with col_bulk2:
+                    if st.button("Revoke from selected", disabled=not (bulk_user_ids and bulk_app_ids)):
+                        removed = revoke_apps_from_users(bulk_user_ids, bulk_app_ids)
+                        st.success(f"Removed {removed} assignment(s)")
             
-            # Debug: Show the user_id being used
-            st.write(f"🔍 **Debug:** Assigning to user_id = {user_id}")
+            user_id = st.selectbox("Select User", list(user_labels), format_func=user_labels.get)
+            assigned_apps = get_user_assigned_apps(user_id)
             
             # Show currently assigned apps
             if assigned_apps:
-                assigned_app_names = apps_df[apps_df['id'].isin(assigned_apps)]['app_name'].tolist()
+                assigned_app_names = [app_labels[app_id] for app_id in assigned_apps if app_id in app_labels]
                 st.success(f"✅ Currently assigned: {', '.join(assigned_app_names)}")
             else:
                 st.info(f"ℹ️ No apps currently assigned to this user")
             
             st.write("**Available Apps:**")
             
+            assignment_counts = get_app_assignment_counts()
             for index, app in apps_df.iterrows():
                 is_assigned = app['id'] in assigned_apps
                 col1, col2 = st.columns([3, 1])
@@ -104,6 +154,7 @@ def show_user_admin_page():
                 with col1:
                     status_icon = "✅" if is_assigned else "⬜"
                     st.write(f"{status_icon} **{app['app_name']}** - {app['description']}")
+                    st.caption(f"{assignment_counts.get(app['id'], 0)} user(s) assigned")
                 
                 with col2:
                     if is_assigned:
@@ -121,3 +172,153 @@ def show_user_admin_page():
                             st.rerun()
         else:
             st.info("No users or apps available")
+    
+    with tab3:
+        st.subheader("Database Backups")
+        st.caption("Online backups copy the database in small batches in the background, so staff can keep working.")
+        
+        if st.button("💾 Start Backup", type="primary"):
+            start_backup()
+            st.success("Backup started")
+        
+        jobs = get_backup_jobs()
+        if jobs:
+            st.markdown("**Recent backup runs**")
+            st.dataframe([job.stats() for job in jobs], width="stretch", hide_index=True)
+            if any(job.status == 'running' for job in jobs):
+                if st.button("🔄 Refresh progress"):
+                    st.rerun()
+        
+        backups = list_backups()
+        if backups:
+            st.markdown("**Backup files**")
+            selected_backup = st.selectbox("Backup", backups, format_func=os.path.basename)
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("🔍 Verify"):
+                    if verify_backup(selected_backup):
+                        st.success("Integrity check passed")
+                    else:
+                        st.error("Integrity check failed")
+            with col2:
+                confirm_restore = st.checkbox("I understand restoring replaces all current data")
+                if st.button("♻️ Restore", disabled=not confirm_restore):
+                    if restore_backup(selected_backup):
+                        st.success(f"Restored {os.path.basename(selected_backup)}")
+                    else:
+                        st.error("Backup failed its integrity check and was not restored")
+        else:
+            st.info("No backups yet")
+    
+    with tab4:
+        st.subheader("Rerun Profiling")
+        st.caption("Profiles every page rerun with cProfile and tracemalloc. Adds noticeable overhead; "
+                   "switch it off once you have what you need.")
+        
+        enabled = st.toggle("Profile reruns", value=profiling_enabled())
+        if enabled != profiling_enabled():
+            set_profiling(enabled)
+            st.rerun()
+        
+        profiles = get_profiles()
+        if profiles:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                selected = st.selectbox(
+                    "Profile", profiles,
+                    format_func=lambda p: f"#{p.id} {p.started_at} · {p.user or 'logged out'} · "
+                                          f"{p.duration_seconds}s · peak {p.peak_kib} KiB"
+                )
+            with col2:
+                st.download_button("⬇️ .prof", selected.prof, file_name=f"rerun_{selected.id}.prof",
+                                   mime="application/octet-stream")
+                if st.button("Clear"):
+                    clear_profiles()
+                    st.rerun()
+            
+            st.markdown("**Top functions by cumulative time**")
+            st.dataframe(selected.functions, width="stretch", hide_index=True)
+            st.markdown("**Top allocation sites**")
+            st.dataframe(selected.allocations, width="stretch", hide_index=True)
+            st.caption("Open a .prof file with `python -m pstats rerun_N.prof` or snakeviz.")
+        else:
+            st.info("No profiles captured yet")
+    
+    with tab5:
+        st.subheader("Opening Days and Closures")
+        st.caption("Next schedule dates that fall on a day a location is closed move to its previous "
+                   "(or next) open day. Holidays close every location.")
+        
+        locations = get_locations()
+        location_names = {location['id']: location['name'] for location in locations}
+        for location in locations:
+            with st.expander(f"🏥 {location['name']}"):
+                with st.form(key=f"location_form_{location['id']}"):
+                    name = st.text_input("Name", value=location['name'])
+                    open_days = st.multiselect("Open days", WEEKDAY_LABELS,
+                                               default=[label for label, flag in zip(WEEKDAY_LABELS, location['weekmask'])
+                                                        if flag == '1'])
+                    roll = st.radio("Dates on closed days move to", list(ROLLS), format_func=ROLL_LABELS.get,
+                                    index=list(ROLLS).index(location['roll']), horizontal=True)
+                    if st.form_submit_button("💾 Save Location"):
+                        try:
+                            update_location(location['id'], name, _weekmask(open_days), roll)
+                        except ValueError as e:
+                            st.error(f"❌ {e}")
+                        else:
+                            _recompute_schedules()
+        
+        with st.expander("➕ Add Location"):
+            with st.form("add_location_form", clear_on_submit=True):
+                name = st.text_input("Name")
+                open_days = st.multiselect("Open days", WEEKDAY_LABELS, default=WEEKDAY_LABELS[:6])
+                roll = st.radio("Dates on closed days move to", list(ROLLS), format_func=ROLL_LABELS.get, horizontal=True)
+                if st.form_submit_button("➕ Add Location"):
+                    try:
+                        add_location(name, _weekmask(open_days), roll)
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+                    except sqlite3.IntegrityError:
+                        st.error("❌ Location names must be unique")
+                    else:
+                        st.success(f"✅ Added {name}")
+                        st.rerun()
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("**Holidays** (all locations)")
+            with st.form("holiday_form", clear_on_submit=True):
+                holiday_date = st.date_input("Date")
+                holiday_name = st.text_input("Holiday", placeholder="e.g., Christmas Day")
+                if st.form_submit_button("➕ Add Holiday") and holiday_name:
+                    set_holiday(holiday_date, holiday_name)
+                    _recompute_schedules()
+            holidays = get_holidays()
+            if holidays:
+                st.dataframe([{'date': day, 'holiday': name} for day, name in holidays], width="stretch", hide_index=True)
+                removed = st.selectbox("Holiday to remove", holidays, format_func=lambda h: f"{h[0]} · {h[1]}")
+                if st.button("🗑️ Remove Holiday"):
+                    remove_holiday(removed[0])
+                    _recompute_schedules()
+        
+        with col2:
+            st.markdown("**Closures** (one location)")
+            with st.form("closure_form", clear_on_submit=True):
+                closure_location = st.selectbox("Location", list(location_names), format_func=location_names.get)
+                closure_date = st.date_input("Date")
+                closure_reason = st.text_input("Reason", placeholder="e.g., Stocktake")
+                if st.form_submit_button("➕ Add Closure") and closure_location is not None:
+                    set_closure(closure_location, closure_date, closure_reason or None)
+                    _recompute_schedules()
+            closures = get_closures()
+            if closures:
+                st.dataframe([{'location': name, 'date': day, 'reason': reason} for _, name, day, reason in closures],
+                             width="stretch", hide_index=True)
+                removed = st.selectbox("Closure to remove", closures, format_func=lambda c: f"{c[2]} · {c[1]}")
+                if st.button("🗑️ Remove Closure"):
+                    remove_closure(removed[0], removed[2])
+                    _recompute_schedules()
+        
+        st.divider()
+        if st.button("🔄 Recompute all next schedule dates"):
+            _recompute_schedules()
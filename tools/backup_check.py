@@ -0,0 +1,90 @@
+"""
+Online backup under write load for Blister Pack Scheduler
+
+Fills a throwaway database with patients, then runs start_backup() while a second
+process keeps writing to it. Every write restarts SQLite's stepped backup, so the job
+must notice and finish with a single-step copy instead of copying forever. Exits 1 if
+the backup does not finish within the timeout, fails verification, or a write waited
+longer than the bound.
+
+Usage:
+    python tools/backup_check.py --patients 60000 --write-interval 0.5
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def writer(db_file, interval, stop, results):
+    """Update one patient every interval seconds on its own connection until stopped"""
+    os.environ['BLISTER_DB_FILE'] = db_file
+    sys.path.insert(0, ROOT)
+    from modules.database import get_connection
+
+    waits = []
+    while not stop.is_set():
+        conn = get_connection()
+        started = time.time()
+        conn.execute('UPDATE patients SET cost = cost + 1 WHERE id = 1')
+        conn.commit()
+        waits.append(time.time() - started)
+        conn.close()
+        stop.wait(interval)
+    results.put(waits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--patients', type=int, default=60000, help='patients in the throwaway database')
+    parser.add_argument('--write-interval', type=float, default=0.5, help='seconds between writes')
+    parser.add_argument('--bound', type=float, default=1.0, help='seconds a write may wait on the backup')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds the backup may take')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='blister-backup-')
+    db_file = os.path.join(workdir, 'blister.db')
+    os.environ['BLISTER_DB_FILE'] = db_file
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from modules.database import init_db, get_connection, start_backup
+
+    init_db()
+    conn = get_connection()
+    conn.executemany('''INSERT INTO patients (name, insurance, cost, blister_schedule, billing_date,
+                                              next_schedule_date, billing_day, next_schedule_day)
+                        VALUES (?, ?, ?, 'Weekly', '2026-01-01', '2026-01-08', 20454, 20461)''',
+                     [(f'Backup Check {i}', f'INS{i:08d}', 10.0) for i in range(args.patients)])
+    conn.commit()
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    conn.close()
+
+    context = multiprocessing.get_context('spawn')
+    stop, results = context.Event(), context.Queue()
+    process = context.Process(target=writer, args=(db_file, args.write_interval, stop, results))
+    process.start()
+    time.sleep(args.write_interval)
+
+    print(f"{pages} page(s) in {workdir}; writing every {args.write_interval}s from pid {process.pid}")
+    job = start_backup()
+    job.thread.join(args.timeout)
+    stop.set()
+    waits = results.get(timeout=args.timeout)
+    process.join()
+
+    stats = job.stats()
+    max_wait = max(waits) if waits else 0.0
+    print(f"backup: {stats}")
+    print(f"writes: {len(waits)} max_wait_seconds={max_wait:.4f}")
+    failed = job.thread.is_alive() or stats['status'] != 'done' or max_wait > args.bound
+    print('FAIL' if failed else 'ok')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
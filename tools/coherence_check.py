@@ -0,0 +1,113 @@
+"""
+Multi-replica cache coherence check for Blister Pack Scheduler
+
+Starts several reader processes against one throwaway database, each acting as an
+app replica: it runs the coherence watcher and keeps reading get_patients() and
+get_user_apps() through its in-process caches. The parent process then adds a
+patient and assigns an app, and every reader must see both writes (and a 'reset'
+on its local change feed) within the bound. Exits 1 if any reader serves stale data
+past the bound, or never served from its cache at all.
+
+Usage:
+    python tools/coherence_check.py --replicas 4 --bound 2.0
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POLL_SECONDS = 0.02
+
+
+def replica(user_id, ready, written, results, timeout):
+    """One app replica: warm the caches, then poll until both writes are visible"""
+    sys.path.insert(0, ROOT)
+    from modules.auth import get_user_apps
+    from modules.change_feed import latest_seq
+    from modules.coherence import start_coherence_watcher
+    from modules.metrics import CACHE_REQUESTS
+    from modules.patient_management import get_patients
+
+    start_coherence_watcher()
+    patients_before = len(get_patients())
+    seq_before = latest_seq()
+    get_user_apps(user_id)
+    ready.put(os.getpid())
+    written.wait(timeout)
+
+    seen = {}
+    deadline = time.time() + timeout
+    while len(seen) < 3 and time.time() < deadline:
+        if 'patients' not in seen and len(get_patients()) > patients_before:
+            seen['patients'] = time.time()
+        if 'access' not in seen and not get_user_apps(user_id).empty:
+            seen['access'] = time.time()
+        if 'feed' not in seen and latest_seq() > seq_before:
+            seen['feed'] = time.time()
+        time.sleep(POLL_SECONDS)
+    results.put({
+        'pid': os.getpid(),
+        'seen': seen,
+        'cache_hits': CACHE_REQUESTS.value('patients', 'hit') + CACHE_REQUESTS.value('access', 'hit'),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=4, help='reader processes to start')
+    parser.add_argument('--bound', type=float, default=2.0, help='seconds a replica may serve stale data')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for replicas')
+    args = parser.parse_args()
+
+    # Point every process at a throwaway database before any module opens one
+    workdir = tempfile.mkdtemp(prefix='blister-coherence-')
+    os.environ['BLISTER_DB_FILE'] = os.path.join(workdir, 'blister.db')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    from modules.database import init_db, init_default_data
+    from modules.patient_management import add_patient
+    from modules.user_management import create_user, get_all_apps, assign_app_to_user
+
+    init_db()
+    init_default_data()
+    _, user_id = create_user('replica_check', 'replica_check', 'Replica Check', 'user')
+
+    context = multiprocessing.get_context('spawn')
+    ready, results, written = context.Queue(), context.Queue(), context.Event()
+    processes = [context.Process(target=replica, args=(user_id, ready, written, results, args.timeout))
+                 for _ in range(args.replicas)]
+    for process in processes:
+        process.start()
+    for _ in processes:
+        ready.get(timeout=args.timeout)
+    # Let every replica serve a few reads from its warm cache first
+    time.sleep(0.5)
+
+    print(f"{args.replicas} replica(s) ready in {workdir}; writing from pid {os.getpid()}")
+    written_at = time.time()
+    add_patient('Coherence Check', time.strftime('%Y-%m-%d'))
+    assign_app_to_user(user_id, int(get_all_apps()['id'].iloc[0]))
+    written.set()
+
+    reports = [results.get(timeout=args.timeout * 2) for _ in processes]
+    for process in processes:
+        process.join()
+
+    failed = False
+    for report in sorted(reports, key=lambda r: r['pid']):
+        delays = {scope: round(seen_at - written_at, 3) for scope, seen_at in report['seen'].items()}
+        stale = [scope for scope in ('patients', 'access', 'feed')
+                 if scope not in delays or delays[scope] > args.bound]
+        status = 'ok' if not stale and report['cache_hits'] else 'FAIL'
+        failed |= status == 'FAIL'
+        print(f"replica {report['pid']}: {status} delays={delays} cache_hits={report['cache_hits']}"
+              + (f" stale={stale}" if stale else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Concurrent-session load test for Blister Pack Scheduler
+
+Drives N simulated staff sessions through app.py headless with Streamlit's AppTest:
+log in, open the scheduler, flip calendar months, search patients and cycle due
+patients. Runs against a freshly seeded database and reports throughput, latency
+percentiles, lock errors and peak memory for each session count. Peak memory is the
+worker process's peak resident set from getrusage, so no allocation tracing slows the
+timed steps.
+
+AppTest is not safe to drive from several threads at once, so each session runs in
+its own worker process; they contend on the same SQLite file as real sessions do.
+
+Usage:
+    python tools/load_test.py --sessions 1,2,4,8 --iterations 5 --patients 5000
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, 'app.py')
+
+FIRST_NAMES = ['Alice', 'Bob', 'Carol', 'David', 'Emma', 'Frank', 'Grace', 'Henry', 'Irene', 'Jack']
+LAST_NAMES = ['Smith', 'Jones', 'Brown', 'Taylor', 'Wilson', 'Martin', 'Lee', 'Walker', 'Hall', 'Young']
+SCHEDULES = ['Weekly', 'Bi-weekly', 'Monthly']
+
+
+def seed_database(patients):
+    """Create the schema and insert synthetic patients, some of them due today"""
+    from modules.database import get_connection, init_db, init_default_data
+    from modules.patient_management import calculate_next_schedule, to_day_number
+
+    init_db()
+    init_default_data()
+    today = datetime.now().date()
+    rows = []
+    for i in range(patients):
+        schedule = random.choice(SCHEDULES)
+        billing_date = (today + timedelta(days=random.randint(-10, 40))).strftime('%Y-%m-%d')
+        next_schedule = calculate_next_schedule(billing_date, schedule)
+        rows.append((
+            f"{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {i}",
+            random.choice(['Home Delivery', 'Pickup', 'Mail']),
+            random.choice(['Blue Cross', 'Medicare', 'Sun Life']),
+            round(random.uniform(10, 200), 2),
+            schedule,
+            billing_date,
+            next_schedule,
+            to_day_number(billing_date),
+            to_day_number(next_schedule),
+        ))
+    conn = get_connection()
+    conn.executemany('''INSERT INTO patients
+                        (name, delivery, insurance, cost, blister_schedule, billing_date, next_schedule_date,
+                         billing_day, next_schedule_day)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+    conn.close()
+
+
+class SessionResult:
+    """Per-session step timings and errors"""
+
+    def __init__(self):
+        self.latencies = []
+        self.lock_errors = 0
+        self.errors = []
+        self.peak_memory = 0
+
+
+def _step(at, result, action):
+    """Apply an action to the AppTest, rerun it and time the rerun"""
+    started = time.perf_counter()
+    try:
+        action()
+        at.run()
+    except Exception as e:
+        message = str(e)
+        if 'locked' in message or 'busy' in message:
+            result.lock_errors += 1
+        else:
+            result.errors.append(message)
+        return
+    result.latencies.append(time.perf_counter() - started)
+    for exception in at.exception:
+        message = str(exception.value)
+        if 'locked' in message or 'busy' in message:
+            result.lock_errors += 1
+        else:
+            result.errors.append(message)
+
+
+def _button(at, key):
+    for button in at.button:
+        if button.key == key:
+            return button
+    return None
+
+
+def _init_worker(workdir):
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+
+def _peak_rss_bytes():
+    """Peak resident set size of this process (ru_maxrss is in KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_session(iterations, timeout):
+    """One simulated staff member working through the app (in a worker process)"""
+    result = _drive_session(iterations, timeout)
+    result.peak_memory = _peak_rss_bytes()
+    # Plain dict so it pickles back to the parent process
+    return vars(result)
+
+
+def _drive_session(iterations, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    result = SessionResult()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    _step(at, result, lambda: None)
+
+    def login():
+        at.text_input[0].input('admin')
+        at.text_input[1].input('admin123')
+        at.button[0].click()
+    _step(at, result, login)
+    if not at.session_state['logged_in']:
+        result.errors.append('login failed')
+        return result
+
+    for _ in range(iterations):
+        _step(at, result, lambda: at.sidebar.radio[0].set_value('Blister Scheduler'))
+        for key in ('next_month', 'next_month', 'prev_month'):
+            button = _button(at, key)
+            if button:
+                _step(at, result, button.click)
+
+        search = [t for t in at.text_input if t.key == 'manual_patient_search']
+        if search:
+            _step(at, result, lambda: search[0].input(random.choice(FIRST_NAMES)))
+
+        cycle_buttons = [b for b in at.button if b.key and b.key.startswith('cycle_')]
+        if cycle_buttons:
+            _step(at, result, random.choice(cycle_buttons).click)
+
+        _step(at, result, lambda: at.sidebar.radio[0].set_value('Patient Management'))
+    return result
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))] if ordered else 0.0
+
+
+def run_level(sessions, iterations, timeout, workdir):
+    """Run a number of sessions concurrently and summarise them"""
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=sessions, initializer=_init_worker, initargs=(workdir,)) as pool:
+        futures = [pool.submit(run_session, iterations, timeout) for _ in range(sessions)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for result in results for latency in result['latencies']]
+    for message in sorted({message for result in results for message in result['errors']})[:5]:
+        print(f"  error: {message[:200]}", file=sys.stderr)
+    return {
+        'sessions': sessions,
+        'steps': len(latencies),
+        'throughput_steps_per_second': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(_percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(_percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 1),
+        'lock_errors': sum(result['lock_errors'] for result in results),
+        'other_errors': sum(len(result['errors']) for result in results),
+        'peak_rss_mb_per_session': round(max(result['peak_memory'] for result in results) / 1024 / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', default='1,2,4,8', help='comma separated session counts to test')
+    parser.add_argument('--iterations', type=int, default=3, help='work loops per session')
+    parser.add_argument('--patients', type=int, default=2000, help='patients to seed')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds allowed per rerun')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # Point the app at a throwaway database before any module opens one
+    workdir = tempfile.mkdtemp(prefix='blister-load-')
+    os.environ['BLISTER_DB_FILE'] = os.path.join(workdir, 'blister.db')
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+
+    print(f"Seeding {args.patients} patients in {workdir}")
+    seed_database(args.patients)
+
+    results = []
+    for sessions in [int(n) for n in args.sessions.split(',')]:
+        print(f"Running {sessions} concurrent session(s)...")
+        results.append(run_level(sessions, args.iterations, args.timeout, workdir))
+
+    columns = list(results[0].keys())
+    print()
+    print(' | '.join(columns))
+    for row in results:
+        print(' | '.join(str(row[column]) for column in columns))
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()